@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Resident node agent.
+
+Runs on every node in place of starting ``sudo python3 main.py`` over SSH
+for each deploy. The agent keeps a Docker client, the database pool and the
+warm container pool alive between spawns and serves a small JSON API on
+127.0.0.1 only; the deployer reaches it through its pooled SSH connection
+(a direct-tcpip channel), so no extra port is exposed.
+
+    POST /spawn                        {"plan_id", "subscription_id", "node_id", "correlation_id"}
+    GET  /containers/<container_id>    inspect an instance container
+    POST /containers/<container_id>/stop
+    GET  /health
+    GET  /latency                      spawn phase latency histograms
+"""
+
+import logging
+import os
+
+import docker
+from flask import Flask, request, jsonify
+
+import catalog
+import db
+import node_identity
+import port_allocator
+import tracing
+import warm_pool
+from main import PlanNotFoundError, get_plan_details, traced_provision
+
+AGENT_HOST = '127.0.0.1'
+AGENT_PORT = int(os.getenv('AGENT_PORT', '7070'))
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+app = Flask(__name__)
+
+client = docker.from_env()
+allocator = port_allocator.PortAllocator(seed=lambda: port_allocator.docker_bound_ports(client))
+pool = warm_pool.WarmPool(client, allocator.allocate, port_release=allocator.free)
+
+
+# Configure the warm pool shapes and start refilling in the background
+def start_warm_pool():
+    pool.configure(get_plan_details)
+    pool.start()
+
+
+@app.route('/spawn', methods=['POST'])
+def spawn():
+    data = request.get_json(silent=True) or {}
+    plan_id = data.get('plan_id')
+    subscription_id = data.get('subscription_id')
+    node_id = data.get('node_id')
+    correlation_id = data.get('correlation_id') or request.headers.get(tracing.CORRELATION_HEADER)
+
+    if not plan_id or not subscription_id or not node_id:
+        return jsonify({"error": "Missing required fields: plan_id, subscription_id, node_id"}), 400
+
+    try:
+        with db.get_pool().connection() as connection:
+            result = traced_provision(connection, plan_id, subscription_id, node_id,
+                                      correlation_id=correlation_id, client=client, pool=pool)
+        return jsonify(result), 200
+    except PlanNotFoundError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.exception("Spawn %s for subscription %s failed", correlation_id, subscription_id)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/containers/<container_id>', methods=['GET'])
+def inspect_container(container_id):
+    try:
+        container = client.containers.get(container_id)
+    except docker.errors.NotFound:
+        return jsonify({"error": "Container not found"}), 404
+    return jsonify({
+        "container_id": container.id,
+        "status": container.status,
+        "started_at": container.attrs['State'].get('StartedAt'),
+        "internal_ip": node_identity.internal_ip(container),
+        "ports": container.attrs['HostConfig'].get('PortBindings') or {},
+    }), 200
+
+
+@app.route('/containers/<container_id>/stop', methods=['POST'])
+def stop_container(container_id):
+    try:
+        container = client.containers.get(container_id)
+        container.stop()
+        with db.get_pool().connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("UPDATE TB_Instances SET instance_status = 'Stopped' WHERE container_id = ?",
+                           (container.id,))
+            connection.commit()
+        return jsonify({"container_id": container.id, "status": "Stopped"}), 200
+    except docker.errors.NotFound:
+        return jsonify({"error": "Container not found"}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({
+        "status": "ok",
+        "warm_pool": pool.status(),
+        "ports": allocator.stats(),
+        "db_pool": db.get_pool().stats(),
+        "catalog": catalog.get_catalog().stats(),
+    }), 200
+
+
+@app.route('/latency', methods=['GET'])
+def latency():
+    return jsonify(tracing.histograms()), 200
+
+
+if __name__ == '__main__':
+    catalog.get_catalog().preload()
+    start_warm_pool()
+    node_id = int(os.getenv('NODE_ID')) if os.getenv('NODE_ID') else None
+    port_allocator.start_reconciler(allocator, lambda: port_allocator.used_ports(client, node_id))
+    app.run(host=AGENT_HOST, port=AGENT_PORT, threaded=True)
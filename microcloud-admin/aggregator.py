@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""Central metrics fan-in across all nodes.
+
+Instead of every node's metrics.py writing to SQL Server, the node
+collectors run with METRICS_INGEST=off and keep their samples in memory.
+A single aggregator polls ``/metrics/latest`` on every TB_Nodes entry
+concurrently each round, merges the new samples and writes them through
+one ``MetricsIngest`` in large batches. The newest sample of each instance
+also goes to TB_Instance_State (see instance_state.py).
+
+Nodes are reached through the pooled SSH transport on the collector's
+loopback port (AGGREGATOR_TRANSPORT=ssh, the default) or over plain HTTP
+on node_ip:METRICS_PORT (AGGREGATOR_TRANSPORT=http). Every node gets
+AGGREGATOR_NODE_TIMEOUT seconds per round. A node that is slow or
+unreachable is left out of that round, and it isn't polled again until
+its earlier request has finished, so one bad node never stalls the rest.
+
+    python3 aggregator.py          # run forever
+    python3 aggregator.py --once   # one round, print the report
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import catalog
+import db
+import instance_state
+import rollup
+import ssh_pool
+from ingest import MetricsIngest
+
+logger = logging.getLogger(__name__)
+
+INTERVAL = float(os.getenv('AGGREGATOR_INTERVAL', '5'))
+NODE_TIMEOUT = float(os.getenv('AGGREGATOR_NODE_TIMEOUT', '3'))
+WORKERS = int(os.getenv('AGGREGATOR_WORKERS', '32'))
+TRANSPORT = os.getenv('AGGREGATOR_TRANSPORT', 'ssh')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '5000'))
+
+
+def load_nodes():
+    return [(node.node_id, node.node_ip, node.node_ssh_port) for node in catalog.get_catalog().nodes()]
+
+
+class _NodeState:
+    def __init__(self):
+        self.in_flight = False
+        self.last_seen = {}  # container id -> timestamp of the last sample taken
+        self.ok = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.last_error = None
+        self.last_latency = None
+
+
+class Aggregator:
+    def __init__(self, pool, transport=TRANSPORT, node_timeout=NODE_TIMEOUT, workers=WORKERS):
+        self.pool = pool
+        self.transport = transport
+        self.node_timeout = node_timeout
+        self.ingest = MetricsIngest(pool, flush_size=10 ** 9, flush_interval=float('inf'))
+        self.state = instance_state.InstanceState(pool, self.ingest.known)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='aggregate')
+        self._ssh = None
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def _node_list(self):
+        # TB_Nodes is cached by the catalog, so this is cheap every round
+        return load_nodes()
+
+    def _fetch(self, node_ip):
+        if self.transport == 'http':
+            url = f"http://{node_ip}:{METRICS_PORT}/metrics/latest"
+            with urllib.request.urlopen(url, timeout=self.node_timeout) as response:
+                return json.loads(response.read())
+        if self._ssh is None:
+            self._ssh = ssh_pool.SSHPool(lambda: [(ip, port) for _, ip, port in self._node_list()])
+        status, body = self._ssh.request(node_ip, 'GET', '/metrics/latest', port=METRICS_PORT,
+                                         timeout=self.node_timeout)
+        if status != 200:
+            raise Exception(f"HTTP {status}")
+        return body
+
+    def _poll(self, node_id, node_ip, state):
+        started = time.monotonic()
+        try:
+            containers = self._fetch(node_ip)['containers']
+        finally:
+            state.last_latency = time.monotonic() - started
+            state.in_flight = False
+
+        samples = []
+        for container_id, sample in containers.items():
+            if sample['timestamp'] <= state.last_seen.get(container_id, 0):
+                continue  # nothing new since the last round
+            samples.append({**sample, 'container_id': container_id, 'read_at': sample['timestamp'],
+                            'pids': int(sample['pids'])})
+        state.last_seen = {cid: max(s['timestamp'], state.last_seen.get(cid, 0)) for cid, s in containers.items()}
+        return samples
+
+    def round(self):
+        """Poll every node once, write what came back; returns a report."""
+        started = time.monotonic()
+        futures = {}
+        skipped = []
+        for node_id, node_ip, _ in self._node_list():
+            with self._lock:
+                state = self._state.setdefault(node_id, _NodeState())
+                if state.in_flight:
+                    skipped.append(node_id)  # still stuck on an earlier round
+                    continue
+                state.in_flight = True
+            futures[self._executor.submit(self._poll, node_id, node_ip, state)] = (node_id, state)
+
+        done, pending = wait(futures, timeout=self.node_timeout)
+        merged = []
+        for future in done:
+            node_id, state = futures[future]
+            try:
+                merged.extend(future.result())
+                state.ok += 1
+            except Exception as e:
+                state.failures += 1
+                state.last_error = str(e)
+                logger.warning("Node %s failed: %s", node_id, e)
+        for future in pending:
+            node_id, state = futures[future]
+            state.timeouts += 1
+            state.last_error = f"no answer within {self.node_timeout:g}s"
+            logger.warning("Node %s timed out", node_id)
+
+        kept = self.ingest.add(merged)
+        try:
+            self.state.update(merged)
+        except Exception as e:
+            logger.error(f"Error updating instance state: {e}", exc_info=True)
+        written = self.ingest.flush()
+        return {
+            'nodes': len(futures) + len(skipped),
+            'answered': len(done),
+            'timed_out': len(pending),
+            'skipped': len(skipped),
+            'samples': len(merged),
+            'kept': kept,
+            'written': written,
+            'seconds': round(time.monotonic() - started, 3),
+        }
+
+    def status(self):
+        with self._lock:
+            return {
+                str(node_id): {
+                    'ok': s.ok, 'failures': s.failures, 'timeouts': s.timeouts,
+                    'in_flight': s.in_flight, 'last_error': s.last_error,
+                    'last_latency': round(s.last_latency, 3) if s.last_latency is not None else None,
+                }
+                for node_id, s in self._state.items()
+            }
+
+    def run_forever(self, interval=INTERVAL, rollup_enabled=True):
+        last_rollup = 0.0
+        while True:
+            started = time.monotonic()
+            try:
+                report = self.round()
+                logger.info("Aggregated %(samples)d samples from %(answered)d/%(nodes)d nodes, "
+                            "wrote %(written)d rows in %(seconds).3fs", report)
+            except Exception as e:
+                logger.error(f"Aggregation round failed: {e}", exc_info=True)
+            if rollup_enabled and time.monotonic() - last_rollup >= rollup.RUN_INTERVAL:
+                last_rollup = time.monotonic()
+                try:
+                    rollup.run(self.pool)
+                except Exception as e:
+                    logger.error(f"Error in rollup: {e}", exc_info=True)
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect metrics from every node and write them centrally.")
+    parser.add_argument('--once', action='store_true', help='Run one round and print the report')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
+    aggregator = Aggregator(db.get_pool())
+    if args.once:
+        report = aggregator.round()
+        print(json.dumps({'round': report, 'nodes': aggregator.status()}, indent=2))
+    else:
+        aggregator.run_forever(rollup_enabled=os.getenv('ROLLUP_ENABLED', 'true').lower() == 'true')
+
+
+if __name__ == '__main__':
+    main()
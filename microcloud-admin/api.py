@@ -1,27 +1,33 @@
 from flask import Flask, request, jsonify
 import os
-import pyodbc
 import docker
-import random
-import socket
-import time
 import secrets
 import string
 from dotenv import load_dotenv
-import tempfile
-import shutil
-import shlex
-import requests
+import catalog
+import db
+import image_cache
+import instances
+import node_identity
+import port_allocator
+import prometheus
+import readiness
+import tracing
+import warm_pool
 import jwt
 from functools import wraps
 from datetime import datetime, timedelta
 
 app = Flask(__name__)
+prometheus.instrument(app)
 
 # Load environment variables
 load_dotenv()
 JWT_SECRET = os.getenv('JWT_SECRET')
 
+# Warm container pool, created on first use
+_warm_pool = None
+
 # Utility to create JWT
 def create_jwt(data, expires_in=60):
     payload = {
@@ -55,48 +61,26 @@ def jwt_required(f):
         return f(*args, **kwargs)
     return wrapper
 
-# Connect to the database
-def connect_db(db_credentials):
-    conn_str = (
-        f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-        f"SERVER={db_credentials['server']};"
-        f"DATABASE={db_credentials['database']};"
-        f"UID={db_credentials['username']};"
-        f"PWD={db_credentials['password']}"
-    )
-    try:
-        connection = pyodbc.connect(conn_str)
-        return connection
-    except pyodbc.Error as e:
-        raise Exception(f"Database connection failed: {str(e)}")
-
-# Retrieve plan details from the database
-def get_plan_details(connection, plan_id):
-    cursor = connection.cursor()
-    query = "SELECT * FROM VW_Plans WHERE plan_id = ?"
-    cursor.execute(query, (plan_id,))
-    row = cursor.fetchone()
-    if row:
-        return {
-            'vcpu': row.vcpu,
-            'ram': row.ram
-        }
+# Retrieve plan details from the catalog cache
+def get_plan_details(plan_id, connection=None):
+    plan_details = catalog.get_catalog().plan(plan_id, connection)
+    if plan_details:
+        return plan_details
     else:
         raise Exception(f"Plan ID {plan_id} not found.")
 
-# Check if a port is free
-def is_port_free(port):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        return s.connect_ex(('localhost', port)) != 0
+# Get the node's port allocator
+def get_port_allocator(connection=None, node_id=None):
+    client = docker.from_env()
+
+    # Seeding only happens the first time the allocator state is created on this node
+    def seed():
+        used = port_allocator.docker_bound_ports(client)
+        if connection is not None:
+            used |= port_allocator.db_mapped_ports(connection, node_id)
+        return used
 
-# Get a list of free ports
-def get_free_ports(count):
-    ports = set()
-    while len(ports) < count:
-        port = random.randint(10000, 11500)
-        if is_port_free(port):
-            ports.add(port)
-    return list(ports)
+    return port_allocator.PortAllocator(seed=seed)
 
 # Generate a random password
 def generate_password(length=12):
@@ -107,62 +91,57 @@ def generate_password(length=12):
 def spawn_docker_instance(vcpu, ram, port_mappings, ssh_password):
     client = docker.from_env()
 
-    # Escape the password for the shell command
-    escaped_password = shlex.quote(ssh_password)
+    with tracing.span('image'):
+        image = image_cache.ensure_base_image(client)
 
-    # Create a Dockerfile for the container
-    dockerfile = f"""
-    FROM ubuntu:latest
-    RUN apt-get update && apt-get install -y openssh-server && \\
-        echo 'root:{escaped_password}' | chpasswd && \\
-        sed -i 's/#PermitRootLogin prohibit-password/PermitRootLogin yes/' /etc/ssh/sshd_config && \\
-        sed -i 's/PasswordAuthentication no/PasswordAuthentication yes/' /etc/ssh/sshd_config && \\
-        mkdir /var/run/sshd
-    EXPOSE 22 80 443 23 8083
-    CMD ["/usr/sbin/sshd", "-D"]
-    """
-
-    temp_dir = tempfile.mkdtemp()
-
-    try:
-        dockerfile_path = os.path.join(temp_dir, 'Dockerfile')
-        with open(dockerfile_path, 'w') as f:
-            f.write(dockerfile)
+    mem_limit = f"{ram}m"
+    nano_cpus = int(float(vcpu) * 1e9)
 
-        image, _ = client.images.build(path=temp_dir, rm=True, tag='custom_ubuntu')
-
-        mem_limit = f"{ram}m"
-        nano_cpus = int(float(vcpu) * 1e9)
-
-        ports = {
-            '80/tcp': port_mappings[0],
-            '443/tcp': port_mappings[1],
-            '22/tcp': port_mappings[2],
-            '23/tcp': port_mappings[3],
-            '8083/tcp': port_mappings[4],
-        }
+    ports = {
+        '80/tcp': port_mappings[0],
+        '443/tcp': port_mappings[1],
+        '22/tcp': port_mappings[2],
+        '23/tcp': port_mappings[3],
+        '8083/tcp': port_mappings[4],
+    }
 
+    with tracing.span('run'):
         container = client.containers.run(
-            image='custom_ubuntu',
+            image=image,
             detach=True,
             mem_limit=mem_limit,
             nano_cpus=nano_cpus,
             ports=ports
         )
 
-        time.sleep(5)
-        container.reload()
-
-        return container
-    finally:
-        shutil.rmtree(temp_dir)
-
-# Get public IP address
-def get_public_ip():
+    # Re-inspect after start: run() returns attrs from before the network was set up.
+    # A container that never gets ready is removed so the caller can free its ports
     try:
-        return requests.get('https://api.ipify.org').text
-    except requests.RequestException:
-        return 'Unavailable'
+        with tracing.span('ready'):
+            ready_seconds = readiness.wait_for_ssh('127.0.0.1', port_mappings[2], container=container)
+            container.reload()
+
+        with tracing.span('password'):
+            image_cache.set_root_password(container, ssh_password)
+    except Exception:
+        container.remove(force=True)
+        raise
+
+    return container, ready_seconds
+
+# Get the node's warm container pool
+def get_warm_pool():
+    global _warm_pool
+    if _warm_pool is None:
+        allocator = get_port_allocator()
+        _warm_pool = warm_pool.WarmPool(docker.from_env(), allocator.allocate, port_release=allocator.free)
+    return _warm_pool
+
+# Configure the warm pool shapes and start refilling in the background
+def start_warm_pool():
+    pool = get_warm_pool()
+    pool.configure(get_plan_details)
+    pool.start()
 
 # Login endpoint to issue JWT
 @app.route('/login', methods=['POST'])
@@ -190,61 +169,92 @@ def spawn_instance():
     if not plan_id or not subscription_id or not node_id:
         return jsonify({"error": "Missing required fields: plan_id, subscription_id, node_id"}), 400
 
+    trace = tracing.Trace('spawn', request.headers.get(tracing.CORRELATION_HEADER))
     try:
-        db_credentials = load_env()
-        connection = connect_db(db_credentials)
-
-        plan_details = get_plan_details(connection, plan_id)
-        vcpu = plan_details['vcpu']
-        ram = plan_details['ram']
-
-        free_ports = get_free_ports(5)
-        ssh_password = generate_password()
-
-        container = spawn_docker_instance(vcpu, ram, free_ports, ssh_password)
-
-        container_id = container.id
-        network_settings = container.attrs['NetworkSettings']
-        networks = network_settings['Networks']
-        internal_ip = next(iter(networks.values()))['IPAddress'] if networks else None
-        external_ip = get_public_ip()
-
-        cursor = connection.cursor()
-        cursor.execute("{CALL P_AddInstance(?, ?, ?, ?, ?)}",
-                       (plan_id, subscription_id, node_id, 'Running', container_id))
-        connection.commit()
-
-        cursor.execute("SELECT instance_id FROM TB_Instances WHERE container_id = ?", (container_id,))
-        instance_id = cursor.fetchone().instance_id
-
-        internal_ports = [80, 443, 22, 23, 8083]
-        for ext_port, int_port in zip(free_ports, internal_ports):
-            cursor.execute(
-                "INSERT INTO TB_Port_Mappings (external_port, internal_port, instance_id) VALUES (?, ?, ?)",
-                (ext_port, int_port, instance_id))
-        connection.commit()
-
-        cursor.execute(
-            "INSERT INTO TB_IP_Mappings (external_ip, internal_ip, instance_id) VALUES (?, ?, ?)",
-            (external_ip, internal_ip, instance_id))
-        connection.commit()
-
-        return jsonify({
-            "message": "Docker instance has been created successfully.",
-            "ssh_command": f"ssh root@{external_ip} -p {free_ports[2]}",
-            "password": ssh_password,
-            "instance_id": instance_id,
-            "container_id": container_id,
-            "ports": {
-                "external_ports": free_ports,
-                "internal_ports": internal_ports
-            },
-            "external_ip": external_ip,
-            "internal_ip": internal_ip
-        })
+        with trace, db.get_pool().connection() as connection:
+            with trace.span('plan'):
+                plan_details = get_plan_details(plan_id, connection)
+            vcpu = plan_details['vcpu']
+            ram = plan_details['ram']
+
+            ssh_password = generate_password()
+
+            allocator = get_port_allocator(connection, node_id)
+            with trace.span('warm_claim'):
+                claimed = get_warm_pool().claim(vcpu, ram, ssh_password)
+            if claimed:
+                container, free_ports, ready_seconds = claimed
+            else:
+                with trace.span('ports'):
+                    free_ports = allocator.allocate(5)
+                try:
+                    container, ready_seconds = spawn_docker_instance(vcpu, ram, free_ports, ssh_password)
+                except Exception:
+                    allocator.free(free_ports)
+                    raise
+
+            # An instance that can't be recorded is removed again, with its ports
+            try:
+                container_id = container.id
+                internal_ip = node_identity.internal_ip(container)
+                with trace.span('public_ip'):
+                    external_ip = node_identity.get_identity(node_id).public_ip(connection)
+
+                with trace.span('persist'):
+                    instance_id = instances.persist_instance(
+                        connection, plan_id, subscription_id, node_id, container_id, free_ports, external_ip,
+                        internal_ip)
+            except Exception:
+                container.remove(force=True)
+                allocator.free(free_ports)
+                raise
+
+            return jsonify({
+                "message": "Docker instance has been created successfully.",
+                "ssh_command": f"ssh root@{external_ip} -p {free_ports[2]}",
+                "password": ssh_password,
+                "instance_id": instance_id,
+                "container_id": container_id,
+                "ports": {
+                    "external_ports": free_ports,
+                    "internal_ports": instances.INTERNAL_PORTS
+                },
+                "external_ip": external_ip,
+                "internal_ip": internal_ip,
+                "ready_seconds": round(ready_seconds, 3),
+                "trace": trace.as_dict()
+            })
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Spawn phase latency histograms
+@app.route('/latency', methods=['GET'])
+def latency():
+    return jsonify(tracing.histograms())
+
+# Prometheus metrics
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    exposition = prometheus.Exposition()
+    prometheus.add_request_metrics(exposition)
+    prometheus.add_db_pool_metrics(exposition, db.get_pool().stats())
+    prometheus.add_catalog_metrics(exposition, catalog.get_catalog().stats())
+    prometheus.add_trace_metrics(exposition)
+    if _warm_pool is not None:
+        for shape, status in _warm_pool.status().items():
+            exposition.gauge('microcloud_warm_pool_idle', 'Paused containers ready to claim.',
+                             status['idle'], {'shape': shape})
+            exposition.gauge('microcloud_warm_pool_target', 'Configured pool size.',
+                             status['target'], {'shape': shape})
+    return exposition.response()
+
 if __name__ == '__main__':
+    # Resolve the node's public IP once up front when the node is known
+    if os.getenv('NODE_ID'):
+        node_identity.get_identity(int(os.getenv('NODE_ID'))).public_ip()
+    catalog.get_catalog().preload()
+    start_warm_pool()
+    node_id = int(os.getenv('NODE_ID')) if os.getenv('NODE_ID') else None
+    port_allocator.start_reconciler(get_port_allocator(), lambda: port_allocator.used_ports(docker.from_env(), node_id))
     app.run(host='0.0.0.0', port=5000)
@@ -60,8 +60,21 @@ export default function ManageOrders() {
         throw new Error("Failed to provision order");
       }
 
-      const result = await response.json();
-      console.log(result.message);
+      // The deploy runs as a background job; poll its status until it finishes
+      let job = await response.json();
+      while (job.status === "queued" || job.status === "running") {
+        await new Promise((resolve) => setTimeout(resolve, 2000));
+        const statusResponse = await fetch(`http://143.110.243.146:9999/deploy/${job.job_id}`);
+        if (!statusResponse.ok) {
+          throw new Error("Failed to fetch provisioning status");
+        }
+        job = await statusResponse.json();
+      }
+
+      if (job.status === "failed") {
+        throw new Error(job.error || "Failed to provision order");
+      }
+      console.log(job.result?.message);
     } catch (error) {
       console.error("Error provisioning order:", error);
     } finally {
@@ -0,0 +1,329 @@
+"""Stand-ins for Docker, SQL Server and the node SSH hop.
+
+They implement just enough of the docker-py, pyodbc and SSHPool surface
+for the real spawn, deploy and ingest code to run unchanged, with
+configurable latencies in place of the real work.
+"""
+
+import json
+import os
+import shlex
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import docker
+
+import ssh_pool
+
+
+class FakeSSHTarget:
+    """Listens on a port and answers with an SSH banner after ``delay`` seconds.
+
+    Stands in for sshd inside a container: connections made before the
+    delay has passed are closed without a banner, like docker-proxy
+    accepting before sshd is up.
+    """
+
+    def __init__(self, port, delay):
+        self.port = port
+        self.ready_at = time.monotonic() + delay
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', port))
+        self._sock.listen(16)
+        self._sock.settimeout(0.2)
+        self._stop = threading.Event()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while not self._stop.is_set():
+            try:
+                conn, _ = self._sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            with conn:
+                if time.monotonic() >= self.ready_at:
+                    conn.sendall(b'SSH-2.0-OpenSSH_fake\r\n')
+                    # sshd is confirmed up; stop listening to keep fd use flat
+                    self.close()
+
+    def close(self):
+        self._stop.set()
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+
+
+class FakeContainer:
+    def __init__(self, client, ports, ssh_delay):
+        self.client = client
+        self.id = uuid.uuid4().hex + uuid.uuid4().hex
+        self.short_id = self.id[:12]
+        self.name = f"fake-{self.short_id}"
+        self.status = 'running'
+        self.ports = ports or {}
+        bindings = {k: [{'HostIp': '', 'HostPort': str(v)}] for k, v in self.ports.items()}
+        self.attrs = {
+            'HostConfig': {'PortBindings': bindings},
+            'State': {'StartedAt': time.strftime('%Y-%m-%dT%H:%M:%SZ')},
+            'NetworkSettings': {'IPAddress': '172.17.0.2', 'Networks': {'bridge': {'IPAddress': '172.17.0.2'}}},
+        }
+        self.labels = {}
+        ssh_port = self.ports.get('22/tcp')
+        self._ssh = FakeSSHTarget(ssh_port, ssh_delay) if ssh_port else None
+
+    def reload(self):
+        pass
+
+    def exec_run(self, cmd, **kwargs):
+        time.sleep(self.client.exec_latency)
+        return 0, b''
+
+    def stop(self, **kwargs):
+        self.status = 'exited'
+        if self._ssh:
+            self._ssh.close()
+
+    def remove(self, **kwargs):
+        self.stop()
+        self.client.containers._containers.pop(self.id, None)
+
+    def pause(self):
+        self.status = 'paused'
+
+    def unpause(self):
+        self.status = 'running'
+
+    def rename(self, name):
+        self.name = name
+
+
+class _Images:
+    def __init__(self, client):
+        self.client = client
+        self._tags = set()
+        self._lock = threading.Lock()
+
+    def get(self, tag):
+        with self._lock:
+            if tag not in self._tags:
+                raise docker.errors.ImageNotFound(tag)
+        return tag
+
+    def build(self, tag=None, **kwargs):
+        time.sleep(self.client.build_latency)
+        with self._lock:
+            self._tags.add(tag)
+        return tag, []
+
+    def list(self, **kwargs):
+        return []
+
+
+class _Containers:
+    def __init__(self, client):
+        self.client = client
+        self._containers = {}
+        self._lock = threading.Lock()
+
+    def run(self, image=None, ports=None, **kwargs):
+        time.sleep(self.client.run_latency)
+        container = FakeContainer(self.client, ports, self.client.ssh_delay)
+        with self._lock:
+            self._containers[container.id] = container
+        return container
+
+    def get(self, container_id):
+        with self._lock:
+            for cid, container in self._containers.items():
+                if cid.startswith(container_id) or container.name == container_id:
+                    return container
+        raise docker.errors.NotFound(container_id)
+
+    def list(self, all=False, filters=None, **kwargs):
+        with self._lock:
+            containers = list(self._containers.values())
+        return containers if all else [c for c in containers if c.status == 'running']
+
+
+class FakeDockerClient:
+    """docker.DockerClient look-alike with configurable latencies (seconds)."""
+
+    def __init__(self, build_latency=2.0, run_latency=0.3, ssh_delay=0.2, exec_latency=0.05):
+        self.build_latency = build_latency
+        self.run_latency = run_latency
+        self.ssh_delay = ssh_delay
+        self.exec_latency = exec_latency
+        self.images = _Images(self)
+        self.containers = _Containers(self)
+
+    def close(self):
+        for container in self.containers.list(all=True):
+            container.stop()
+
+
+class Row(sqlite3.Row):
+    """sqlite3 row with pyodbc-style attribute access."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except IndexError:
+            raise AttributeError(name)
+
+
+class _Cursor:
+    def __init__(self, raw):
+        self._raw = raw
+        self.fast_executemany = False
+
+    def execute(self, sql, *params):
+        # pyodbc takes parameters as one sequence or as separate arguments
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = params[0]
+        self._raw.execute(sql, params)
+        return self
+
+    def executemany(self, sql, rows):
+        self._raw.executemany(sql, rows)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+class _Connection:
+    def __init__(self, raw):
+        self.raw = raw
+
+    def cursor(self):
+        return _Cursor(self.raw.cursor())
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+
+# The subset of the SQL Server schema the benchmarked paths touch
+SCHEMA = """
+    CREATE TABLE TB_Nodes (node_id INTEGER PRIMARY KEY, node_ip TEXT, node_ssh_port INTEGER, node_region INTEGER);
+    CREATE TABLE TB_Plans (plan_id INTEGER PRIMARY KEY, vcpu REAL, ram REAL);
+    CREATE VIEW VW_Plans AS SELECT plan_id, vcpu, ram FROM TB_Plans;
+    CREATE TABLE TB_Subscription (sub_id INTEGER PRIMARY KEY, customer_id INTEGER, plan_id INTEGER, status TEXT);
+    CREATE TABLE TB_Instances (instance_id INTEGER PRIMARY KEY AUTOINCREMENT, subscription_id INTEGER,
+                               node_id INTEGER, instance_status TEXT, container_id TEXT);
+    CREATE TABLE TB_SSH_Details (id INTEGER PRIMARY KEY AUTOINCREMENT, ip_addr TEXT, tcp_port INTEGER, psswd TEXT);
+    CREATE TABLE TB_User_Logs (id INTEGER PRIMARY KEY AUTOINCREMENT, event_type TEXT, customer_id INTEGER,
+                               timestamp TEXT);
+    CREATE TABLE TB_Instance_Metrics (id INTEGER PRIMARY KEY AUTOINCREMENT, container_id TEXT, cpu_percent REAL,
+                                      mem_usage REAL, mem_percent REAL, net_io TEXT, block_io TEXT, pids INTEGER,
+                                      net_rx_bytes INTEGER, net_tx_bytes INTEGER, blk_read_bytes INTEGER,
+                                      blk_write_bytes INTEGER, net_rx_rate REAL, net_tx_rate REAL,
+                                      blk_read_rate REAL, blk_write_rate REAL,
+                                      timestamp TEXT DEFAULT CURRENT_TIMESTAMP);
+"""
+
+
+class SQLitePool:
+    """``db.ConnectionPool`` look-alike backed by a throwaway SQLite file."""
+
+    def __init__(self, path=None, query_latency=0.0):
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='microcloud-bench-', suffix='.db')
+            os.close(fd)
+        self.path = path
+        self.query_latency = query_latency
+        self._stats = {'checkouts': 0}
+        with self._raw() as raw:
+            raw.executescript(SCHEMA)
+
+    def _raw(self):
+        raw = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        raw.row_factory = Row
+        return raw
+
+    @contextmanager
+    def connection(self):
+        # A round trip to SQL Server is the cost being modelled, so every
+        # checkout pays query_latency once
+        self._stats['checkouts'] += 1
+        if self.query_latency:
+            time.sleep(self.query_latency)
+        raw = self._raw()
+        try:
+            yield _Connection(raw)
+            raw.rollback()
+        finally:
+            raw.close()
+
+    def stats(self):
+        return dict(self._stats)
+
+    def close(self):
+        os.unlink(self.path)
+
+
+class FakeSSHPool:
+    """``ssh_pool.SSHPool`` look-alike for nodes with and without an agent.
+
+    Nodes in ``agent_nodes`` (all of them when None) answer agent requests
+    after ``latency``. The others refuse the agent port, so the deployer
+    falls back to running ``main.py`` over SSH; ``run`` answers that after
+    ``ssh_latency`` (the interpreter start and imports of a one-shot spawn)
+    with the lines main.py prints.
+    """
+
+    def __init__(self, latency=1.0, ssh_latency=2.0, agent_nodes=None):
+        self.latency = latency
+        self.ssh_latency = ssh_latency
+        self.agent_nodes = agent_nodes
+        self._ports = iter(range(30000, 60000))
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'commands': 0}
+
+    def _next_port(self):
+        with self._lock:
+            return next(self._ports)
+
+    def request(self, node_ip, method, path, body=None, port=None, timeout=None):
+        with self._lock:
+            self._stats['requests'] += 1
+        if self.agent_nodes is not None and node_ip not in self.agent_nodes:
+            raise ssh_pool.ServiceUnavailableError(f"No agent listening on {node_ip}")
+        time.sleep(self.latency)
+        return 200, {
+            'external_ip': node_ip,
+            'ssh_port': self._next_port(),
+            'password': 'benchmark',
+            'trace': {'spans': [{'phase': 'spawn', 'seconds': self.latency}]},
+        }
+
+    def run(self, node_ip, command, timeout=None):
+        with self._lock:
+            self._stats['commands'] += 1
+        args = shlex.split(command)
+        if 'main.py' not in args or len(args) < args.index('main.py') + 4:
+            return 2, '', f"usage: main.py plan_id subscription_id node_id (got {command!r})\n"
+        time.sleep(self.ssh_latency)
+        trace = {'spans': [{'phase': 'spawn', 'seconds': self.ssh_latency}]}
+        output = (
+            "Docker instance has been created successfully.\n"
+            f"SSH Command: ssh root@{node_ip} -p {self._next_port()}\n"
+            "Password: benchmark\n"
+            f"Ready In: {self.ssh_latency:.3f}s\n"
+            f"Trace: {json.dumps(trace)}\n"
+        )
+        return 0, output, ''
+
+    def stats(self):
+        with self._lock:
+            return {'connects': 0, 'reconnects': 0, 'channel_waits': 0, 'nodes': {}, **self._stats}
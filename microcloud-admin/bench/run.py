@@ -0,0 +1,276 @@
+"""Offline benchmarks for the spawn, deploy and metrics ingest paths.
+
+Runs the real code against the stand-ins in ``bench.fakes`` at several
+sizes and writes a JSON results file that can be compared between runs.
+Run from microcloud-admin/:
+
+    python3 -m bench.run run [--sizes 10,100,1000] [--out results.json]
+    python3 -m bench.run compare old.json new.json
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import deployer
+import jobs
+import main as node_main
+import placement
+import port_allocator
+from bench.fakes import FakeDockerClient, FakeSSHPool, SQLitePool
+from ingest import MetricsIngest
+from metric_store import MetricStore
+from stats_collector import RateTracker
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+# Throughput metrics go up when things get better, latencies go down
+HIGHER_IS_BETTER = ('spawns_per_second', 'rows_per_second', 'deploys_per_second')
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+    return ordered[index]
+
+
+def bench_spawn(count, args):
+    """Spawn ``count`` containers through main.spawn_docker_instance."""
+    client = FakeDockerClient(args.build_latency, args.run_latency, args.ssh_delay, args.exec_latency)
+    state_dir = tempfile.TemporaryDirectory(prefix='microcloud-bench-ports-')
+    allocator = port_allocator.PortAllocator(start=args.port_start, end=args.port_start + 5 * count + 500,
+                                             state_path=os.path.join(state_dir.name, 'ports.bin'))
+    latencies = []
+
+    def spawn(_):
+        started = time.monotonic()
+        ports = allocator.allocate(5)
+        node_main.spawn_docker_instance(1, 512, ports, 'benchmark', client)
+        latencies.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(spawn, range(count)))
+    finally:
+        client.close()
+        state_dir.cleanup()
+    elapsed = time.monotonic() - started
+    return {
+        'spawns_per_second': round(count / elapsed, 3),
+        'p50_seconds': round(percentile(latencies, 0.5), 4),
+        'p99_seconds': round(percentile(latencies, 0.99), 4),
+    }
+
+
+def _seed_deploys(pool, count, nodes):
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany("INSERT INTO TB_Nodes (node_id, node_ip, node_ssh_port, node_region) VALUES (?, ?, ?, 1)",
+                           [(n, f"10.0.0.{n}", 22) for n in range(1, nodes + 1)])
+        cursor.execute("INSERT INTO TB_Plans (plan_id, vcpu, ram) VALUES (1, 1, 1024)")
+        cursor.executemany("INSERT INTO TB_Subscription (sub_id, customer_id, plan_id, status) "
+                           "VALUES (?, ?, 1, 'Payment Pending')",
+                           [(i, i) for i in range(1, count + 1)])
+        conn.commit()
+
+
+def bench_deploy(count, args):
+    """Run ``count`` deploys through the deployer's job queue, some over the SSH fallback."""
+    pool = SQLitePool(query_latency=args.query_latency)
+    _seed_deploys(pool, count, args.nodes)
+
+    # Enough capacity everywhere; placement state is loaded once up front
+    scheduler = placement.Scheduler(pool, strategy=args.strategy, refresh_interval=float('inf'))
+    scheduler.plans = {1: (1.0, 1024.0)}
+    capacity = {'vcpu': count, 'ram': count * 1024, 'cpu_overcommit': 1.0, 'ram_overcommit': 1.0}
+    scheduler.nodes = {n: placement.NodeState(n, f"10.0.0.{n}", 1, capacity) for n in range(1, args.nodes + 1)}
+    scheduler._loaded_at = time.monotonic()
+
+    # The first --ssh-nodes nodes have no agent and take the SSH fallback
+    db._pool = pool
+    deployer._scheduler = scheduler
+    ssh = deployer._ssh_pool = FakeSSHPool(
+        args.agent_latency, args.ssh_latency,
+        agent_nodes={f"10.0.0.{n}" for n in range(args.ssh_nodes + 1, args.nodes + 1)})
+    queue = deployer._deploy_queue = jobs.JobQueue(
+        deployer.execute_deploy, max_workers=args.concurrency, per_node_limit=args.per_node_limit,
+        max_pending=count + 1)
+
+    started = time.monotonic()
+    submitted = [
+        queue.submit(sub_id, {'plan_id': 1, 'subscription_id': sub_id, 'region_id': 1})[0]
+        for sub_id in range(1, count + 1)
+    ]
+    while any(job.status in (jobs.QUEUED, jobs.RUNNING) for job in submitted):
+        time.sleep(0.01)
+    elapsed = time.monotonic() - started
+
+    failed = [job for job in submitted if job.status == jobs.FAILED]
+    latencies = [job.finished_at - job.created_at for job in submitted]
+    pool.close()
+    return {
+        'deploys_per_second': round(count / elapsed, 3),
+        'p50_seconds': round(percentile(latencies, 0.5), 4),
+        'p99_seconds': round(percentile(latencies, 0.99), 4),
+        'failed': len(failed),
+        'ssh_fallbacks': ssh.stats()['commands'],
+    }
+
+
+def _samples(container_ids, tick):
+    now = time.time()
+    return [{
+        'container_id': cid,
+        'read_at': now,
+        'cpu_percent': (i * 7 + tick) % 100 / 1.0,
+        'mem_usage': 256.0 + i % 64,
+        'mem_percent': 25.0,
+        'mem_bytes': (256 + i % 64) * 1024 * 1024,
+        'net_rx_bytes': tick * 1000 + i,
+        'net_tx_bytes': tick * 500 + i,
+        'blk_read_bytes': tick * 4096,
+        'blk_write_bytes': tick * 8192,
+        'pids': 12,
+    } for i, cid in enumerate(container_ids)]
+
+
+def bench_ingest(count, args):
+    """Push ``args.ticks`` ticks of samples for ``count`` containers through the ingest."""
+    pool = SQLitePool(query_latency=args.query_latency)
+    container_ids = [f"{i:012x}" for i in range(count)]
+    with pool.connection() as conn:
+        conn.cursor().executemany(
+            "INSERT INTO TB_Instances (subscription_id, node_id, instance_status, container_id) "
+            "VALUES (?, 1, 'Running', ?)", [(i, cid + 'f' * 52) for i, cid in enumerate(container_ids)])
+        conn.commit()
+
+    ingest = MetricsIngest(pool, flush_size=args.flush_size, flush_interval=float('inf'))
+    rates = RateTracker()
+    store = MetricStore(interval=5)
+    ticks = [_samples(container_ids, tick) for tick in range(args.ticks)]
+
+    tick_seconds = []
+    started = time.monotonic()
+    for samples in ticks:
+        tick_started = time.monotonic()
+        samples = rates.apply(samples)
+        store.add(samples)
+        ingest.add(samples)
+        ingest.maybe_flush()
+        tick_seconds.append(time.monotonic() - tick_started)
+    ingest.flush()
+    elapsed = time.monotonic() - started
+    pool.close()
+    return {
+        'rows_per_second': round(ingest.stats['rows_written'] / elapsed, 1),
+        'tick_p50_seconds': round(percentile(tick_seconds, 0.5), 5),
+        'tick_p99_seconds': round(percentile(tick_seconds, 0.99), 5),
+        'rows': ingest.stats['rows_written'],
+    }
+
+
+BENCHMARKS = {'spawn': bench_spawn, 'deploy': bench_deploy, 'ingest': bench_ingest}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    sizes = [int(s) for s in args.sizes.split(',')]
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    results = {}
+    for name in names:
+        results[name] = {}
+        for size in sizes:
+            print(f"{name} @ {size} ...", file=sys.stderr, flush=True)
+            results[name][str(size)] = BENCHMARKS[name](size, args)
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('command', 'out')},
+        'results': results,
+    }
+
+    out = args.out
+    if out is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        out = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{report['revision'] or 'local'}.json")
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Results written to {out}", file=sys.stderr)
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"{'benchmark':<28}{'metric':<22}{'old':>12}{'new':>12}{'change':>10}")
+    for name, sizes in new['results'].items():
+        for size, metrics in sizes.items():
+            before = old['results'].get(name, {}).get(size, {})
+            for metric, value in metrics.items():
+                previous = before.get(metric)
+                change = ''
+                if isinstance(previous, (int, float)) and previous and isinstance(value, (int, float)):
+                    delta = (value - previous) / previous * 100
+                    better = delta > 0 if metric in HIGHER_IS_BETTER else delta < 0
+                    change = f"{delta:+.1f}%{'' if better or abs(delta) < 5 else ' !'}"
+                print(f"{name + ' @ ' + size:<28}{metric:<22}{str(previous):>12}{str(value):>12}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the spawn, deploy and ingest paths offline.")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = sub.add_parser('run')
+    run_parser.add_argument('--sizes', default='10,100,1000', help='Container/deploy counts to run at')
+    run_parser.add_argument('--only', help='Comma-separated subset of: ' + ', '.join(BENCHMARKS))
+    run_parser.add_argument('--out', help='Results file (default: bench/results/<time>-<rev>.json)')
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument('--build-latency', type=float, default=2.0)
+    run_parser.add_argument('--run-latency', type=float, default=0.3)
+    run_parser.add_argument('--ssh-delay', type=float, default=0.2)
+    run_parser.add_argument('--exec-latency', type=float, default=0.05)
+    run_parser.add_argument('--query-latency', type=float, default=0.002)
+    run_parser.add_argument('--agent-latency', type=float, default=1.0)
+    run_parser.add_argument('--ssh-latency', type=float, default=2.0)
+    run_parser.add_argument('--nodes', type=int, default=4)
+    run_parser.add_argument('--ssh-nodes', type=int, default=1, help='Nodes without an agent (SSH fallback)')
+    run_parser.add_argument('--strategy', default='spread', choices=['binpack', 'spread'],
+                            help='Placement strategy; spread uses every node')
+    run_parser.add_argument('--per-node-limit', type=int, default=2)
+    run_parser.add_argument('--ticks', type=int, default=20)
+    run_parser.add_argument('--flush-size', type=int, default=500)
+    run_parser.add_argument('--port-start', type=int, default=20000)
+
+    compare_parser = sub.add_parser('compare')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""Read-through cache of the catalogs that barely change.
+
+Plans, nodes (and the regions they're in) and the per-customer deploy
+lookup used to cost a round trip to SQL Server on every spawn and deploy.
+They're now served from memory:
+
+    catalog.get_catalog().plan(plan_id)        # {'vcpu': ..., 'ram': ...}
+    catalog.get_catalog().nodes()              # [Node(node_id, node_ip, node_ssh_port, node_region), ...]
+    catalog.get_catalog().deployment(email)    # Deployment(plan_id, sub_id, region_id) or None
+
+Plans and nodes are small, so once a table has been read whole (by
+``preload()``, ``plans()`` or ``nodes()``) it's loaded whole in one query
+and kept for CATALOG_TTL seconds. A lookup for an id that isn't there
+reloads early (at most once every CATALOG_MISS_RELOAD seconds), so a new
+plan or node is usable right away. Until then, as in the one-shot
+``main.py``, ``plan()`` and ``node()`` fetch and cache only the row asked
+for; ids that aren't found aren't cached. Deploy lookups are cached per email for
+CATALOG_DEPLOY_TTL seconds; emails without a deployable subscription are
+never cached, so a customer who just paid isn't turned away.
+
+``preload()`` loads plans and nodes up front at service start and
+``invalidate()`` drops one catalog or all of them after an edit. Hits,
+misses and loads are counted per catalog in ``stats()``.
+
+Callers that already hold a pooled connection pass it as ``connection=``
+so a reload doesn't check out a second one; with DB_POOL_SIZE concurrent
+holders that would wait on the pool forever.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+TTL = float(os.getenv('CATALOG_TTL', '300'))
+DEPLOY_TTL = float(os.getenv('CATALOG_DEPLOY_TTL', '30'))
+MISS_RELOAD = float(os.getenv('CATALOG_MISS_RELOAD', '5'))
+
+Node = namedtuple('Node', 'node_id node_ip node_ssh_port node_region')
+Deployment = namedtuple('Deployment', 'plan_id sub_id region_id')
+
+
+def load_plans(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT plan_id, vcpu, ram FROM VW_Plans")
+    return {row.plan_id: {'vcpu': row.vcpu, 'ram': row.ram} for row in cursor.fetchall()}
+
+
+def load_plan(conn, plan_id):
+    cursor = conn.cursor()
+    cursor.execute("SELECT vcpu, ram FROM VW_Plans WHERE plan_id = ?", (plan_id,))
+    row = cursor.fetchone()
+    return {'vcpu': row.vcpu, 'ram': row.ram} if row else None
+
+
+def load_nodes(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT node_id, node_ip, node_ssh_port, node_region FROM TB_Nodes")
+    return {row.node_id: Node(row.node_id, row.node_ip, row.node_ssh_port, row.node_region)
+            for row in cursor.fetchall()}
+
+
+def load_node(conn, node_id):
+    cursor = conn.cursor()
+    cursor.execute("SELECT node_id, node_ip, node_ssh_port, node_region FROM TB_Nodes WHERE node_id = ?",
+                   (node_id,))
+    row = cursor.fetchone()
+    return Node(row.node_id, row.node_ip, row.node_ssh_port, row.node_region) if row else None
+
+
+class _Table:
+    """One catalog table: cached row by row until it's first read whole, then reloaded whole
+    when it expires or misses a key."""
+
+    def __init__(self, loader, row_loader, ttl):
+        self.loader = loader
+        self.row_loader = row_loader
+        self.ttl = ttl
+        self.entries = {}
+        self.loaded_at = None
+        self.whole = False
+        self.row_loaded_at = {}
+        self.stats = {'hits': 0, 'misses': 0, 'loads': 0, 'invalidations': 0}
+
+    def expired(self, now):
+        return self.loaded_at is None or now - self.loaded_at > self.ttl
+
+    def set(self, entries, now):
+        self.entries = entries
+        self.loaded_at = now
+        self.whole = True
+        self.row_loaded_at = {}
+        self.stats['loads'] += 1
+
+    def row_expired(self, key, now):
+        loaded_at = self.row_loaded_at.get(key)
+        return loaded_at is None or now - loaded_at > self.ttl
+
+
+class Catalog:
+    def __init__(self, pool, ttl=TTL, deploy_ttl=DEPLOY_TTL, miss_reload=MISS_RELOAD):
+        self.pool = pool
+        self.deploy_ttl = deploy_ttl
+        self.miss_reload = miss_reload
+        self._tables = {'plans': _Table(load_plans, load_plan, ttl), 'nodes': _Table(load_nodes, load_node, ttl)}
+        self._deployments = {}  # email -> (Deployment, loaded at)
+        self._deploy_stats = {'hits': 0, 'misses': 0, 'loads': 0, 'invalidations': 0}
+        self._lock = threading.Lock()
+
+    def _checkout(self, connection):
+        return nullcontext(connection) if connection is not None else self.pool.connection()
+
+    def _reload(self, names, connection=None):
+        with self._checkout(connection) as conn:
+            loaded = {name: self._tables[name].loader(conn) for name in names}
+        now = time.monotonic()
+        with self._lock:
+            for name, entries in loaded.items():
+                self._tables[name].set(entries, now)
+
+    def preload(self):
+        """Load every whole-table catalog in one checkout."""
+        self._reload(list(self._tables))
+        logger.info("Catalog preloaded: %d plans, %d nodes",
+                    len(self._tables['plans'].entries), len(self._tables['nodes'].entries))
+
+    def _get_row(self, table, key, connection=None):
+        now = time.monotonic()
+        with self._lock:
+            stale = table.row_expired(key, now)
+            table.stats['misses' if stale else 'hits'] += 1
+            if not stale:
+                return table.entries.get(key)
+        with self._checkout(connection) as conn:
+            entry = table.row_loader(conn, key)
+        with self._lock:
+            table.stats['loads'] += 1
+            if table.whole:
+                # A whole load finished meanwhile and is newer than this row
+                return table.entries.get(key, entry)
+            if entry is None:
+                table.entries.pop(key, None)
+                table.row_loaded_at.pop(key, None)
+            else:
+                table.entries[key] = entry
+                table.row_loaded_at[key] = time.monotonic()
+            return entry
+
+    def _get(self, name, key=None, connection=None):
+        table = self._tables[name]
+        if key is not None and not table.whole:
+            return self._get_row(table, key, connection)
+        now = time.monotonic()
+        with self._lock:
+            stale = table.expired(now) or (
+                key is not None and key not in table.entries and now - table.loaded_at > self.miss_reload)
+            table.stats['misses' if stale else 'hits'] += 1
+        if stale:
+            self._reload([name], connection)
+        with self._lock:
+            return table.entries if key is None else table.entries.get(key)
+
+    def plan(self, plan_id, connection=None):
+        """``{'vcpu', 'ram'}`` of a plan, or None if there's no such plan."""
+        return self._get('plans', int(plan_id), connection)
+
+    def plans(self):
+        return dict(self._get('plans'))
+
+    def node(self, node_id, connection=None):
+        return self._get('nodes', int(node_id), connection)
+
+    def nodes(self):
+        return list(self._get('nodes').values())
+
+    def regions(self):
+        """Region id -> ids of the nodes in it."""
+        regions = {}
+        for node in self.nodes():
+            regions.setdefault(node.node_region, []).append(node.node_id)
+        return regions
+
+    def deployment(self, email):
+        """Plan, subscription and region to deploy for a customer, or None."""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._deployments.get(email)
+            if cached is not None and now - cached[1] <= self.deploy_ttl:
+                self._deploy_stats['hits'] += 1
+                return cached[0]
+            self._deploy_stats['misses'] += 1
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT plan_id, sub_id, region_id FROM VW_Deploy WHERE email = ?", (email,))
+            row = cursor.fetchone()
+        with self._lock:
+            self._deploy_stats['loads'] += 1
+            if row is None:
+                self._deployments.pop(email, None)
+                return None
+            deployment = Deployment(row.plan_id, row.sub_id, row.region_id)
+            self._deployments[email] = (deployment, time.monotonic())
+            return deployment
+
+    def invalidate(self, name=None, key=None):
+        """Drop a catalog ('plans', 'nodes' or 'deployments'), one email of 'deployments', or everything."""
+        if name not in (None, 'plans', 'nodes', 'deployments'):
+            raise ValueError(f"Unknown catalog: {name}")
+        with self._lock:
+            for table_name, table in self._tables.items():
+                if name in (None, table_name):
+                    table.loaded_at = None
+                    table.row_loaded_at = {}
+                    table.stats['invalidations'] += 1
+            if name in (None, 'deployments'):
+                if key is None:
+                    self._deployments.clear()
+                else:
+                    self._deployments.pop(key, None)
+                self._deploy_stats['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = {name: {**table.stats, 'entries': len(table.entries)} for name, table in self._tables.items()}
+            stats['deployments'] = {**self._deploy_stats, 'entries': len(self._deployments)}
+        return stats
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """Return the process-wide catalog, backed by the shared DB pool."""
+    global _catalog
+    if _catalog is None:
+        import db
+
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = Catalog(db.get_pool())
+    return _catalog
@@ -0,0 +1,136 @@
+"""Adaptive, non-overlapping collection loop for metrics.py.
+
+Two stages run on their own threads so a slow database never delays
+sampling:
+
+* sampling takes a snapshot of the collector every interval and hands the
+  samples to the flush stage through a bounded queue;
+* flushing buffers them into the DB ingest and writes when it's due.
+
+Only one sample runs at a time, since the loop waits for a sample to
+finish before scheduling the next. The interval adapts to how long
+sampling takes: if a sample uses more than METRICS_TARGET_LOAD of the
+interval, the interval stretches at once; when samples are cheap it
+shrinks back gradually. It always stays between METRICS_MIN_INTERVAL and
+METRICS_MAX_INTERVAL.
+
+Ticks the loop couldn't run on time are counted as dropped, and the
+start-time lag is reported. If the flush stage falls behind and its queue
+fills up, the oldest waiting batch is dropped and counted.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+INTERVAL = float(os.getenv('METRICS_INTERVAL', '5'))
+MIN_INTERVAL = float(os.getenv('METRICS_MIN_INTERVAL', '5'))
+MAX_INTERVAL = float(os.getenv('METRICS_MAX_INTERVAL', '30'))
+TARGET_LOAD = float(os.getenv('METRICS_TARGET_LOAD', '0.5'))
+FLUSH_BACKLOG = int(os.getenv('METRICS_FLUSH_BACKLOG', '12'))
+# How much of the gap to the desired interval is closed per tick when shrinking
+SHRINK_RATE = 0.2
+
+
+class CollectionLoop:
+    def __init__(self, sample, flush, interval=INTERVAL, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL,
+                 target_load=TARGET_LOAD, backlog=FLUSH_BACKLOG):
+        # sample() returns a batch; flush(batch) stores it
+        self.sample = sample
+        self.flush = flush
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min(max(interval, min_interval), max_interval)
+        self.target_load = target_load
+        self.sample_duration = tracing.Histogram()
+        self.flush_duration = tracing.Histogram()
+        self.stats = {
+            'ticks': 0, 'dropped_ticks': 0, 'sample_errors': 0,
+            'flushes': 0, 'flush_errors': 0, 'dropped_batches': 0,
+            'lag_seconds': 0.0, 'lag_seconds_max': 0.0,
+        }
+        self._batches = queue.Queue(maxsize=backlog)
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _adapt(self, took):
+        desired = min(max(took / self.target_load, self.min_interval), self.max_interval)
+        if desired > self.interval:
+            self.interval = desired
+        else:
+            self.interval += (desired - self.interval) * SHRINK_RATE
+
+    def _enqueue(self, batch):
+        while True:
+            try:
+                self._batches.put_nowait(batch)
+                return
+            except queue.Full:
+                try:
+                    self._batches.get_nowait()
+                    self.stats['dropped_batches'] += 1
+                except queue.Empty:
+                    pass
+
+    def _sample_loop(self):
+        scheduled = time.monotonic()
+        while not self._stop.is_set():
+            started = time.monotonic()
+            lag = max(0.0, started - scheduled)
+            self.stats['lag_seconds'] = lag
+            self.stats['lag_seconds_max'] = max(self.stats['lag_seconds_max'], lag)
+            self.stats['dropped_ticks'] += int(lag // self.interval)
+            self.stats['ticks'] += 1
+            try:
+                self._enqueue(self.sample())
+            except Exception as e:
+                self.stats['sample_errors'] += 1
+                logger.error(f"Error sampling metrics: {e}", exc_info=True)
+            took = time.monotonic() - started
+            self.sample_duration.observe(took)
+            self._adapt(took)
+
+            scheduled = started + self.interval
+            self._stop.wait(max(0.0, scheduled - time.monotonic()))
+
+    def _flush_loop(self):
+        while not self._stop.is_set() or not self._batches.empty():
+            try:
+                batch = self._batches.get(timeout=1.0)
+            except queue.Empty:
+                batch = None
+            # Called without a batch too, so time-based flushes still happen
+            started = time.monotonic()
+            try:
+                self.flush(batch)
+            except Exception as e:
+                self.stats['flush_errors'] += 1
+                logger.error(f"Error flushing metrics: {e}", exc_info=True)
+            if batch is not None:
+                self.stats['flushes'] += 1
+                self.flush_duration.observe(time.monotonic() - started)
+
+    def start(self):
+        for target, name in ((self._sample_loop, 'metrics-sample'), (self._flush_loop, 'metrics-flush')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info("Collection loop started at a %.1fs interval", self.interval)
+
+    def stop(self, timeout=10.0):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def status(self):
+        return {
+            **self.stats,
+            'interval_seconds': round(self.interval, 3),
+            'flush_backlog': self._batches.qsize(),
+        }
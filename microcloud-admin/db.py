@@ -0,0 +1,243 @@
+"""Shared, bounded pyodbc connection pool for the Python services.
+
+Opening a SQL Server connection costs a TLS and login handshake, so api.py,
+deployer.py, metrics.py and main.py check connections out of one pool
+instead of calling ``pyodbc.connect`` per request or tick:
+
+    with db.get_pool().connection() as conn:
+        cursor = conn.cursor()
+        ...
+        conn.commit()
+
+Connections idle for longer than DB_POOL_HEALTH_CHECK_IDLE seconds are
+pinged with ``SELECT 1`` on checkout, and every connection is recycled after
+DB_POOL_MAX_LIFETIME seconds. Work left uncommitted when a connection goes
+back to the pool is rolled back; a connection whose last use ended in a
+commit goes back without the extra round trip.
+
+With DB_POOL_REUSE_CURSORS enabled, ``conn.cursor()`` hands back the same
+cursor for the life of the connection, so pyodbc keeps the last statement
+prepared and re-executing identical SQL skips the prepare step.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+try:
+    import pyodbc
+except ImportError:
+    # Only opening a connection needs the driver; the offline benchmarks and
+    # tests put their own pool in place and run without unixODBC
+    pyodbc = None
+
+if pyodbc is not None:
+    Error = pyodbc.Error
+else:
+    class Error(Exception):
+        """Stands in for pyodbc.Error when the driver isn't installed; never raised."""
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+def connection_string():
+    return (
+        f"DRIVER={os.getenv('DB_DRIVER', '{ODBC Driver 17 for SQL Server}')};"
+        f"SERVER={os.getenv('DB_SERVER')};"
+        f"DATABASE={os.getenv('DB_NAME') or os.getenv('DB_DATABASE')};"
+        f"UID={os.getenv('DB_USER')};"
+        f"PWD={os.getenv('DB_PASSWORD')}"
+    )
+
+
+class PooledConnection:
+    """Wraps a pyodbc connection with the bookkeeping the pool needs."""
+
+    def __init__(self, raw, reuse_cursors):
+        self.raw = raw
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self._reuse_cursors = reuse_cursors
+        self._cursor = None
+        # A cursor was handed out since the last commit or rollback, so
+        # there may be an open transaction
+        self.dirty = False
+
+    def cursor(self):
+        self.dirty = True
+        if not self._reuse_cursors:
+            return self.raw.cursor()
+        if self._cursor is None:
+            self._cursor = self.raw.cursor()
+        return self._cursor
+
+    def commit(self):
+        self.raw.commit()
+        self.dirty = False
+
+    def rollback(self):
+        self.raw.rollback()
+        self.dirty = False
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+    def _close(self):
+        try:
+            self.raw.close()
+        except Error:
+            pass
+
+
+class ConnectionPool:
+    def __init__(self, conn_str, max_size=10, max_lifetime=1800.0, checkout_timeout=30.0,
+                 health_check_idle=30.0, reuse_cursors=False):
+        self.conn_str = conn_str
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.checkout_timeout = checkout_timeout
+        self.health_check_idle = health_check_idle
+        self.reuse_cursors = reuse_cursors
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._stats = {
+            'checkouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'health_check_failures': 0,
+            'timeouts': 0,
+            'in_use': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+        }
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _connect(self):
+        if pyodbc is None:
+            raise RuntimeError("pyodbc is not available; install it and unixODBC to connect to SQL Server")
+        conn = PooledConnection(pyodbc.connect(self.conn_str), self.reuse_cursors)
+        self._count('created')
+        return conn
+
+    def _usable(self, conn):
+        now = time.monotonic()
+        if now - conn.created_at > self.max_lifetime:
+            self._count('recycled')
+            return False
+        if now - conn.last_used > self.health_check_idle:
+            try:
+                conn.raw.cursor().execute("SELECT 1").fetchone()
+            except Error:
+                self._count('health_check_failures')
+                return False
+        return True
+
+    def _checkout(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            self._count('timeouts')
+            raise PoolTimeoutError(f"No database connection available within {self.checkout_timeout}s")
+        waited = time.monotonic() - start
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            self._stats['wait_seconds_total'] += waited
+            self._stats['wait_seconds_max'] = max(self._stats['wait_seconds_max'], waited)
+
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if self._usable(conn):
+                    return conn
+                conn._close()
+        except Exception:
+            self._release_slot()
+            raise
+
+    def _release_slot(self):
+        self._count('in_use', -1)
+        self._slots.release()
+
+    def _checkin(self, conn, broken):
+        try:
+            if not broken and conn.dirty:
+                try:
+                    conn.rollback()
+                except Error:
+                    broken = True
+            if broken:
+                conn._close()
+            else:
+                conn.last_used = time.monotonic()
+                self._idle.put(conn)
+        finally:
+            self._release_slot()
+
+    @contextmanager
+    def connection(self):
+        """Check a connection out for the duration of the ``with`` block."""
+        conn = self._checkout()
+        broken = False
+        try:
+            yield conn
+        except Error:
+            # The connection may be dead; don't hand it to the next caller
+            broken = True
+            raise
+        finally:
+            self._checkin(conn, broken)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['idle'] = self._idle.qsize()
+        stats['max_size'] = self.max_size
+        stats['wait_seconds_avg'] = stats['wait_seconds_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait()._close()
+            except queue.Empty:
+                return
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide pool, configured from the environment."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    connection_string(),
+                    max_size=int(os.getenv('DB_POOL_SIZE', '10')),
+                    max_lifetime=float(os.getenv('DB_POOL_MAX_LIFETIME', '1800')),
+                    checkout_timeout=float(os.getenv('DB_POOL_TIMEOUT', '30')),
+                    health_check_idle=float(os.getenv('DB_POOL_HEALTH_CHECK_IDLE', '30')),
+                    reuse_cursors=os.getenv('DB_POOL_REUSE_CURSORS', 'false').lower() in ('1', 'true', 'yes'),
+                )
+    return _pool
@@ -1,80 +1,65 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import pyodbc
-import random
 import datetime
-import paramiko
+import json
 import re
 import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import catalog
+import db
+import jobs
+import placement
+import prometheus
+import ssh_pool
+import tracing
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
+prometheus.instrument(app)
 
-# Database connection details - update these accordingly
-DB_SERVER = '143.110.243.146'
-DB_DATABASE = 'microcloud'
-DB_USERNAME = 'sa'
-DB_PASSWORD = 
-ODBC_DRIVER = '{ODBC Driver 17 for SQL Server}'  # Adjust as needed
-
-def get_db_connection():
-    conn_str = f"DRIVER={ODBC_DRIVER};SERVER={DB_SERVER};DATABASE={DB_DATABASE};UID={DB_USERNAME};PWD={DB_PASSWORD}"
-    conn = pyodbc.connect(conn_str)
-    return conn
-
-def run_remote_command(node_ip, plan_id, subscription_id, node_id):
-    # Load SSH config
-    ssh_config = paramiko.SSHConfig()
-    config_path = os.path.expanduser('~/.ssh/config')
-    if os.path.exists(config_path):
-        with open(config_path, 'r') as f:
-            ssh_config.parse(f)
-    else:
-        raise Exception("No SSH config found at ~/.ssh/config")
-
-    # Map node_ip to known SSH alias from ~/.ssh/config
-    ip_to_alias = {
-        '129.151.137.147': 'oracle1',
-        '129.151.158.64': 'oracle2',
-        '15.206.149.72': 'aws1',
-        '4.213.178.67': 'azure1-1',
-        '4.251.115.138': 'azure1-2',
-        '4.240.98.248': 'azure1-3',
-        '4.213.36.141': 'azure2-1',
-        '40.120.108.242': 'azure2-2',
-        '172.164.241.50': 'azure2-3'
-    }
-
-    if node_ip in ip_to_alias:
-        host_alias = ip_to_alias[node_ip]
-    else:
-        raise Exception(f"No SSH alias found for IP: {node_ip}")
+# Subscription statuses picked up by bulk fulfilment
+DEPLOYABLE_STATUSES = [s.strip() for s in os.getenv('DEPLOYABLE_STATUSES', 'Payment Pending,Paid').split(',')]
+BULK_WORKERS = int(os.getenv('BULK_DEPLOY_WORKERS', '16'))
+BULK_COMMIT_SIZE = int(os.getenv('BULK_COMMIT_SIZE', '25'))
+
+# Status held by a subscription while one deploy provisions it
+PROVISIONING = 'Provisioning'
+
+# Loopback port of the resident agent on each node (agent.py)
+AGENT_PORT = int(os.getenv('AGENT_PORT', '7070'))
 
-    host_conf = ssh_config.lookup(host_alias)
+# SSH connections, node placement state and the deploy queue, created on first use
+_ssh_pool = None
+_scheduler = None
+_deploy_queue = None
 
-    hostname = host_conf.get('hostname', host_alias)
-    username = host_conf.get('user', 'ubuntu')  # Default if not specified in config
-    identityfile = host_conf.get('identityfile', None)
-    if identityfile and isinstance(identityfile, list):
-        identityfile = identityfile[0]
+def load_nodes():
+    return [(node.node_ip, node.node_ssh_port) for node in catalog.get_catalog().nodes()]
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+def get_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = placement.Scheduler(db.get_pool())
+    return _scheduler
 
-    ssh.connect(
-        hostname=hostname,
-        username=username,
-        key_filename=identityfile,
-    )
+def get_ssh_pool():
+    global _ssh_pool
+    if _ssh_pool is None:
+        _ssh_pool = ssh_pool.SSHPool(load_nodes)
+    return _ssh_pool
 
+def run_remote_command(node_ip, plan_id, subscription_id, node_id, correlation_id=None):
     command = f"sudo python3 main.py {plan_id} {subscription_id} {node_id}"
-    stdin, stdout, stderr = ssh.exec_command(command)
-    output = stdout.read().decode('utf-8', errors='replace')
-    error = stderr.read().decode('utf-8', errors='replace')
-    ssh.close()
+    if correlation_id:
+        command += f" --correlation-id {correlation_id}"
+    exit_status, output, error = get_ssh_pool().run(node_ip, command)
 
-    if error.strip():
-        raise Exception(f"Remote command error: {error.strip()}")
+    # Judge by exit status; warnings on stderr alone shouldn't fail a deploy
+    if exit_status != 0:
+        raise Exception(f"Remote command error: {error.strip() or f'exit status {exit_status}'}")
 
     return output
 
@@ -100,6 +85,292 @@ def parse_output(output):
     psswd = pwd_line.split("Password:")[1].strip()
     return ip_addr, tcp_port, psswd
 
+def parse_trace(output):
+    # main.py prints its spawn trace as JSON on a "Trace:" line
+    for line in output.split('\n'):
+        line = line.strip()
+        if line.startswith("Trace:"):
+            try:
+                return json.loads(line[len("Trace:"):])
+            except ValueError:
+                return None
+    return None
+
+def add_node_spans(node_trace):
+    # Fold the node's spawn phases into the current deploy trace
+    trace = tracing.current()
+    if trace is None or not node_trace:
+        return
+    for span in node_trace.get('spans', []):
+        trace.add(f"node.{span['phase']}", span['seconds'])
+
+def provision_on_node(node_ip, plan_id, subscription_id, node_id, correlation_id=None):
+    """Spawn an instance on a node; returns (ip_addr, tcp_port, psswd).
+
+    Goes through the node agent when one is running and falls back to
+    running main.py over SSH otherwise. The node's spawn phases are added
+    to the current trace.
+    """
+    try:
+        status, result = get_ssh_pool().request(node_ip, 'POST', '/spawn', {
+            'plan_id': plan_id, 'subscription_id': subscription_id, 'node_id': node_id,
+            'correlation_id': correlation_id,
+        }, port=AGENT_PORT)
+    except ssh_pool.ServiceUnavailableError:
+        output = run_remote_command(node_ip, plan_id, subscription_id, node_id, correlation_id)
+        add_node_spans(parse_trace(output))
+        return parse_output(output)
+
+    if status != 200:
+        raise Exception(f"Node agent error: {(result or {}).get('error', f'HTTP {status}')}")
+    add_node_spans(result.get('trace'))
+    return result['external_ip'], int(result['ssh_port']), result['password']
+
+def lookup_deployment(email):
+    # Fetch plan_id, sub_id (subscription_id), region_id from VW_Deploy based on email (cached)
+    return catalog.get_catalog().deployment(email)
+
+def claim_subscription(subscription_id):
+    """Mark a subscription as being provisioned; returns its previous status.
+
+    Returns None when it's already active or claimed by another deploy
+    (a /deploy job, a bulk run in this or another process). The claim is a
+    compare-and-set on the status, so exactly one caller wins. A claim
+    that provisioned but couldn't be recorded stays 'Provisioning' on
+    purpose, so the subscription isn't deployed a second time.
+    """
+    with db.get_pool().connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT status FROM TB_Subscription WHERE sub_id = ?", (subscription_id,))
+        row = cursor.fetchone()
+        if row is None or row.status in ('Active', PROVISIONING):
+            return None
+        cursor.execute("UPDATE TB_Subscription SET status = ? WHERE sub_id = ? AND status = ?",
+                       (PROVISIONING, subscription_id, row.status))
+        claimed = cursor.rowcount == 1
+        conn.commit()
+    return row.status if claimed else None
+
+def release_subscription(subscription_id, status):
+    # Give a claim back after a failed provision so the subscription can be retried
+    with db.get_pool().connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE TB_Subscription SET status = ? WHERE sub_id = ? AND status = ?",
+                       (status, subscription_id, PROVISIONING))
+        conn.commit()
+
+def record_deployments(deployments):
+    """Record finished deployments in one transaction.
+
+    Each deployment is a dict with subscription_id, ip_addr, tcp_port and psswd.
+    """
+    sub_ids = [d['subscription_id'] for d in deployments]
+    placeholders = ', '.join('?' * len(sub_ids))
+    with db.get_pool().connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.fast_executemany = True
+            cursor.executemany("INSERT INTO TB_SSH_Details (ip_addr, tcp_port, psswd) VALUES (?, ?, ?)",
+                               [(d['ip_addr'], d['tcp_port'], d['psswd']) for d in deployments])
+            cursor.execute(f"UPDATE TB_Subscription SET status = 'Active' WHERE sub_id IN ({placeholders})", sub_ids)
+            cursor.execute(f"SELECT sub_id, customer_id FROM TB_Subscription WHERE sub_id IN ({placeholders})", sub_ids)
+            customer_ids = {row.sub_id: row.customer_id for row in cursor.fetchall()}
+            missing = [sub_id for sub_id in sub_ids if sub_id not in customer_ids]
+            if missing:
+                raise Exception(f"Subscription(s) {missing} not found, cannot retrieve customer_id.")
+
+            timestamp = datetime.datetime.now()
+            cursor.executemany("INSERT INTO TB_User_Logs (event_type, customer_id, timestamp) VALUES (?, ?, ?)",
+                               [("Got Instance", customer_ids[sub_id], timestamp) for sub_id in sub_ids])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+def record_deployment(subscription_id, ip_addr, tcp_port, psswd):
+    record_deployments([{
+        'subscription_id': subscription_id, 'ip_addr': ip_addr, 'tcp_port': tcp_port, 'psswd': psswd,
+    }])
+
+def execute_deploy(job, queue):
+    plan_id = job.payload['plan_id']
+    subscription_id = job.payload['subscription_id']
+    region_id = job.payload['region_id']
+
+    with tracing.Trace('deploy', job.payload.get('correlation_id')) as trace:
+        trace.add('queued', time.monotonic() - job.created_at)
+
+        # Neither a retry after an earlier success nor a concurrent deploy of the
+        # same subscription may create a second instance
+        with trace.span('claim'):
+            previous_status = claim_subscription(subscription_id)
+        if previous_status is None:
+            return {"message": "Subscription is already active or being deployed", "trace": trace.as_dict()}
+
+        try:
+            # Reserve capacity on the best node in the region
+            with trace.span('place'):
+                reservation = get_scheduler().place(region_id, plan_id)
+        except Exception:
+            release_subscription(subscription_id, previous_status)
+            raise
+        job.node_id = reservation.node_id
+        job.mark('placed')
+
+        # Spawn the instance on the node, limited per node
+        try:
+            slot_wait = time.monotonic()
+            with queue.node_slot(reservation.node_id):
+                trace.add('node_slot', time.monotonic() - slot_wait)
+                job.mark('provisioning')
+                with trace.span('provision'):
+                    ip_addr, tcp_port, psswd = provision_on_node(
+                        reservation.node_ip, plan_id, subscription_id, reservation.node_id, trace.correlation_id)
+        except Exception:
+            reservation.release()
+            release_subscription(subscription_id, previous_status)
+            raise
+        reservation.confirm()
+        job.mark('provisioned')
+
+        # Record the deployment
+        with trace.span('record'):
+            record_deployment(subscription_id, ip_addr, tcp_port, psswd)
+        job.mark('recorded')
+    return {"message": "Deployment successful", "trace": trace.as_dict()}
+
+def load_deployable(statuses):
+    placeholders = ', '.join('?' * len(statuses))
+    with db.get_pool().connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT d.plan_id, d.sub_id, d.region_id, d.email
+            FROM VW_Deploy d
+            JOIN TB_Subscription s ON s.sub_id = d.sub_id
+            WHERE s.status IN ({placeholders})
+        """, list(statuses))
+        return cursor.fetchall()
+
+def fulfil_pending(statuses=DEPLOYABLE_STATUSES, job=None):
+    """Deploy every deployable subscription; returns an aggregated report.
+
+    Placement is planned for the whole batch up front (largest plans first),
+    the deploys then run in parallel within the per-node limits, and the
+    results are recorded BULK_COMMIT_SIZE at a time. Each subscription is
+    claimed right before it's provisioned, so one that another deploy got
+    to first is skipped.
+    """
+    started = time.monotonic()
+    queue = get_deploy_queue()
+    scheduler = get_scheduler()
+    report = {'total': 0, 'succeeded': 0, 'failed': 0, 'skipped': 0, 'per_node': {}, 'failures': []}
+
+    def fail(row, error):
+        report['failed'] += 1
+        report['failures'].append({'subscription_id': row.sub_id, 'email': row.email, 'error': str(error)})
+
+    rows = load_deployable(statuses)
+    report['total'] = len(rows)
+    rows.sort(key=lambda r: scheduler.plan_size(r.plan_id), reverse=True)
+
+    by_node = {}
+    for row in rows:
+        if queue.is_active(row.sub_id):
+            report['skipped'] += 1  # a single deploy for it is already in flight
+            continue
+        try:
+            reservation = scheduler.place(row.region_id, row.plan_id)
+        except placement.NoCapacityError as e:
+            fail(row, e)
+            continue
+        by_node.setdefault(reservation.node_id, []).append((row, reservation))
+    if job:
+        job.mark('placed')
+
+    # Interleave nodes so workers don't all queue up on one node's slots
+    placed = []
+    while by_node:
+        for node_id in list(by_node):
+            placed.append(by_node[node_id].pop(0))
+            if not by_node[node_id]:
+                del by_node[node_id]
+
+    def provision(row, reservation):
+        previous_status = claim_subscription(row.sub_id)
+        if previous_status is None:
+            reservation.release()
+            return None
+        try:
+            with tracing.Trace('bulk_deploy') as trace:
+                slot_wait = time.monotonic()
+                with queue.node_slot(reservation.node_id):
+                    trace.add('node_slot', time.monotonic() - slot_wait)
+                    with trace.span('provision'):
+                        ip_addr, tcp_port, psswd = provision_on_node(
+                            reservation.node_ip, row.plan_id, row.sub_id, reservation.node_id, trace.correlation_id)
+        except Exception:
+            reservation.release()
+            release_subscription(row.sub_id, previous_status)
+            raise
+        reservation.confirm()
+        return {'subscription_id': row.sub_id, 'ip_addr': ip_addr, 'tcp_port': tcp_port, 'psswd': psswd}
+
+    def flush(batch):
+        try:
+            record_deployments([deployment for _, deployment in batch])
+            report['succeeded'] += len(batch)
+            for reservation, _ in batch:
+                node = str(reservation.node_id)
+                report['per_node'][node] = report['per_node'].get(node, 0) + 1
+        except Exception as e:
+            for reservation, deployment in batch:
+                report['failed'] += 1
+                report['failures'].append({
+                    'subscription_id': deployment['subscription_id'],
+                    'error': f"Provisioned on node {reservation.node_id} but not recorded: {e}",
+                })
+
+    batch = []
+    with ThreadPoolExecutor(max_workers=BULK_WORKERS) as executor:
+        futures = {executor.submit(provision, row, reservation): (row, reservation) for row, reservation in placed}
+        for future in as_completed(futures):
+            row, reservation = futures[future]
+            try:
+                deployment = future.result()
+            except Exception as e:
+                fail(row, e)
+                continue
+            if deployment is None:
+                report['skipped'] += 1  # claimed by another deploy in the meantime
+                continue
+            batch.append((reservation, deployment))
+            if len(batch) >= BULK_COMMIT_SIZE:
+                flush(batch)
+                batch = []
+    if batch:
+        flush(batch)
+
+    report['duration_seconds'] = round(time.monotonic() - started, 3)
+    return report
+
+def execute_fulfilment(job, queue):
+    return fulfil_pending(job.payload['statuses'], job=job)
+
+def get_deploy_queue():
+    global _deploy_queue
+    if _deploy_queue is None:
+        _deploy_queue = jobs.JobQueue(
+            execute_deploy,
+            max_workers=int(os.getenv('DEPLOY_WORKERS', '8')),
+            per_node_limit=int(os.getenv('DEPLOY_PER_NODE_LIMIT', '2')),
+        )
+    return _deploy_queue
+
+def job_response(job):
+    body = job.as_dict()
+    body['status_url'] = f"/deploy/{job.id}"
+    return jsonify(body), 200 if job.status == jobs.SUCCEEDED else 202
+
 @app.route('/deploy', methods=['POST'])
 def deploy():
     data = request.get_json()
@@ -110,62 +381,87 @@ def deploy():
     if not email:
         return jsonify({"error": "Missing required parameter: email"}), 400
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
     try:
-        # Fetch plan_id, sub_id (subscription_id), region_id from VW_Deploy based on email
-        cursor.execute("SELECT plan_id, sub_id, region_id FROM VW_Deploy WHERE email = ?", (email,))
-        row = cursor.fetchone()
+        row = lookup_deployment(email)
         if not row:
             return jsonify({"error": "No records found for the given email"}), 400
 
-        plan_id = row.plan_id
-        subscription_id = row.sub_id
-        region_id = row.region_id
-
-        # Query nodes for the given region
-        cursor.execute("SELECT node_id, node_ip, node_ssh_port, node_region FROM TB_Nodes WHERE node_region = ?", (region_id,))
-        nodes = cursor.fetchall()
-
-        if not nodes:
-            return jsonify({"error": "No nodes found for the given region"}), 400
-
-        # Randomly select a node
-        selected_node = random.choice(nodes)
-        node_id = selected_node.node_id
-        node_ip = selected_node.node_ip
-
-        # Run the remote command
-        output = run_remote_command(node_ip, plan_id, subscription_id, node_id)
-
-        # Parse the output
-        ip_addr, tcp_port, psswd = parse_output(output)
-
-        # Perform database operations
-        cursor.execute("INSERT INTO TB_SSH_Details (ip_addr, tcp_port, psswd) VALUES (?, ?, ?)",
-                       (ip_addr, tcp_port, psswd))
-        cursor.execute("UPDATE TB_Subscription SET status = 'Active' WHERE sub_id = ?", (subscription_id,))
-        cursor.execute("SELECT customer_id FROM TB_Subscription WHERE sub_id = ?", (subscription_id,))
-        row = cursor.fetchone()
-        if not row:
-            raise Exception("Subscription not found, cannot retrieve customer_id.")
-        customer_id = row[0]
-
-        timestamp = datetime.datetime.now()
-        cursor.execute("INSERT INTO TB_User_Logs (event_type, customer_id, timestamp) VALUES (?, ?, ?)",
-                       ("Got Instance", customer_id, timestamp))
-
-        conn.commit()
-        return jsonify({"message": "Deployment successful"}), 200
-
+        # Carried to the node so both sides of a deploy can be matched up
+        correlation_id = request.headers.get(tracing.CORRELATION_HEADER) or uuid.uuid4().hex
+        job, _ = get_deploy_queue().submit(row.sub_id, {
+            'email': email,
+            'plan_id': row.plan_id,
+            'subscription_id': row.sub_id,
+            'region_id': row.region_id,
+            'correlation_id': correlation_id,
+        })
+        response, status = job_response(job)
+        response.headers[tracing.CORRELATION_HEADER] = job.payload['correlation_id']
+        return response, status
+
+    except jobs.QueueFullError as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
-        conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        cursor.close()
-        conn.close()
+
+@app.route('/deploy/bulk', methods=['POST'])
+def deploy_bulk():
+    data = request.get_json(silent=True) or {}
+    statuses = data.get('statuses') or DEPLOYABLE_STATUSES
+    try:
+        job, _ = get_deploy_queue().submit(
+            'bulk-fulfilment', {'statuses': statuses}, handler=execute_fulfilment, allow_rerun=True)
+        return job_response(job)
+    except jobs.QueueFullError as e:
+        return jsonify({"error": str(e)}), 503
+
+@app.route('/deploy/<job_id>', methods=['GET'])
+def deploy_status(job_id):
+    job = get_deploy_queue().get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.as_dict()), 200
+
+@app.route('/latency', methods=['GET'])
+def latency():
+    # Deploy phase latency histograms
+    return jsonify(tracing.histograms()), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus metrics
+    exposition = prometheus.Exposition()
+    prometheus.add_request_metrics(exposition)
+    prometheus.add_db_pool_metrics(exposition, db.get_pool().stats())
+    prometheus.add_catalog_metrics(exposition, catalog.get_catalog().stats())
+    if _ssh_pool is not None:
+        prometheus.add_ssh_pool_metrics(exposition, _ssh_pool.stats())
+    prometheus.add_trace_metrics(exposition)
+    if _deploy_queue is not None:
+        for status, count in _deploy_queue.stats().items():
+            exposition.gauge('microcloud_deploy_jobs', 'Deploy jobs by status.', count, {'status': status})
+    return exposition.response()
+
+@app.route('/catalog', methods=['GET'])
+def catalog_stats():
+    # Catalog cache hit/miss counters
+    return jsonify(catalog.get_catalog().stats()), 200
+
+@app.route('/catalog/invalidate', methods=['POST'])
+def catalog_invalidate():
+    # Drop cached plans, nodes or deploy lookups after editing them ({"catalog": ..., "key": ...})
+    data = request.get_json(silent=True) or {}
+    try:
+        catalog.get_catalog().invalidate(data.get('catalog'), data.get('key'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"message": "Catalog invalidated"}), 200
 
 if __name__ == '__main__':
-    # Run the Flask app
-    app.run(host='0.0.0.0', port=9999, debug=True)
+    if len(sys.argv) > 1 and sys.argv[1] == 'fulfil':
+        # Deploy all pending subscriptions from the command line
+        print(json.dumps(fulfil_pending(sys.argv[2:] or DEPLOYABLE_STATUSES), indent=2))
+    else:
+        # Run the Flask app
+        catalog.get_catalog().preload()
+        app.run(host='0.0.0.0', port=9999, debug=True)
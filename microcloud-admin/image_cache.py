@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Content-addressed cache for the instance base image.
+
+The base image only contains the sshd setup; nothing instance specific
+(the root password in particular) is baked into a layer. The image tag is
+derived from a hash of the template definition, so a node builds it once
+and every spawn after that reuses it. Concurrent spawns serialise on a
+lock file instead of racing on a shared tag.
+
+Usage on a node:
+    python3 image_cache.py warm        # build (or pull) the image now
+    python3 image_cache.py status      # show the current tag and whether it exists
+    python3 image_cache.py invalidate  # drop stale images (--all drops the current one too)
+"""
+
+import argparse
+import fcntl
+import hashlib
+import logging
+import os
+import shlex
+import shutil
+import tempfile
+import threading
+
+import docker
+
+logger = logging.getLogger(__name__)
+
+BASE_IMAGE_REPO = 'microcloud_base'
+TEMPLATE_LABEL = 'microcloud.template'
+LOCK_PATH = os.getenv('IMAGE_CACHE_LOCK', '/tmp/microcloud_base.lock')
+
+# Optional pre-built image (e.g. from a registry) to pull instead of building
+PREBUILT_IMAGE = os.getenv('BASE_IMAGE')
+
+BASE_DOCKERFILE = """FROM ubuntu:latest
+RUN apt-get update && apt-get install -y openssh-server && \\
+    sed -i 's/#PermitRootLogin prohibit-password/PermitRootLogin yes/' /etc/ssh/sshd_config && \\
+    sed -i 's/PasswordAuthentication no/PasswordAuthentication yes/' /etc/ssh/sshd_config && \\
+    mkdir /var/run/sshd && \\
+    rm -rf /var/lib/apt/lists/*
+EXPOSE 22 80 443 23 8083
+CMD ["/usr/sbin/sshd", "-D"]
+"""
+
+_build_lock = threading.Lock()
+
+
+def template_hash(dockerfile=BASE_DOCKERFILE, prebuilt=PREBUILT_IMAGE):
+    """Return the content hash that keys the cached image."""
+    digest = hashlib.sha256()
+    digest.update((prebuilt or '').encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(dockerfile.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def image_tag(dockerfile=BASE_DOCKERFILE, prebuilt=PREBUILT_IMAGE):
+    return f"{BASE_IMAGE_REPO}:{template_hash(dockerfile, prebuilt)[:16]}"
+
+
+def _image_exists(client, tag):
+    try:
+        client.images.get(tag)
+        return True
+    except docker.errors.ImageNotFound:
+        return False
+
+
+def _build(client, tag, digest, dockerfile):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(temp_dir, 'Dockerfile'), 'w') as f:
+            f.write(dockerfile)
+        client.images.build(path=temp_dir, rm=True, tag=tag, labels={TEMPLATE_LABEL: digest})
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def _pull(client, tag, prebuilt):
+    image = client.images.pull(prebuilt)
+    image.tag(tag)
+
+
+def ensure_base_image(client, dockerfile=BASE_DOCKERFILE, prebuilt=PREBUILT_IMAGE):
+    """Return the tag of the cached base image, building or pulling it if missing.
+
+    Safe to call from several threads and processes at once: only the first
+    caller builds, the rest wait on the lock and then find the image present.
+    """
+    tag = image_tag(dockerfile, prebuilt)
+    if _image_exists(client, tag):
+        return tag
+
+    with _build_lock, open(LOCK_PATH, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if not _image_exists(client, tag):
+                logger.info("Base image %s not cached, %s", tag, 'pulling' if prebuilt else 'building')
+                if prebuilt:
+                    _pull(client, tag, prebuilt)
+                else:
+                    _build(client, tag, template_hash(dockerfile, prebuilt), dockerfile)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return tag
+
+
+def invalidate(client, keep_current=True):
+    """Remove cached base images; returns the list of removed tags.
+
+    Images still used by a container are left alone (Docker refuses to
+    remove them without force).
+    """
+    current = image_tag()
+    removed = []
+    for image in client.images.list(name=BASE_IMAGE_REPO):
+        for tag in image.tags:
+            if keep_current and tag == current:
+                continue
+            try:
+                client.images.remove(tag)
+                removed.append(tag)
+            except docker.errors.APIError as e:
+                logger.warning("Could not remove %s: %s", tag, e)
+    return removed
+
+
+def set_root_password(container, password):
+    """Set the root password inside a running container."""
+    command = f"echo {shlex.quote('root:' + password)} | chpasswd"
+    exit_code, output = container.exec_run(['sh', '-c', command])
+    if exit_code != 0:
+        raise Exception(f"Failed to set root password: {output.decode('utf-8', errors='replace').strip()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the cached instance base image.")
+    parser.add_argument('command', choices=['warm', 'status', 'invalidate'])
+    parser.add_argument('--all', action='store_true', help='With invalidate, also remove the current image')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    client = docker.from_env()
+
+    if args.command == 'warm':
+        print(f"Base image ready: {ensure_base_image(client)}")
+    elif args.command == 'status':
+        tag = image_tag()
+        print(f"Base image: {tag} ({'cached' if _image_exists(client, tag) else 'missing'})")
+    else:
+        removed = invalidate(client, keep_current=not args.all)
+        print(f"Removed {len(removed)} image(s): {', '.join(removed) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""Buffered, batched ingest of container samples into TB_Instance_Metrics.
+
+Samples are only stored for containers that belong to an instance. Instead
+of a ``LIKE`` lookup per sample, the ingest keeps the set of known
+container ids in memory. New instances are picked up incrementally by
+instance_id watermark, a full reload every METRICS_KNOWN_FULL_REFRESH
+seconds drops deleted ones, and an unknown id in a sample triggers an
+early incremental refresh (rate limited).
+
+Rows are buffered and written with a single ``fast_executemany`` batch
+when the buffer reaches METRICS_FLUSH_SIZE rows or METRICS_FLUSH_INTERVAL
+seconds have passed since the last flush.
+
+METRICS_STORAGE picks the format: ``rows`` (one TB_Instance_Metrics row
+per sample, the default), ``blob`` (compressed per-container-hour blobs,
+see tsblob.py) or ``both``. Rollups are computed from raw rows, so they
+need ``rows`` or ``both``.
+"""
+
+import argparse
+import logging
+import os
+import threading
+import time
+
+import tsblob
+from stats_collector import human_size
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SIZE = int(os.getenv('METRICS_FLUSH_SIZE', '500'))
+FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+FULL_REFRESH_INTERVAL = float(os.getenv('METRICS_KNOWN_FULL_REFRESH', '600'))
+UNKNOWN_REFRESH_INTERVAL = float(os.getenv('METRICS_KNOWN_UNKNOWN_REFRESH', '15'))
+STORAGE = os.getenv('METRICS_STORAGE', 'rows')
+
+# Numeric I/O columns next to the net_io/block_io display strings, which
+# stay populated for existing readers
+NUMERIC_COLUMNS = [
+    ('net_rx_bytes', 'BIGINT'), ('net_tx_bytes', 'BIGINT'),
+    ('blk_read_bytes', 'BIGINT'), ('blk_write_bytes', 'BIGINT'),
+    ('net_rx_rate', 'FLOAT'), ('net_tx_rate', 'FLOAT'),
+    ('blk_read_rate', 'FLOAT'), ('blk_write_rate', 'FLOAT'),
+]
+
+INSERT_SQL = f"""
+    INSERT INTO TB_Instance_Metrics (container_id, cpu_percent, mem_usage, mem_percent, net_io, block_io, pids,
+                                     {', '.join(name for name, _ in NUMERIC_COLUMNS)})
+    VALUES (?, ?, ?, ?, ?, ?, ?, {', '.join('?' for _ in NUMERIC_COLUMNS)})
+"""
+
+
+def create_columns(connection):
+    """Add the numeric I/O columns to TB_Instance_Metrics if they're missing."""
+    cursor = connection.cursor()
+    for name, sql_type in NUMERIC_COLUMNS:
+        cursor.execute(f"""
+            IF COL_LENGTH('TB_Instance_Metrics', '{name}') IS NULL
+                ALTER TABLE TB_Instance_Metrics ADD {name} {sql_type} NULL
+        """)
+    connection.commit()
+
+
+def metrics_row(sample):
+    """TB_Instance_Metrics row for a collector sample."""
+    net_io = f"{human_size(sample['net_rx_bytes'])} / {human_size(sample['net_tx_bytes'])}"
+    block_io = f"{human_size(sample['blk_read_bytes'])} / {human_size(sample['blk_write_bytes'])}"
+    return (sample['container_id'], sample['cpu_percent'], sample['mem_usage'], sample['mem_percent'],
+            net_io, block_io, sample['pids'],
+            *(sample.get(name) for name, _ in NUMERIC_COLUMNS))
+
+
+class KnownContainers:
+    """Short (12 character) ids of the containers that belong to an instance."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._ids = {}  # short container id -> instance_id
+        self._watermark = 0
+        self._full_at = 0.0
+        self._incremental_at = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self, full=False):
+        with self._lock:
+            watermark = 0 if full else self._watermark
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT instance_id, container_id FROM TB_Instances WHERE instance_id > ? AND container_id IS NOT NULL",
+                (watermark,))
+            rows = cursor.fetchall()
+        ids = {row.container_id[:12]: row.instance_id for row in rows}
+        now = time.monotonic()
+        with self._lock:
+            self._ids = ids if full else {**self._ids, **ids}
+            if rows:
+                self._watermark = max(self._watermark if not full else 0, max(row.instance_id for row in rows))
+            if full:
+                self._full_at = now
+            self._incremental_at = now
+
+    def filter(self, container_ids):
+        """Return the subset of ids that belong to an instance."""
+        now = time.monotonic()
+        if now - self._full_at > FULL_REFRESH_INTERVAL:
+            self.refresh(full=True)
+        with self._lock:
+            unknown = [c for c in container_ids if c not in self._ids]
+        if unknown and now - self._incremental_at > UNKNOWN_REFRESH_INTERVAL:
+            self.refresh()
+        with self._lock:
+            return {c for c in container_ids if c in self._ids}
+
+    def instance_ids(self, container_ids):
+        """Map the ids that belong to an instance to its instance_id."""
+        known = self.filter(container_ids)
+        with self._lock:
+            return {c: self._ids[c] for c in known if c in self._ids}
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class MetricsIngest:
+    def __init__(self, pool, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 row_builder=metrics_row, insert_sql=INSERT_SQL, storage=STORAGE):
+        if storage not in ('rows', 'blob', 'both'):
+            raise ValueError(f"Unknown metrics storage: {storage}")
+        self.pool = pool
+        self.write_rows = storage in ('rows', 'both')
+        self.blobs = tsblob.BlobStore() if storage in ('blob', 'both') else None
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.row_builder = row_builder
+        self.insert_sql = insert_sql
+        self.known = KnownContainers(pool)
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self.stats = {'rows_buffered': 0, 'rows_written': 0, 'rows_skipped': 0, 'flushes': 0, 'flush_errors': 0,
+                      'blobs_written': 0}
+
+    def add(self, samples):
+        """Buffer the samples of known containers; returns how many were kept."""
+        known = self.known.filter({s['container_id'] for s in samples})
+        kept = [s for s in samples if s['container_id'] in known]
+        with self._lock:
+            self._buffer.extend(kept)
+            self.stats['rows_buffered'] += len(kept)
+            self.stats['rows_skipped'] += len(samples) - len(kept)
+        return len(kept)
+
+    def due(self):
+        with self._lock:
+            return bool(self._buffer) and (
+                len(self._buffer) >= self.flush_size
+                or time.monotonic() - self._last_flush >= self.flush_interval)
+
+    def flush(self):
+        """Write everything buffered in one batch; returns the row count."""
+        with self._lock:
+            samples, self._buffer = self._buffer, []
+            self._last_flush = time.monotonic()
+        if not samples:
+            return 0
+        try:
+            with self.pool.connection() as conn:
+                if self.write_rows:
+                    cursor = conn.cursor()
+                    cursor.fast_executemany = True
+                    cursor.executemany(self.insert_sql, [self.row_builder(s) for s in samples])
+                if self.blobs is not None:
+                    self.blobs.add(samples)
+                    self.stats['blobs_written'] += self.blobs.write(conn)
+                conn.commit()
+        except Exception:
+            self.stats['flush_errors'] += 1
+            with self._lock:
+                # Keep the rows for the next attempt, but don't grow without bound
+                self._buffer = (samples + self._buffer)[-self.flush_size * 10:]
+            raise
+        self.stats['flushes'] += 1
+        self.stats['rows_written'] += len(samples)
+        return len(samples)
+
+    def maybe_flush(self):
+        return self.flush() if self.due() else 0
+
+
+def main():
+    import db
+    import instance_state
+
+    parser = argparse.ArgumentParser(description="Prepare the tables the metrics ingest writes to.")
+    parser.add_argument('command', choices=['init'])
+    parser.parse_args()
+
+    with db.get_pool().connection() as connection:
+        create_columns(connection)
+        tsblob.create_table(connection)
+        instance_state.create_table(connection)
+    print("TB_Instance_Metrics numeric I/O columns, TB_Instance_Metrics_Blob and TB_Instance_State ready")
+
+
+if __name__ == '__main__':
+    main()
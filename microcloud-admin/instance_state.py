@@ -0,0 +1,162 @@
+"""Latest usage and status of every instance, one row each in TB_Instance_State.
+
+Dashboards need the current figures, not the history, so instead of
+scanning TB_Instance_Metrics they read this table. The metrics pipeline
+upserts it every tick: the newest sample of each known container becomes
+one row of a single ``fast_executemany`` MERGE. The same statement copies
+what the customer dashboard shows next to the usage (status, node IP,
+plan, renewal date) from TB_Instances, TB_Subscription, TB_Plans and
+TB_Nodes. The customer_id index covers all of it, so "all instances of a
+customer" is one index seek with no further joins.
+
+Stopped containers stop producing samples, and plans and renewals change
+without one, so every METRICS_STATE_SYNC_INTERVAL seconds the copied
+columns are refreshed on the rows where they differ and rows of deleted
+instances are removed.
+"""
+
+import logging
+import os
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+TABLE = 'TB_Instance_State'
+SYNC_INTERVAL = float(os.getenv('METRICS_STATE_SYNC_INTERVAL', '60'))
+
+# Sample fields kept per instance and their SQL types
+USAGE_COLUMNS = [
+    ('cpu_percent', 'FLOAT'), ('mem_usage', 'FLOAT'), ('mem_percent', 'FLOAT'),
+    ('net_rx_rate', 'FLOAT'), ('net_tx_rate', 'FLOAT'),
+    ('blk_read_rate', 'FLOAT'), ('blk_write_rate', 'FLOAT'),
+    ('pids', 'INT'),
+]
+
+# Columns copied from the catalog tables: (name, SQL type, source expression in _DETAIL_JOINS)
+DETAIL_COLUMNS = [
+    ('customer_id', 'INT', 'sub.customer_id'),
+    ('subscription_id', 'INT', 'i.subscription_id'),
+    ('node_id', 'INT', 'i.node_id'),
+    ('instance_status', 'VARCHAR(50)', 'i.instance_status'),
+    ('node_ip', 'VARCHAR(64)', 'n.node_ip'),
+    ('plan_name', 'NVARCHAR(100)', 'p.plan_name'),
+    ('vcpu', 'FLOAT', 'p.vcpu'),
+    ('ram', 'INT', 'p.ram'),
+    ('storage', 'INT', 'p.storage'),
+    ('renewal_date', 'DATETIME', 'sub.renewal_date'),
+]
+
+_DETAIL_JOINS = """
+        LEFT JOIN TB_Subscription sub ON sub.sub_id = i.subscription_id
+        LEFT JOIN TB_Plans p ON p.plan_id = sub.plan_id
+        LEFT JOIN TB_Nodes n ON n.node_id = i.node_id
+"""
+
+_SOURCE_COLUMNS = [('instance_id', 'INT'), ('container_id', 'VARCHAR(64)'), *USAGE_COLUMNS, ('last_seen', 'DATETIME')]
+_COPIED = [*(name for name, _, _ in DETAIL_COLUMNS), 'container_id',
+           *(name for name, _ in USAGE_COLUMNS), 'last_seen']
+
+# Parameters are cast so the driver doesn't have to guess their types
+UPSERT_SQL = f"""
+    MERGE {TABLE} WITH (HOLDLOCK) AS t
+    USING (
+        SELECT i.instance_id, {', '.join(f'{source} AS {name}' for name, _, source in DETAIL_COLUMNS)},
+               {', '.join(f'v.{name}' for name, _ in _SOURCE_COLUMNS[1:])}
+        FROM (SELECT {', '.join(f'CAST(? AS {sql_type}) AS {name}' for name, sql_type in _SOURCE_COLUMNS)}) AS v
+        JOIN TB_Instances i ON i.instance_id = v.instance_id{_DETAIL_JOINS}
+    ) AS s
+    ON t.instance_id = s.instance_id
+    WHEN MATCHED AND s.last_seen >= t.last_seen THEN
+        UPDATE SET {', '.join(f'{name} = s.{name}' for name in _COPIED)}
+    WHEN NOT MATCHED THEN
+        INSERT (instance_id, {', '.join(_COPIED)})
+        VALUES (s.instance_id, {', '.join(f's.{name}' for name in _COPIED)});
+"""
+
+
+def create_table(connection):
+    cursor = connection.cursor()
+    cursor.execute(f"""
+        IF OBJECT_ID('{TABLE}', 'U') IS NULL
+            CREATE TABLE {TABLE} (
+                instance_id INT NOT NULL,
+                {' '.join(f'{name} {sql_type} NULL,' for name, sql_type, _ in DETAIL_COLUMNS)}
+                container_id VARCHAR(64) NOT NULL,
+                {' '.join(f'{name} {sql_type} NULL,' for name, sql_type in USAGE_COLUMNS)}
+                last_seen DATETIME NOT NULL,
+                CONSTRAINT PK_{TABLE} PRIMARY KEY (instance_id)
+            )
+    """)
+    included = [name for name, _, _ in DETAIL_COLUMNS[1:]] + [name for name, _ in USAGE_COLUMNS] + ['last_seen']
+    cursor.execute(f"""
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_{TABLE}_customer')
+            CREATE INDEX IX_{TABLE}_customer ON {TABLE} (customer_id)
+                INCLUDE ({', '.join(included)})
+    """)
+    connection.commit()
+
+
+def sync(cursor):
+    """Refresh the copied columns of rows whose sources changed and drop rows of deleted instances."""
+    # EXCEPT compares NULLs as equal, so only rows with a real difference are rewritten
+    cursor.execute(f"""
+        UPDATE t SET {', '.join(f'{name} = {source}' for name, _, source in DETAIL_COLUMNS)}
+        FROM {TABLE} t
+        JOIN TB_Instances i ON i.instance_id = t.instance_id{_DETAIL_JOINS}
+        WHERE EXISTS (
+            SELECT {', '.join(f't.{name}' for name, _, _ in DETAIL_COLUMNS)}
+            EXCEPT
+            SELECT {', '.join(source for _, _, source in DETAIL_COLUMNS)}
+        )
+    """)
+    cursor.execute(f"""
+        DELETE t FROM {TABLE} t
+        WHERE NOT EXISTS (SELECT 1 FROM TB_Instances i WHERE i.instance_id = t.instance_id)
+    """)
+
+
+class InstanceState:
+    """Upserts the newest sample of each instance; ``known`` is the ingest's KnownContainers."""
+
+    def __init__(self, pool, known, sync_interval=SYNC_INTERVAL):
+        self.pool = pool
+        self.known = known
+        self.sync_interval = sync_interval
+        self._synced_at = 0.0
+        self.stats = {'updates': 0, 'rows_upserted': 0, 'syncs': 0, 'errors': 0}
+
+    def update(self, samples):
+        """Write the newest sample of every known container; returns the row count."""
+        newest = {}
+        for sample in samples:
+            current = newest.get(sample['container_id'])
+            if current is None or sample['read_at'] > current['read_at']:
+                newest[sample['container_id']] = sample
+        instance_ids = self.known.instance_ids(newest)
+        rows = [
+            (instance_ids[cid], cid, *(sample.get(name) for name, _ in USAGE_COLUMNS),
+             datetime.fromtimestamp(sample['read_at']))
+            for cid, sample in newest.items() if cid in instance_ids
+        ]
+        sync_due = time.monotonic() - self._synced_at >= self.sync_interval
+        if not rows and not sync_due:
+            return 0
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                if rows:
+                    cursor.fast_executemany = True
+                    cursor.executemany(UPSERT_SQL, rows)
+                if sync_due:
+                    sync(cursor)
+                conn.commit()
+        except Exception:
+            self.stats['errors'] += 1
+            raise
+        if sync_due:
+            self._synced_at = time.monotonic()
+            self.stats['syncs'] += 1
+        self.stats['updates'] += 1
+        self.stats['rows_upserted'] += len(rows)
+        return len(rows)
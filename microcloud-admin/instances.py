@@ -0,0 +1,47 @@
+"""Persistence of newly spawned instances."""
+
+# Container ports published for every instance, in the order external ports are allocated
+INTERNAL_PORTS = [80, 443, 22, 23, 8083]
+
+
+def _persist_batch(port_count):
+    port_rows = ',\n        '.join(['(?, ?, @instance_id)'] * port_count)
+    return f"""
+    SET NOCOUNT ON;
+    DECLARE @instance_id INT;
+    EXEC P_AddInstance ?, ?, ?, ?, ?;
+    SELECT @instance_id = MAX(instance_id) FROM TB_Instances WHERE container_id = ?;
+    IF @instance_id IS NULL
+        THROW 50001, 'P_AddInstance did not create an instance row.', 1;
+    INSERT INTO TB_Port_Mappings (external_port, internal_port, instance_id) VALUES
+        {port_rows};
+    INSERT INTO TB_IP_Mappings (external_ip, internal_ip, instance_id) VALUES (?, ?, @instance_id);
+    SELECT @instance_id AS instance_id;
+    """
+
+
+def persist_instance(connection, plan_id, subscription_id, node_id, container_id,
+                     external_ports, external_ip, internal_ip, status='Running'):
+    """Record an instance with its port and IP mappings; returns the instance_id.
+
+    Everything is sent as one batch and committed once, so the row locks
+    are held for a single round trip instead of one per statement.
+    """
+    params = [plan_id, subscription_id, node_id, status, container_id, container_id]
+    for external_port, internal_port in zip(external_ports, INTERNAL_PORTS):
+        params += [external_port, internal_port]
+    params += [external_ip, internal_ip]
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute(_persist_batch(len(INTERNAL_PORTS)), params)
+        # Skip any result sets produced inside the procedure
+        while cursor.description is None or cursor.description[0][0] != 'instance_id':
+            if not cursor.nextset():
+                raise Exception("Instance batch returned no instance_id.")
+        instance_id = cursor.fetchone().instance_id
+        connection.commit()
+        return instance_id
+    except Exception:
+        connection.rollback()
+        raise
@@ -0,0 +1,140 @@
+"""In-process job queue for deploys.
+
+Jobs run on a bounded thread pool. A handler can hold a per-node slot while
+it works on a node, which caps how many jobs hit the same node at once.
+Jobs are keyed (by subscription for deploys): submitting a key that already
+has a queued, running or succeeded job returns that job instead of starting
+another one, so client retries don't create duplicate instances.
+"""
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class Job:
+    def __init__(self, key, payload):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.payload = payload
+        self.status = QUEUED
+        self.node_id = None
+        self.result = None
+        self.error = None
+        self.phases = {QUEUED: _now()}
+        self.created_at = time.monotonic()
+        self.finished_at = None
+
+    def mark(self, phase):
+        """Record the time a phase of the job was reached."""
+        self.phases[phase] = _now()
+
+    def as_dict(self):
+        return {
+            'job_id': self.id,
+            'key': self.key,
+            'status': self.status,
+            'node_id': self.node_id,
+            'phases': dict(self.phases),
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+class JobQueue:
+    def __init__(self, handler, max_workers=8, per_node_limit=2, max_pending=500, retention=3600):
+        # handler(job, queue) returns the job result or raises
+        self.handler = handler
+        self.per_node_limit = per_node_limit
+        self.max_pending = max_pending
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._by_key = {}
+        self._node_slots = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, payload, handler=None, allow_rerun=False):
+        """Queue a job for ``key``; returns ``(job, created)``.
+
+        ``handler`` overrides the queue's default handler for this job. With
+        ``allow_rerun`` only a queued or running job is reused, so a key that
+        already succeeded can run again.
+        """
+        with self._lock:
+            self._prune()
+            existing = self._jobs.get(self._by_key.get(key))
+            reusable = (QUEUED, RUNNING) if allow_rerun else (QUEUED, RUNNING, SUCCEEDED)
+            if existing is not None and existing.status in reusable:
+                return existing, False
+            pending = sum(1 for j in self._jobs.values() if j.status in (QUEUED, RUNNING))
+            if pending >= self.max_pending:
+                raise QueueFullError("Too many jobs in progress, try again later")
+            job = Job(key, payload)
+            self._jobs[job.id] = job
+            self._by_key[key] = job.id
+        self._executor.submit(self._run, job, handler or self.handler)
+        return job, True
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def is_active(self, key):
+        """True if a job for ``key`` is queued or running."""
+        with self._lock:
+            job = self._jobs.get(self._by_key.get(key))
+            return job is not None and job.status in (QUEUED, RUNNING)
+
+    @contextmanager
+    def node_slot(self, node_id):
+        """Hold one of the node's concurrency slots for the duration of the block."""
+        with self._lock:
+            slot = self._node_slots.setdefault(node_id, threading.BoundedSemaphore(self.per_node_limit))
+        slot.acquire()
+        try:
+            yield
+        finally:
+            slot.release()
+
+    def _run(self, job, handler):
+        job.status = RUNNING
+        job.mark(RUNNING)
+        try:
+            job.result = handler(job, self)
+            job.status = SUCCEEDED
+        except Exception as e:
+            job.error = str(e)
+            job.status = FAILED
+        job.mark(job.status)
+        job.finished_at = time.monotonic()
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.retention
+        for job_id in [j.id for j in self._jobs.values() if j.finished_at and j.finished_at < cutoff]:
+            job = self._jobs.pop(job_id)
+            if self._by_key.get(job.key) == job_id:
+                del self._by_key[job.key]
+
+    def stats(self):
+        with self._lock:
+            counts = {QUEUED: 0, RUNNING: 0, SUCCEEDED: 0, FAILED: 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        return counts
@@ -1,220 +1,190 @@
 #!/usr/bin/env python3
 
 import argparse
-import os
-import pyodbc
+import json
 import docker
-import random
-import socket
-import time
 import secrets
 import string
-from dotenv import load_dotenv
-import tempfile
-import shutil
-import shlex
+import catalog
+import db
+import image_cache
+import instances
+import node_identity
+import port_allocator
+import readiness
+import tracing
+import warm_pool
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Spawn a Docker instance based on plan specifications.")
     parser.add_argument('plan_id', type=int, help='Plan ID')
     parser.add_argument('subscription_id', type=int, help='Subscription ID')
     parser.add_argument('node_id', type=int, help='Node ID')
+    parser.add_argument('--correlation-id', help='Correlation ID of the deploy this spawn belongs to')
     return parser.parse_args()
 
-def load_env():
-    load_dotenv()
-    db_credentials = {
-        'server': os.getenv('DB_SERVER'),
-        'database': os.getenv('DB_NAME'),
-        'username': os.getenv('DB_USER'),
-        'password': os.getenv('DB_PASSWORD')
-    }
-    return db_credentials
-
-def connect_db(db_credentials):
-    conn_str = (
-        f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-        f"SERVER={db_credentials['server']};"
-        f"DATABASE={db_credentials['database']};"
-        f"UID={db_credentials['username']};"
-        f"PWD={db_credentials['password']}"
-    )
-    try:
-        connection = pyodbc.connect(conn_str)
-        return connection
-    except pyodbc.Error as e:
-        print("Database connection failed:", e)
-        exit(1)
+class PlanNotFoundError(Exception):
+    pass
 
-def get_plan_details(connection, plan_id):
-    cursor = connection.cursor()
-    query = "SELECT * FROM VW_Plans WHERE plan_id = ?"
-    cursor.execute(query, (plan_id,))
-    row = cursor.fetchone()
-    if row:
-        plan_details = {
-            'vcpu': row.vcpu,
-            'ram': row.ram
-        }
+def get_plan_details(plan_id, connection=None):
+    plan_details = catalog.get_catalog().plan(plan_id, connection)
+    if plan_details:
         return plan_details
     else:
-        print("Plan ID not found.")
-        exit(1)
-
-def is_port_free(port):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        return s.connect_ex(('localhost', port)) != 0
+        raise PlanNotFoundError(f"Plan ID {plan_id} not found.")
 
-def get_free_ports(count):
-    ports = set()
-    while len(ports) < count:
-        port = random.randint(10000, 11500)
-        if is_port_free(port):
-            ports.add(port)
-    return list(ports)
+def get_port_allocator(connection, node_id, client=None):
+    client = client or docker.from_env()
+    # Seeding only happens the first time the allocator state is created on this node
+    return port_allocator.PortAllocator(
+        seed=lambda: port_allocator.docker_bound_ports(client) | port_allocator.db_mapped_ports(connection, node_id)
+    )
 
 def generate_password(length=12):
     # Use only letters and digits
     characters = string.ascii_letters + string.digits
     return ''.join(secrets.choice(characters) for _ in range(length))
 
-def spawn_docker_instance(vcpu, ram, port_mappings, ssh_password):
-    client = docker.from_env()
-
-    # Escape the password for the shell command
-    escaped_password = shlex.quote(ssh_password)
-
-    # Create a Dockerfile for the container
-    dockerfile = f"""
-    FROM ubuntu:latest
-    RUN apt-get update && apt-get install -y openssh-server && \\
-        echo 'root:{escaped_password}' | chpasswd && \\
-        sed -i 's/#PermitRootLogin prohibit-password/PermitRootLogin yes/' /etc/ssh/sshd_config && \\
-        sed -i 's/PasswordAuthentication no/PasswordAuthentication yes/' /etc/ssh/sshd_config && \\
-        mkdir /var/run/sshd
-    EXPOSE 22 80 443 23 8083
-    CMD ["/usr/sbin/sshd", "-D"]
-    """
+def spawn_docker_instance(vcpu, ram, port_mappings, ssh_password, client=None):
+    client = client or docker.from_env()
 
-    # Create a temporary directory for the Docker build context
-    temp_dir = tempfile.mkdtemp()
+    # Reuse the cached base image; it is only built the first time on a node
+    with tracing.span('image'):
+        image = image_cache.ensure_base_image(client)
 
-    try:
-        # Write the Dockerfile to the temporary directory
-        dockerfile_path = os.path.join(temp_dir, 'Dockerfile')
-        with open(dockerfile_path, 'w') as f:
-            f.write(dockerfile)
-
-        # Build the Docker image
-        image, build_logs = client.images.build(path=temp_dir, rm=True, tag='custom_ubuntu')
-
-        # Resource constraints
-        mem_limit = f"{ram}m"
-        nano_cpus = int(float(vcpu) * 1e9)  # Docker uses nanocpus for CPU limit
-
-        # Port mappings
-        ports = {
-            '80/tcp': port_mappings[0],
-            '443/tcp': port_mappings[1],
-            '22/tcp': port_mappings[2],
-            '23/tcp': port_mappings[3],
-            '8083/tcp': port_mappings[4],
-        }
-
-        # Run the container
+    # Resource constraints
+    mem_limit = f"{ram}m"
+    nano_cpus = int(float(vcpu) * 1e9)  # Docker uses nanocpus for CPU limit
+
+    # Port mappings
+    ports = {
+        '80/tcp': port_mappings[0],
+        '443/tcp': port_mappings[1],
+        '22/tcp': port_mappings[2],
+        '23/tcp': port_mappings[3],
+        '8083/tcp': port_mappings[4],
+    }
+
+    # Run the container
+    with tracing.span('run'):
         container = client.containers.run(
-            image='custom_ubuntu',
+            image=image,
             detach=True,
             mem_limit=mem_limit,
             nano_cpus=nano_cpus,
             ports=ports
         )
 
-        # Wait for the container to start and assign an IP
-        time.sleep(5)
-        container.reload()  # Reload the container attributes
+    # Wait until sshd answers on the mapped port, then re-inspect once: run()
+    # inspects the container before starting it, so its network settings
+    # (the internal IP) are still empty. A container that never gets there is
+    # removed, so its ports are unbound before the caller frees them
+    try:
+        with tracing.span('ready'):
+            ready_seconds = readiness.wait_for_ssh('127.0.0.1', port_mappings[2], container=container)
+            container.reload()
 
-        return container
-    finally:
-        # Clean up the temporary directory
-        shutil.rmtree(temp_dir)
+        # The password is set at start-up so it never ends up in an image layer
+        with tracing.span('password'):
+            image_cache.set_root_password(container, ssh_password)
+    except Exception:
+        container.remove(force=True)
+        raise
 
-def get_public_ip():
-    import requests
-    try:
-        ip = requests.get('https://api.ipify.org').text
-        return ip
-    except requests.RequestException:
-        return 'Unavailable'
+    return container, ready_seconds
 
-def main():
-    args = parse_args()
-    db_credentials = load_env()
-    connection = connect_db(db_credentials)
-    plan_details = get_plan_details(connection, args.plan_id)
+def provision(connection, plan_id, subscription_id, node_id, client=None, pool=None):
+    """Spawn and record an instance; returns its details as a dict.
+
+    Long-running callers (the node agent) pass their own Docker client and
+    warm pool so they are reused between spawns.
+    """
+    client = client or docker.from_env()
+    with tracing.span('plan'):
+        plan_details = get_plan_details(plan_id, connection)
 
     vcpu = plan_details['vcpu']
     ram = plan_details['ram']
 
-    # Get 5 free ports
-    free_ports = get_free_ports(5)
-
     # Generate SSH password
     ssh_password = generate_password()
 
-    # Spawn Docker instance
-    container = spawn_docker_instance(vcpu, ram, free_ports, ssh_password)
-
-    # Get container details
-    container_id = container.id
-
-    # Retrieve the internal IP address from the correct network settings
-    network_settings = container.attrs['NetworkSettings']
-    networks = network_settings['Networks']
-    if networks:
-        # Assuming the container is connected to one network
-        network_name = next(iter(networks))
-        internal_ip = networks[network_name]['IPAddress']
+    # Take a pre-created container from the warm pool if one is ready
+    allocator = get_port_allocator(connection, node_id, client)
+    pool = pool or warm_pool.WarmPool(client, allocator.allocate, port_release=allocator.free)
+    with tracing.span('warm_claim'):
+        claimed = pool.claim(vcpu, ram, ssh_password)
+    if claimed:
+        container, free_ports, ready_seconds = claimed
     else:
-        internal_ip = None  # or handle accordingly
-
-    external_ip = get_public_ip()
+        # Reserve 5 free ports
+        with tracing.span('ports'):
+            free_ports = allocator.allocate(5)
+
+        # Spawn Docker instance
+        try:
+            container, ready_seconds = spawn_docker_instance(vcpu, ram, free_ports, ssh_password, client)
+        except Exception:
+            allocator.free(free_ports)
+            raise
+
+    # An instance that can't be recorded is removed again, with its ports
+    try:
+        # Get container details
+        container_id = container.id
+
+        # Internal IP comes from the attrs reloaded after start; the public IP is cached per node
+        internal_ip = node_identity.internal_ip(container)
+        with tracing.span('public_ip'):
+            external_ip = node_identity.get_identity(node_id).public_ip(connection)
+
+        # Insert the instance with its port and IP mappings in one transaction
+        with tracing.span('persist'):
+            instance_id = instances.persist_instance(
+                connection, plan_id, subscription_id, node_id, container_id, free_ports, external_ip, internal_ip)
+    except Exception:
+        container.remove(force=True)
+        allocator.free(free_ports)
+        raise
+
+    return {
+        'instance_id': instance_id,
+        'container_id': container_id,
+        'external_ip': external_ip,
+        'internal_ip': internal_ip,
+        'ssh_port': free_ports[2],
+        'password': ssh_password,
+        'ports': {
+            'external_ports': free_ports,
+            'internal_ports': instances.INTERNAL_PORTS
+        },
+        'ready_seconds': round(ready_seconds, 3),
+        'warm': bool(claimed)
+    }
 
-    # Insert into TB_Instances
-    cursor = connection.cursor()
-    proc_query = "{CALL P_AddInstance(?, ?, ?, ?, ?)}"
-    cursor.execute(proc_query, (args.plan_id, args.subscription_id, args.node_id, 'Running', container_id))
-    connection.commit()
+def traced_provision(connection, plan_id, subscription_id, node_id, correlation_id=None, client=None, pool=None):
+    """``provision`` under a spawn trace; the result carries the trace."""
+    with tracing.Trace('spawn', correlation_id) as trace:
+        result = provision(connection, plan_id, subscription_id, node_id, client=client, pool=pool)
+    result['trace'] = trace.as_dict()
+    return result
 
-    # Get instance_id
-    cursor.execute("SELECT instance_id FROM TB_Instances WHERE container_id = ?", (container_id,))
-    instance_row = cursor.fetchone()
-    if instance_row:
-        instance_id = instance_row.instance_id
-    else:
-        print("Failed to retrieve instance_id.")
+def main():
+    args = parse_args()
+    try:
+        with db.get_pool().connection() as connection:
+            result = traced_provision(connection, args.plan_id, args.subscription_id, args.node_id,
+                                      correlation_id=args.correlation_id)
+    except PlanNotFoundError:
+        print("Plan ID not found.")
         exit(1)
 
-    # Insert into TB_Port_Mappings
-    internal_ports = [80, 443, 22, 23, 8083]
-    for external_port, internal_port in zip(free_ports, internal_ports):
-        cursor.execute(
-            "INSERT INTO TB_Port_Mappings (external_port, internal_port, instance_id) VALUES (?, ?, ?)",
-            (external_port, internal_port, instance_id)
-        )
-    connection.commit()
-
-    # Insert into TB_IP_Mappings
-    cursor.execute(
-        "INSERT INTO TB_IP_Mappings (external_ip, internal_ip, instance_id) VALUES (?, ?, ?)",
-        (external_ip, internal_ip, instance_id)
-    )
-    connection.commit()
-
     # Print SSH command
     print("Docker instance has been created successfully.")
-    print(f"SSH Command: ssh root@{external_ip} -p {free_ports[2]}")
-    print(f"Password: {ssh_password}")
+    print(f"SSH Command: ssh root@{result['external_ip']} -p {result['ssh_port']}")
+    print(f"Password: {result['password']}")
+    print(f"Ready In: {result['ready_seconds']:.3f}s")
+    print(f"Trace: {json.dumps(result['trace'])}")
 
 if __name__ == '__main__':
     main()
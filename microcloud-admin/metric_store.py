@@ -0,0 +1,112 @@
+"""Recent container samples held in memory for dashboard reads.
+
+Each container gets a fixed-size ring buffer: one ``array('d')`` per field
+plus one for the sample timestamps, so a container costs
+``capacity * 8 bytes`` per field regardless of how long it has been running
+and nothing is allocated per sample. The buffers cover the last
+METRICS_MEMORY_MINUTES minutes, and containers that stop reporting are
+dropped after the same window.
+"""
+
+import math
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_right
+
+WINDOW_MINUTES = float(os.getenv('METRICS_MEMORY_MINUTES', '15'))
+
+FIELDS = ('cpu_percent', 'mem_usage', 'mem_percent', 'net_rx_bytes', 'net_tx_bytes',
+          'blk_read_bytes', 'blk_write_bytes', 'net_rx_rate', 'net_tx_rate',
+          'blk_read_rate', 'blk_write_rate', 'pids')
+
+
+class RingBuffer:
+    """Fixed-capacity columnar buffer of timestamped samples."""
+
+    def __init__(self, capacity, fields=FIELDS):
+        self.capacity = capacity
+        self.fields = fields
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.columns = {f: array('d', bytes(8 * capacity)) for f in fields}
+        self.head = 0  # next slot to write
+        self.size = 0
+
+    def append(self, ts, sample):
+        self.timestamps[self.head] = ts
+        for f in self.fields:
+            self.columns[f][self.head] = sample.get(f) or 0.0
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    @property
+    def last_ts(self):
+        return self.timestamps[self.head - 1] if self.size else 0.0
+
+    def _ordered(self, column):
+        # Oldest first
+        if self.size < self.capacity:
+            return column[:self.size]
+        return column[self.head:] + column[:self.head]
+
+    def since(self, ts):
+        """Columns of the samples newer than ``ts``, oldest first."""
+        timestamps = self._ordered(self.timestamps)
+        start = bisect_right(timestamps, ts)
+        result = {'timestamp': timestamps[start:].tolist()}
+        for f in self.fields:
+            result[f] = self._ordered(self.columns[f])[start:].tolist()
+        return result
+
+    def latest(self):
+        if not self.size:
+            return None
+        i = self.head - 1
+        sample = {f: self.columns[f][i] for f in self.fields}
+        sample['timestamp'] = self.timestamps[i]
+        return sample
+
+
+class MetricStore:
+    def __init__(self, interval=5.0, window_minutes=WINDOW_MINUTES, fields=FIELDS):
+        self.window = window_minutes * 60
+        self.capacity = math.ceil(self.window / interval) + 1
+        self.fields = fields
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def add(self, samples):
+        """Append a tick of collector samples; repeats of a sample are skipped."""
+        now = time.time()
+        with self._lock:
+            for sample in samples:
+                buffer = self._buffers.get(sample['container_id'])
+                if buffer is None:
+                    buffer = self._buffers[sample['container_id']] = RingBuffer(self.capacity, self.fields)
+                ts = sample.get('read_at', now)
+                if ts > buffer.last_ts:
+                    buffer.append(ts, sample)
+            for container_id in [c for c, b in self._buffers.items() if b.last_ts < now - self.window]:
+                del self._buffers[container_id]
+
+    def since(self, container_id, ts=0.0):
+        """Samples of one container newer than ``ts``; None if it isn't tracked."""
+        with self._lock:
+            buffer = self._buffers.get(container_id[:12])
+            return buffer.since(ts) if buffer is not None else None
+
+    def latest(self, container_ids=None):
+        """Most recent sample per container, for all containers or the given ids."""
+        with self._lock:
+            if container_ids is None:
+                container_ids = list(self._buffers)
+            result = {}
+            for container_id in container_ids:
+                buffer = self._buffers.get(container_id[:12])
+                if buffer is not None and buffer.size:
+                    result[container_id[:12]] = buffer.latest()
+            return result
+
+    def __len__(self):
+        return len(self._buffers)
@@ -1,115 +1,218 @@
 import os
-import subprocess
-import re
-import pyodbc
-import json
 import logging
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request, stream_with_context
 from apscheduler.schedulers.background import BackgroundScheduler
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 import signal
+import json
+import time
+import collection
+import db
+import instance_state
+import prometheus
+import rollup
+import tsblob
+from ingest import MetricsIngest
+from metric_store import MetricStore
+from stats_collector import RateTracker, StatsCollector
 
 # Load environment variables
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (DEBUG logs every tick, so it's opt-in)
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
 
 # Flask application setup
 app = Flask(__name__)
-
-# Database credentials from .env
-DB_SERVER = os.getenv('DB_SERVER')
-DB_USER = os.getenv('DB_USER')
-DB_PASSWORD = os.getenv('DB_PASSWORD')
-DB_DATABASE = os.getenv('DB_DATABASE')
-
-# MS SQL connection string
-conn_string = f'DRIVER={{ODBC Driver 17 for SQL Server}};SERVER={DB_SERVER};DATABASE={DB_DATABASE};UID={DB_USER};PWD={DB_PASSWORD}'
-
-# Function to convert memory units to MiB
-def convert_to_mib(mem_string):
-    """Converts memory usage strings to MiB."""
-    unit_multipliers = {"KiB": 1 / 1024, "MiB": 1, "GiB": 1024}
-    match = re.match(r"([\d.]+)([KMGT]i?B)", mem_string.strip())
-    if match:
-        value, unit = match.groups()
-        multiplier = unit_multipliers.get(unit, 1)
-        return float(value) * multiplier
-    return 0.0
-
-# Function to parse docker stats output and insert into database
-def process_and_push_metrics():
+prometheus.instrument(app)
+
+# With METRICS_INGEST=off the node only keeps samples in memory and
+# aggregator.py pulls them from /metrics/latest and writes them centrally
+INGEST_ENABLED = os.getenv('METRICS_INGEST', 'local').lower() != 'off'
+
+# Keep TB_Instance_State (latest usage per instance) current on every tick
+STATE_ENABLED = os.getenv('METRICS_STATE', 'on').lower() != 'off'
+
+# Per-container gauges are capped so a crowded node can't blow up the scrape
+PROMETHEUS_MAX_CONTAINERS = int(os.getenv('PROMETHEUS_MAX_CONTAINERS', '500'))
+
+# Streaming Docker stats, the buffered DB ingest, the latest-state writer and the collection loop,
+# created at start-up
+collector = None
+ingest = None
+state = None
+loop = None
+
+# Recent samples kept in memory for dashboard reads, sized for the shortest interval
+store = MetricStore(interval=collection.MIN_INTERVAL)
+
+# Per-second I/O rates from the byte counters of consecutive ticks
+rates = RateTracker()
+
+# Sampling stage: read the latest stats and keep them in memory
+def sample_metrics():
+    samples = rates.apply(collector.snapshot())
+    store.add(samples)
+    logger.debug(f"Sampled {len(samples)} containers")
+    return samples
+
+# Flush stage: buffer the samples for the database and write when due
+def push_metrics(samples):
+    if ingest is None:
+        return
+    if samples:
+        kept = ingest.add(samples)
+        logger.debug(f"Buffered {kept} of {len(samples)} container samples")
+    if state is not None:
+        try:
+            state.update(samples or [])
+        except Exception as e:
+            logger.error(f"Error updating instance state: {e}", exc_info=True)
+    written = ingest.maybe_flush()
+    if written:
+        logger.debug(f"Flushed {written} metric rows")
+
+# Function to downsample raw metrics into the rollup tiers and purge old rows
+def compact_metrics():
     try:
-        logger.debug("Starting process_and_push_metrics")
-        # Run the 'docker stats' command with JSON output
-        result = subprocess.run(
-            ['docker', 'stats', '--no-stream', '--format', '{{json .}}'],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        logger.debug("Docker stats command executed")
-
-        # Split the output into lines (one JSON object per line)
-        lines = result.stdout.strip().split('\n')
-        logger.debug(f"Docker stats output lines: {lines}")
-
-        with pyodbc.connect(conn_string) as conn:
-            cursor = conn.cursor()
-            for line in lines:
-                if not line.strip():
-                    continue  # Skip empty lines
-
-                logger.debug(f"Processing line: {line}")
-
-                # Parse the JSON line
-                data = json.loads(line)
-
-                # Extract fields
-                container_id = data['Container']
-                cpu_percent = float(data['CPUPerc'].strip('%'))
-
-                # Parse and convert memory usage
-                mem_usage_raw = data['MemUsage'].split('/')[0].strip()
-                mem_usage = convert_to_mib(mem_usage_raw)
-                mem_percent = float(data['MemPerc'].strip('%'))
-
-                net_io = data['NetIO']
-                block_io = data['BlockIO']
-                pids = int(data['PIDs'])
-
-                # Check if container_id exists in TB_Instances table
-                cursor.execute("SELECT COUNT(1) FROM TB_Instances WHERE container_id LIKE ?", (container_id + '%',))
-                if cursor.fetchone()[0] > 0:
-                    # Insert data into TB_Instance_Metrics table
-                    cursor.execute("""
-                        INSERT INTO TB_Instance_Metrics (container_id, cpu_percent, mem_usage, mem_percent, net_io, block_io, pids)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    """, container_id, cpu_percent, mem_usage, mem_percent, net_io, block_io, pids)
-
-            conn.commit()
+        rollup.run(db.get_pool())
     except Exception as e:
-        logger.error(f"Error in process_and_push_metrics: {e}", exc_info=True)
+        logger.error(f"Error in compact_metrics: {e}", exc_info=True)
 
-# Initialize the scheduler (don't start it yet)
+# Initialize the scheduler for the rollup job (don't start it yet)
 scheduler = BackgroundScheduler()
 
-# Define a function to start the scheduler
+# Define a function to start collection and the scheduler
 def start_scheduler():
-    scheduler.add_job(process_and_push_metrics, 'interval', seconds=5)
-    scheduler.start()
+    global collector, ingest, state, loop
+    collector = StatsCollector(on_unwatch=rates.forget)
+    collector.start()
+    if INGEST_ENABLED:
+        ingest = MetricsIngest(db.get_pool())
+        if STATE_ENABLED:
+            state = instance_state.InstanceState(db.get_pool(), ingest.known)
+    loop = collection.CollectionLoop(sample_metrics, push_metrics)
+    loop.start()
+    if INGEST_ENABLED and os.getenv('ROLLUP_ENABLED', 'true').lower() == 'true':
+        scheduler.add_job(compact_metrics, 'interval', seconds=rollup.RUN_INTERVAL, max_instances=1)
+        scheduler.start()
     logger.info("Scheduler started")
 
-# Flask route
-@app.route('/metrics', methods=['GET'])
+# Service status (moved from /metrics, which now serves Prometheus metrics)
+@app.route('/status', methods=['GET'])
 def get_metrics_status():
-    return jsonify({"status": "Metrics are being collected and pushed to the database."})
+    return jsonify({
+        "status": "Metrics are being collected and pushed to the database.",
+        "ingest": ingest.stats if ingest else None,
+        "instance_state": state.stats if state else None,
+        "collection": loop.status() if loop else None,
+    })
+
+# Prometheus metrics
+@app.route('/metrics', methods=['GET'])
+def get_prometheus_metrics():
+    exposition = prometheus.Exposition()
+    prometheus.add_request_metrics(exposition)
+    if INGEST_ENABLED:
+        prometheus.add_db_pool_metrics(exposition, db.get_pool().stats())
+
+    if loop is not None:
+        status = loop.status()
+        exposition.histogram('microcloud_collect_sample_duration_seconds', 'Sampling stage run time.',
+                             loop.sample_duration.as_dict())
+        exposition.histogram('microcloud_collect_flush_duration_seconds', 'Flush stage run time.',
+                             loop.flush_duration.as_dict())
+        exposition.gauge('microcloud_collect_interval_seconds', 'Current collection interval.',
+                         status['interval_seconds'])
+        exposition.gauge('microcloud_collect_lag_seconds', 'How late the last tick started.', status['lag_seconds'])
+        exposition.gauge('microcloud_collect_flush_backlog', 'Batches waiting for the flush stage.',
+                         status['flush_backlog'])
+        for key in ('ticks', 'dropped_ticks', 'sample_errors', 'flushes', 'flush_errors', 'dropped_batches'):
+            exposition.counter(f'microcloud_collect_{key}_total', f'Collection {key.replace("_", " ")}.', status[key])
+    if ingest is not None:
+        for key in ('rows_written', 'rows_skipped', 'flushes', 'flush_errors'):
+            exposition.counter(f'microcloud_ingest_{key}_total', f'Ingest {key.replace("_", " ")}.', ingest.stats[key])
+    if state is not None:
+        for key in ('rows_upserted', 'syncs', 'errors'):
+            exposition.counter(f'microcloud_instance_state_{key}_total', f'Instance state {key.replace("_", " ")}.',
+                               state.stats[key])
+
+    latest = store.latest()
+    now = time.time()
+    exposition.gauge('microcloud_containers_tracked', 'Containers with recent samples.', len(latest))
+    if latest:
+        exposition.gauge('microcloud_collector_lag_seconds', 'Age of the stalest latest sample.',
+                         now - min(sample['timestamp'] for sample in latest.values()))
+    busiest = sorted(latest.items(), key=lambda item: item[1]['cpu_percent'], reverse=True)
+    for container_id, sample in busiest[:PROMETHEUS_MAX_CONTAINERS]:
+        labels = {'container_id': container_id}
+        exposition.gauge('microcloud_container_cpu_percent', 'Container CPU usage.', sample['cpu_percent'], labels)
+        exposition.gauge('microcloud_container_memory_bytes', 'Container memory usage.',
+                         sample['mem_usage'] * 1024 * 1024, labels)
+        exposition.gauge('microcloud_container_memory_percent', 'Container memory usage of its limit.',
+                         sample['mem_percent'], labels)
+        exposition.gauge('microcloud_container_network_rx_bytes_per_second', 'Container network receive rate.',
+                         sample['net_rx_rate'], labels)
+        exposition.gauge('microcloud_container_network_tx_bytes_per_second', 'Container network transmit rate.',
+                         sample['net_tx_rate'], labels)
+    return exposition.response()
+
+# Latest sample of several containers (?ids=a,b,c), or of every container
+@app.route('/metrics/latest', methods=['GET'])
+def get_latest_metrics():
+    ids = request.args.get('ids')
+    container_ids = [i.strip() for i in ids.split(',') if i.strip()] if ids else None
+    return jsonify({"containers": store.latest(container_ids)})
+
+# Recent samples of one container from memory, newer than ?since= (unix seconds)
+@app.route('/metrics/<container_id>', methods=['GET'])
+def get_container_metrics(container_id):
+    try:
+        since = float(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({"error": "since must be a unix timestamp"}), 400
+    samples = store.since(container_id, since)
+    if samples is None:
+        return jsonify({"error": "No recent samples for this container"}), 404
+    return jsonify({"container_id": container_id[:12], "samples": samples})
+
+# Metric history for one container, served from the tier that fits the range
+@app.route('/metrics/<container_id>/history', methods=['GET'])
+def get_metrics_history(container_id):
+    try:
+        end = datetime.fromisoformat(request.args['end']) if 'end' in request.args else datetime.now()
+        start = datetime.fromisoformat(request.args['start']) if 'start' in request.args else end - timedelta(hours=1)
+        max_points = int(request.args.get('max_points', 500))
+    except ValueError:
+        return jsonify({"error": "start and end must be ISO timestamps"}), 400
+
+    with db.get_pool().connection() as conn:
+        tier, rows = rollup.query(conn, container_id, start, end, max_points)
+    for row in rows:
+        row['bucket'] = row['bucket'].isoformat()
+    return jsonify({"container_id": container_id[:12], "tier": tier, "samples": rows})
+
+# Samples of one container from the compressed hourly blobs, streamed as JSON lines
+# (?start=&end= in unix seconds, the last hour by default)
+@app.route('/metrics/<container_id>/range', methods=['GET'])
+def get_metrics_range(container_id):
+    try:
+        end = float(request.args.get('end', time.time()))
+        start = float(request.args.get('start', end - 3600))
+    except ValueError:
+        return jsonify({"error": "start and end must be unix timestamps"}), 400
+
+    def generate():
+        with db.get_pool().connection() as conn:
+            for sample in tsblob.read_range(conn, container_id, start, end, ingest.blobs if ingest else None):
+                yield json.dumps(sample) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 if __name__ == "__main__":
     # Only start the scheduler in the main process
     if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
         start_scheduler()
-    app.run(debug=True)
+    app.run(port=int(os.getenv('METRICS_PORT', '5000')), debug=True)
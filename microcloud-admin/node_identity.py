@@ -0,0 +1,153 @@
+"""Resolve and cache this node's public IP.
+
+Sources are tried in order until one returns an address:
+
+1. NODE_PUBLIC_IP from the environment
+2. TB_Nodes.node_ip for the node's node_id, through the catalog
+3. a local metadata file (NODE_METADATA_PATH, ``{"public_ip": "..."}``)
+4. api.ipify.org, with a short timeout, as a last resort
+
+The result is kept in memory and in a small cache file for NODE_IDENTITY_TTL
+seconds, so the one-shot ``main.py`` processes don't resolve it again on
+every spawn either. When no source answers, 'Unavailable' is remembered in
+memory (not in the file) for NODE_IDENTITY_NEGATIVE_TTL seconds, so an outage
+doesn't cost every spawn the full chain and the ipify timeout. A caller holding a pooled connection passes it to
+``public_ip()`` so the TB_Nodes lookup doesn't check out another one.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+import catalog
+
+logger = logging.getLogger(__name__)
+
+IDENTITY_TTL = float(os.getenv('NODE_IDENTITY_TTL', '3600'))
+CACHE_PATH = os.getenv('NODE_IDENTITY_CACHE', '/tmp/microcloud_node_identity.json')
+METADATA_PATH = os.getenv('NODE_METADATA_PATH', '/etc/microcloud/node.json')
+NEGATIVE_TTL = float(os.getenv('NODE_IDENTITY_NEGATIVE_TTL', '60'))
+IPIFY_TIMEOUT = float(os.getenv('NODE_IDENTITY_HTTP_TIMEOUT', '3'))
+
+
+def from_config(node_id, connection=None):
+    return os.getenv('NODE_PUBLIC_IP')
+
+
+def from_tb_nodes(node_id, connection=None):
+    if node_id is None:
+        return None
+    node = catalog.get_catalog().node(node_id, connection)
+    return node.node_ip if node else None
+
+
+def from_metadata(node_id, connection=None):
+    if not os.path.exists(METADATA_PATH):
+        return None
+    with open(METADATA_PATH, 'r') as f:
+        return json.load(f).get('public_ip')
+
+
+def from_ipify(node_id, connection=None):
+    return requests.get('https://api.ipify.org', timeout=IPIFY_TIMEOUT).text.strip()
+
+
+DEFAULT_SOURCES = [from_config, from_tb_nodes, from_metadata, from_ipify]
+
+
+class NodeIdentity:
+    def __init__(self, node_id=None, sources=None, ttl=IDENTITY_TTL, cache_path=CACHE_PATH,
+                 negative_ttl=NEGATIVE_TTL):
+        self.node_id = node_id
+        self.sources = sources if sources is not None else DEFAULT_SOURCES
+        self.ttl = ttl
+        self.cache_path = cache_path
+        self.negative_ttl = negative_ttl
+        self._public_ip = None
+        self._resolved_at = 0.0
+        self._unavailable_at = None
+        self._lock = threading.Lock()
+
+    def _read_cache_file(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return None
+        try:
+            with open(self.cache_path, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get('node_id') != self.node_id or time.time() - cached.get('resolved_at', 0) > self.ttl:
+            return None
+        return cached.get('public_ip')
+
+    def _write_cache_file(self, public_ip):
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path, 'w') as f:
+                json.dump({'node_id': self.node_id, 'public_ip': public_ip, 'resolved_at': time.time()}, f)
+        except OSError as e:
+            logger.warning("Could not write node identity cache: %s", e)
+
+    def _resolve(self, connection=None):
+        for source in self.sources:
+            try:
+                public_ip = source(self.node_id, connection)
+            except Exception as e:
+                logger.warning("Node identity source %s failed: %s", source.__name__, e)
+                continue
+            if public_ip:
+                logger.info("Node public IP %s resolved from %s", public_ip, source.__name__)
+                return public_ip
+        return None
+
+    def public_ip(self, connection=None):
+        """The node's public IP, or 'Unavailable' if no source could provide it."""
+        with self._lock:
+            if self._public_ip and time.monotonic() - self._resolved_at < self.ttl:
+                return self._public_ip
+            if self._unavailable_at is not None and time.monotonic() - self._unavailable_at < self.negative_ttl:
+                return 'Unavailable'
+            public_ip = self._read_cache_file()
+            if not public_ip:
+                public_ip = self._resolve(connection)
+                if not public_ip:
+                    self._unavailable_at = time.monotonic()
+                    return 'Unavailable'
+                self._write_cache_file(public_ip)
+            self._public_ip = public_ip
+            self._resolved_at = time.monotonic()
+            self._unavailable_at = None
+            return public_ip
+
+    def invalidate(self):
+        with self._lock:
+            self._public_ip = None
+            self._unavailable_at = None
+            if self.cache_path and os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
+
+
+_identities = {}
+_identities_lock = threading.Lock()
+
+
+def get_identity(node_id=None):
+    """Process-wide NodeIdentity for a node_id."""
+    with _identities_lock:
+        if node_id not in _identities:
+            _identities[node_id] = NodeIdentity(node_id)
+        return _identities[node_id]
+
+
+def internal_ip(container):
+    """The container's IP on its (first) network, from attrs already loaded.
+
+    The attrs must come from an inspect after the container started.
+    """
+    networks = container.attrs['NetworkSettings']['Networks']
+    return next(iter(networks.values()))['IPAddress'] if networks else None
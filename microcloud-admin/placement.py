@@ -0,0 +1,280 @@
+"""Capacity-aware placement of new instances on nodes.
+
+Node state is held in memory: the vcpu/ram reserved by running instances
+(from their plan sizes) and the usage observed in recent TB_Instance_Metrics
+samples. It is loaded with a couple of aggregate queries and refreshed every
+PLACEMENT_REFRESH seconds; in between, placements update it incrementally.
+
+A node fits a plan when its reserved vcpu/ram plus the plan stay within
+capacity times the node's overcommit ratio, and observed usage leaves room
+for the plan on the physical capacity. Among the fitting nodes,
+``binpack`` picks the one left fullest and ``spread`` the one left emptiest.
+
+Node capacities come from NODE_CAPACITY_CONFIG, a JSON file like:
+
+    {"default": {"vcpu": 4, "ram": 8192, "cpu_overcommit": 2.0, "ram_overcommit": 1.0},
+     "nodes": {"3": {"vcpu": 8, "ram": 16384}}}
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+STRATEGY = os.getenv('PLACEMENT_STRATEGY', 'binpack')
+REFRESH_INTERVAL = float(os.getenv('PLACEMENT_REFRESH', '60'))
+CONTAINERS_FULL_REFRESH = float(os.getenv('PLACEMENT_CONTAINERS_FULL_REFRESH', '3600'))
+METRICS_WINDOW_MINUTES = int(os.getenv('PLACEMENT_METRICS_WINDOW', '5'))
+CAPACITY_CONFIG_PATH = os.getenv('NODE_CAPACITY_CONFIG', 'node_capacity.json')
+
+DEFAULT_CAPACITY = {'vcpu': 4.0, 'ram': 8192.0, 'cpu_overcommit': 2.0, 'ram_overcommit': 1.0}
+
+
+class NoCapacityError(Exception):
+    pass
+
+
+def load_capacity_config(path=CAPACITY_CONFIG_PATH):
+    """Return ``(default, {node_id: capacity})`` with every key filled in."""
+    raw = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            raw = json.load(f)
+    default = {**DEFAULT_CAPACITY, **raw.get('default', {})}
+    nodes = {int(node_id): {**default, **conf} for node_id, conf in raw.get('nodes', {}).items()}
+    return default, nodes
+
+
+class NodeState:
+    def __init__(self, node_id, node_ip, region_id, capacity):
+        self.node_id = node_id
+        self.node_ip = node_ip
+        self.region_id = region_id
+        self.vcpu = float(capacity['vcpu'])
+        self.ram = float(capacity['ram'])
+        self.cpu_overcommit = float(capacity['cpu_overcommit'])
+        self.ram_overcommit = float(capacity['ram_overcommit'])
+        self.reserved_vcpu = 0.0
+        self.reserved_ram = 0.0
+        self.observed_vcpu = 0.0
+        self.observed_ram = 0.0
+
+    def fits(self, vcpu, ram):
+        return (self.reserved_vcpu + vcpu <= self.vcpu * self.cpu_overcommit
+                and self.reserved_ram + ram <= self.ram * self.ram_overcommit
+                and self.observed_vcpu + vcpu <= self.vcpu
+                and self.observed_ram + ram <= self.ram)
+
+    def load_after(self, vcpu, ram):
+        """Fraction of allocatable capacity in use if the plan were placed here."""
+        cpu = (self.reserved_vcpu + vcpu) / (self.vcpu * self.cpu_overcommit)
+        mem = (self.reserved_ram + ram) / (self.ram * self.ram_overcommit)
+        return max(cpu, mem)
+
+    def as_dict(self):
+        return {
+            'node_id': self.node_id,
+            'node_ip': self.node_ip,
+            'region_id': self.region_id,
+            'vcpu': self.vcpu,
+            'ram': self.ram,
+            'reserved_vcpu': self.reserved_vcpu,
+            'reserved_ram': self.reserved_ram,
+            'observed_vcpu': round(self.observed_vcpu, 3),
+            'observed_ram': round(self.observed_ram, 1),
+        }
+
+
+class Reservation:
+    """Capacity held on a node for an in-flight deploy.
+
+    ``release()`` gives it back if the deploy fails; ``confirm()`` keeps it
+    until the next refresh picks the instance up from the database.
+    """
+
+    def __init__(self, scheduler, node, vcpu, ram):
+        self.scheduler = scheduler
+        self.node = node
+        self.vcpu = vcpu
+        self.ram = ram
+
+    @property
+    def node_id(self):
+        return self.node.node_id
+
+    @property
+    def node_ip(self):
+        return self.node.node_ip
+
+    def confirm(self):
+        self.scheduler._settle(self, keep=True)
+
+    def release(self):
+        self.scheduler._settle(self, keep=False)
+
+
+class Scheduler:
+    def __init__(self, pool, strategy=STRATEGY, refresh_interval=REFRESH_INTERVAL,
+                 metrics_window=METRICS_WINDOW_MINUTES, capacity_config_path=CAPACITY_CONFIG_PATH):
+        if strategy not in ('binpack', 'spread'):
+            raise ValueError(f"Unknown placement strategy: {strategy}")
+        self.pool = pool
+        self.strategy = strategy
+        self.refresh_interval = refresh_interval
+        self.metrics_window = metrics_window
+        self.capacity_config_path = capacity_config_path
+        self.nodes = {}
+        self.plans = {}
+        self._pending = set()  # reservations not yet visible in the database
+        self._confirmed = {}  # confirmed reservation -> when, until a refresh that started later
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        # Short container id -> node_id, read incrementally by instance_id watermark
+        self._container_nodes = {}
+        self._container_watermark = 0
+        self._containers_loaded_at = 0.0
+
+    def _load_container_nodes(self, cursor):
+        if time.monotonic() - self._containers_loaded_at > CONTAINERS_FULL_REFRESH:
+            # Now and then from scratch, so deleted instances drop out
+            self._container_nodes, self._container_watermark = {}, 0
+            self._containers_loaded_at = time.monotonic()
+        cursor.execute(
+            "SELECT instance_id, node_id, container_id FROM TB_Instances "
+            "WHERE instance_id > ? AND container_id IS NOT NULL", (self._container_watermark,))
+        for row in cursor.fetchall():
+            self._container_nodes[row.container_id[:12]] = row.node_id
+            self._container_watermark = max(self._container_watermark, row.instance_id)
+        return self._container_nodes
+
+    def refresh(self):
+        """Reload node, plan and usage state from the database."""
+        with self._refresh_lock:
+            self._refresh()
+
+    def _refresh(self):
+        # Only one refresh reads at a time; reservations confirmed after this
+        # point may be missing from what it reads, so they're added back below
+        started = time.monotonic()
+        default, capacities = load_capacity_config(self.capacity_config_path)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT plan_id, vcpu, ram FROM VW_Plans")
+            plans = {row.plan_id: (float(row.vcpu), float(row.ram)) for row in cursor.fetchall()}
+
+            cursor.execute("SELECT node_id, node_ip, node_region FROM TB_Nodes")
+            nodes = {
+                row.node_id: NodeState(row.node_id, row.node_ip, row.node_region,
+                                       capacities.get(row.node_id, default))
+                for row in cursor.fetchall()
+            }
+
+            cursor.execute("""
+                SELECT i.node_id, SUM(p.vcpu) AS vcpu, SUM(p.ram) AS ram
+                FROM TB_Instances i
+                JOIN TB_Subscription s ON s.sub_id = i.subscription_id
+                JOIN TB_Plans p ON p.plan_id = s.plan_id
+                WHERE i.instance_status = 'Running'
+                GROUP BY i.node_id
+            """)
+            for row in cursor.fetchall():
+                if row.node_id in nodes:
+                    nodes[row.node_id].reserved_vcpu = float(row.vcpu or 0)
+                    nodes[row.node_id].reserved_ram = float(row.ram or 0)
+
+            # Metrics are keyed by the 12 character short id, TB_Instances by the full
+            # one; map them here rather than joining on a prefix no index can seek
+            node_ids = self._load_container_nodes(cursor)
+
+            cursor.execute("""
+                SELECT container_id, AVG(cpu_percent) AS cpu_percent, AVG(mem_usage) AS mem_usage
+                FROM TB_Instance_Metrics
+                WHERE timestamp >= DATEADD(minute, -?, GETDATE())
+                GROUP BY container_id
+            """, (self.metrics_window,))
+            for row in cursor.fetchall():
+                node = nodes.get(node_ids.get(row.container_id))
+                if node is not None:
+                    node.observed_vcpu += float(row.cpu_percent or 0) / 100
+                    node.observed_ram += float(row.mem_usage or 0)
+
+        with self._lock:
+            # Deploys still in flight aren't in TB_Instances yet, nor are those
+            # confirmed while the queries above ran
+            self._confirmed = {r: at for r, at in self._confirmed.items() if at >= started}
+            for reservation in [*self._pending, *self._confirmed]:
+                node = nodes.get(reservation.node_id)
+                if node is not None:
+                    node.reserved_vcpu += reservation.vcpu
+                    node.reserved_ram += reservation.ram
+                    reservation.node = node
+            self.nodes = nodes
+            self.plans = plans
+            self._loaded_at = time.monotonic()
+
+    def _stale(self):
+        return time.monotonic() - self._loaded_at > self.refresh_interval
+
+    def _refresh_if_stale(self):
+        if not self._stale():
+            return
+        with self._refresh_lock:
+            if not self._stale():
+                return  # refreshed by another thread meanwhile
+            try:
+                self._refresh()
+            except Exception as e:
+                if not self.nodes:
+                    raise
+                logger.warning("Placement state refresh failed, using cached state: %s", e)
+
+    def plan_size(self, plan_id):
+        self._refresh_if_stale()
+        if plan_id not in self.plans:
+            # A plan created since the last refresh
+            self.refresh()
+        return self.plans[plan_id]
+
+    def place(self, region_id, plan_id, exclude=()):
+        """Reserve capacity for a plan on the best node in a region."""
+        vcpu, ram = self.plan_size(plan_id)
+        with self._lock:
+            candidates = [
+                n for n in self.nodes.values()
+                if n.region_id == region_id and n.node_id not in exclude
+            ]
+            if not candidates:
+                raise NoCapacityError("No nodes found for the given region")
+            fitting = [n for n in candidates if n.fits(vcpu, ram)]
+            if not fitting:
+                raise NoCapacityError(f"No node in region {region_id} has capacity for plan {plan_id}")
+
+            if self.strategy == 'binpack':
+                node = max(fitting, key=lambda n: n.load_after(vcpu, ram))
+            else:
+                node = min(fitting, key=lambda n: n.load_after(vcpu, ram))
+
+            node.reserved_vcpu += vcpu
+            node.reserved_ram += ram
+            reservation = Reservation(self, node, vcpu, ram)
+            self._pending.add(reservation)
+            return reservation
+
+    def _settle(self, reservation, keep):
+        with self._lock:
+            if reservation not in self._pending:
+                return
+            self._pending.discard(reservation)
+            if keep:
+                self._confirmed[reservation] = time.monotonic()
+            else:
+                reservation.node.reserved_vcpu -= reservation.vcpu
+                reservation.node.reserved_ram -= reservation.ram
+
+    def snapshot(self):
+        with self._lock:
+            return [n.as_dict() for n in self.nodes.values()]
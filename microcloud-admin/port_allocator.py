@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""Node-local allocator for the external ports handed to instances.
+
+The state lives in a small binary file: a header, a bitmap of used ports and
+a stack of free ports. Allocating pops from the stack and freeing pushes back
+onto it, so both are O(1); the bitmap guards against double frees and stale
+entries. Every operation holds an exclusive flock on the file, which makes
+reservations atomic across threads and across the separate ``main.py``
+processes started by the deployer.
+
+When the state file does not exist yet it is seeded from the ports already
+bound by Docker containers (running or stopped) and, when a database
+connection is available, from TB_Port_Mappings for the node.
+
+Ports of containers removed outside the spawn paths (deleted instances,
+trimmed pool containers after a crash) are recovered by ``reconcile``:
+long-running services call it every PORT_RECONCILE_INTERVAL seconds with
+the ports Docker and TB_Port_Mappings still use, and ports found unused on
+two passes in a row go back to the free list.
+
+Usage on a node:
+    python3 port_allocator.py stats
+    python3 port_allocator.py reseed <node_id>
+"""
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from array import array
+
+logger = logging.getLogger(__name__)
+
+PORT_RANGE_START = int(os.getenv('PORT_RANGE_START', '10000'))
+PORT_RANGE_END = int(os.getenv('PORT_RANGE_END', '11500'))
+STATE_PATH = os.getenv('PORT_STATE_PATH', '/tmp/microcloud_ports.bin')
+RECONCILE_INTERVAL = float(os.getenv('PORT_RECONCILE_INTERVAL', '600'))
+
+# magic, range start, range size, free count, exhaustion count, skipped-busy count
+_HEADER = struct.Struct('<4sIIIII')
+_MAGIC = b'MCPA'
+
+
+class PortsExhaustedError(Exception):
+    pass
+
+
+def is_port_free(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        return s.connect_ex(('localhost', port)) != 0
+
+
+def docker_bound_ports(client):
+    """Host ports bound by any container on the node, including stopped ones."""
+    used = set()
+    for container in client.containers.list(all=True):
+        bindings = container.attrs['HostConfig'].get('PortBindings') or {}
+        for entries in bindings.values():
+            for entry in entries or []:
+                if entry.get('HostPort'):
+                    used.add(int(entry['HostPort']))
+    return used
+
+
+def db_mapped_ports(connection, node_id):
+    """External ports recorded in TB_Port_Mappings for instances on a node."""
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT pm.external_port FROM TB_Port_Mappings pm "
+        "JOIN TB_Instances i ON i.instance_id = pm.instance_id WHERE i.node_id = ?",
+        (node_id,))
+    return {row.external_port for row in cursor.fetchall()}
+
+
+def used_ports(client, node_id=None):
+    """Ports bound by Docker plus, when the node is known, those in TB_Port_Mappings."""
+    used = docker_bound_ports(client)
+    if node_id is not None:
+        import db
+
+        with db.get_pool().connection() as connection:
+            used |= db_mapped_ports(connection, node_id)
+    return used
+
+
+class _State:
+    def __init__(self, start, size):
+        self.start = start
+        self.size = size
+        self.bitmap = bytearray((size + 7) // 8)
+        self.free = array('H', range(size - 1, -1, -1))  # lowest port on top
+        self.exhausted = 0
+        self.skipped_busy = 0
+
+    def is_used(self, index):
+        return self.bitmap[index >> 3] & (1 << (index & 7))
+
+    def set_used(self, index, used):
+        if used:
+            self.bitmap[index >> 3] |= 1 << (index & 7)
+        else:
+            self.bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+    def used_count(self):
+        return bin(int.from_bytes(self.bitmap, 'little')).count('1')
+
+    def rebuild_free(self):
+        self.free = array('H', (i for i in range(self.size - 1, -1, -1) if not self.is_used(i)))
+
+    def dump(self):
+        header = _HEADER.pack(_MAGIC, self.start, self.size, len(self.free), self.exhausted, self.skipped_busy)
+        return header + bytes(self.bitmap) + self.free.tobytes()
+
+    @classmethod
+    def load(cls, data, start, size):
+        magic, saved_start, saved_size, free_count, exhausted, skipped = _HEADER.unpack_from(data)
+        if magic != _MAGIC or saved_start != start or saved_size != size:
+            return None
+        state = cls(start, size)
+        offset = _HEADER.size
+        state.bitmap = bytearray(data[offset:offset + len(state.bitmap)])
+        offset += len(state.bitmap)
+        state.free = array('H')
+        state.free.frombytes(data[offset:offset + free_count * 2])
+        state.exhausted = exhausted
+        state.skipped_busy = skipped
+        return state
+
+
+class PortAllocator:
+    """Allocate and free external ports in [start, end] for this node.
+
+    ``seed`` is called (without arguments) the first time the state file is
+    created and must return the ports already in use.
+    """
+
+    _thread_lock = threading.Lock()
+
+    def __init__(self, start=PORT_RANGE_START, end=PORT_RANGE_END, state_path=STATE_PATH, seed=None):
+        self.start = start
+        self.size = end - start + 1
+        self.state_path = state_path
+        self.seed = seed
+        self._unused = set()  # indexes marked used but unused on the last reconcile
+
+    def _transaction(self, fn):
+        with self._thread_lock:
+            fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), 'r+b') as f:
+                    data = f.read()
+                    state = _State.load(data, self.start, self.size) if len(data) >= _HEADER.size else None
+                    if state is None:
+                        state = _State(self.start, self.size)
+                        for port in (self.seed() if self.seed else ()):
+                            if self.start <= port < self.start + self.size:
+                                state.set_used(port - self.start, True)
+                        state.rebuild_free()
+                    try:
+                        return fn(state)
+                    finally:
+                        f.seek(0)
+                        f.write(state.dump())
+                        f.truncate()
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    def allocate(self, count):
+        """Reserve ``count`` free ports and return them."""
+        def take(state):
+            ports = []
+            while len(ports) < count:
+                if not state.free:
+                    for port in ports:
+                        index = port - state.start
+                        state.set_used(index, False)
+                        state.free.append(index)
+                    state.exhausted += 1
+                    raise PortsExhaustedError(
+                        f"Port range {state.start}-{state.start + state.size - 1} exhausted")
+                index = state.free.pop()
+                if state.is_used(index):
+                    continue  # stale stack entry
+                state.set_used(index, True)
+                port = state.start + index
+                if not is_port_free(port):
+                    # Bound by something we did not hand out; keep it marked used
+                    state.skipped_busy += 1
+                    continue
+                ports.append(port)
+            return ports
+        return self._transaction(take)
+
+    def free(self, ports):
+        """Return ports to the pool; ports outside the range or already free are ignored."""
+        def release(state):
+            for port in ports:
+                index = port - state.start
+                if 0 <= index < state.size and state.is_used(index):
+                    state.set_used(index, False)
+                    state.free.append(index)
+        self._transaction(release)
+
+    def reseed(self, used):
+        """Replace the state with exactly ``used`` marked as taken."""
+        def reset(state):
+            state.bitmap = bytearray(len(state.bitmap))
+            for port in used:
+                index = port - state.start
+                if 0 <= index < state.size:
+                    state.set_used(index, True)
+            state.rebuild_free()
+        self._transaction(reset)
+
+    def reconcile(self, used):
+        """Bring the state in line with ``used``, the ports actually in use; returns the ports freed.
+
+        Ports in ``used`` are marked taken. A taken port missing from
+        ``used`` is only freed when it was also missing on the previous
+        call, so ports handed out for a spawn that hasn't bound them yet
+        survive one pass.
+        """
+        def sweep(state):
+            marked = False
+            for port in used:
+                index = port - state.start
+                if 0 <= index < state.size and not state.is_used(index):
+                    state.set_used(index, True)
+                    marked = True
+            if marked:
+                # Drop the newly taken ports from the free stack
+                state.rebuild_free()
+            unused = {i for i in range(state.size) if state.is_used(i) and state.start + i not in used}
+            freed = sorted(unused & self._unused)
+            for index in freed:
+                state.set_used(index, False)
+                state.free.append(index)
+            self._unused = unused - set(freed)
+            return [state.start + index for index in freed]
+        return self._transaction(sweep)
+
+    def stats(self):
+        def collect(state):
+            used = state.used_count()
+            return {
+                'range': [state.start, state.start + state.size - 1],
+                'total': state.size,
+                'used': used,
+                'free': state.size - used,
+                'utilisation': round(used / state.size, 4),
+                'exhausted_count': state.exhausted,
+                'skipped_busy_count': state.skipped_busy,
+            }
+        return self._transaction(collect)
+
+
+def start_reconciler(allocator, used, interval=RECONCILE_INTERVAL):
+    """Call ``allocator.reconcile(used())`` every ``interval`` seconds in a daemon thread."""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                freed = allocator.reconcile(used())
+                if freed:
+                    logger.info("Reclaimed %d unused port(s)", len(freed))
+            except Exception as e:
+                logger.error("Port reconcile failed: %s", e)
+
+    thread = threading.Thread(target=run, name='port-reconcile', daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or reseed the node port allocator.")
+    parser.add_argument('command', choices=['stats', 'reseed'])
+    parser.add_argument('node_id', type=int, nargs='?', help='Node ID (reseed also reads TB_Port_Mappings)')
+    args = parser.parse_args()
+
+    allocator = PortAllocator()
+    if args.command == 'reseed':
+        import docker
+
+        allocator.reseed(used_ports(docker.from_env(), args.node_id))
+    print(json.dumps(allocator.stats(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Prometheus text exposition for the Flask services.
+
+Each service builds an ``Exposition`` on every scrape from the stats its
+components already keep (DB pool, SSH pool, catalog cache, job queue,
+tracing histograms)
+and returns it from ``/metrics``. ``instrument(app)`` adds request counts
+and latencies per route.
+
+Labels are kept to bounded sets: the route *pattern* rather than the path,
+the HTTP method and status code, node IPs from TB_Nodes, and phase names.
+"""
+
+import threading
+import time
+
+from flask import Response, g, request
+
+import tracing
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class Exposition:
+    def __init__(self):
+        self._families = {}  # name -> (type, help, [(suffix, labels, value)])
+
+    def _family(self, name, kind, help_text):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = (kind, help_text, [])
+        return family[2]
+
+    def counter(self, name, help_text, value, labels=None):
+        self._family(name, 'counter', help_text).append(('', labels or {}, value))
+
+    def gauge(self, name, help_text, value, labels=None):
+        self._family(name, 'gauge', help_text).append(('', labels or {}, value))
+
+    def histogram(self, name, help_text, histogram, labels=None):
+        """Add a histogram given as ``tracing.Histogram.as_dict()``."""
+        samples = self._family(name, 'histogram', help_text)
+        labels = labels or {}
+        for bound, count in histogram['buckets']:
+            samples.append(('_bucket', {**labels, 'le': bound if bound == '+Inf' else repr(float(bound))}, count))
+        samples.append(('_sum', labels, histogram['sum']))
+        samples.append(('_count', labels, histogram['count']))
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text, samples) in self._families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def response(self):
+        return Response(self.render(), content_type=CONTENT_TYPE)
+
+
+_requests = {}  # (route, method, status) -> count
+_latency = {}  # (route, method) -> tracing.Histogram
+_lock = threading.Lock()
+
+
+def instrument(app):
+    """Count and time every request of ``app`` by route pattern."""
+
+    @app.before_request
+    def _start_timer():
+        g._prometheus_started = time.monotonic()
+
+    @app.after_request
+    def _record(response):
+        started = getattr(g, '_prometheus_started', None)
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        with _lock:
+            key = (route, request.method, str(response.status_code))
+            _requests[key] = _requests.get(key, 0) + 1
+            if started is not None:
+                histogram = _latency.get((route, request.method))
+                if histogram is None:
+                    histogram = _latency[(route, request.method)] = tracing.Histogram()
+                histogram.observe(time.monotonic() - started)
+        return response
+
+    return app
+
+
+def add_request_metrics(exposition):
+    with _lock:
+        requests = sorted(_requests.items())
+        latency = [(key, histogram.as_dict()) for key, histogram in sorted(_latency.items())]
+    for (route, method, status), count in requests:
+        exposition.counter('microcloud_http_requests_total', 'HTTP requests handled.', count,
+                           {'route': route, 'method': method, 'status': status})
+    for (route, method), histogram in latency:
+        exposition.histogram('microcloud_http_request_duration_seconds', 'HTTP request latency.', histogram,
+                             {'route': route, 'method': method})
+
+
+def add_db_pool_metrics(exposition, stats):
+    exposition.gauge('microcloud_db_pool_in_use', 'Connections checked out of the pool.', stats['in_use'])
+    exposition.gauge('microcloud_db_pool_idle', 'Idle connections in the pool.', stats['idle'])
+    exposition.gauge('microcloud_db_pool_max_size', 'Pool size limit.', stats['max_size'])
+    for key in ('checkouts', 'created', 'recycled', 'health_check_failures', 'timeouts'):
+        exposition.counter(f'microcloud_db_pool_{key}_total', f'Pool {key.replace("_", " ")}.', stats[key])
+    exposition.counter('microcloud_db_pool_wait_seconds_total', 'Time spent waiting for a connection.',
+                       stats['wait_seconds_total'])
+
+
+def add_ssh_pool_metrics(exposition, stats):
+    for key in ('connects', 'reconnects', 'commands', 'requests', 'channel_waits'):
+        exposition.counter(f'microcloud_ssh_{key}_total', f'SSH pool {key.replace("_", " ")}.', stats[key])
+    for node_ip, node in stats['nodes'].items():
+        exposition.gauge('microcloud_ssh_node_connected', 'Whether the node connection is up.',
+                         1 if node['connected'] else 0, {'node': node_ip})
+        exposition.gauge('microcloud_ssh_node_channels_in_use', 'Open channels to the node.',
+                         node['channels_in_use'], {'node': node_ip})
+
+
+def add_catalog_metrics(exposition, stats):
+    for name, catalog in stats.items():
+        labels = {'catalog': name}
+        for key in ('hits', 'misses', 'loads', 'invalidations'):
+            exposition.counter(f'microcloud_catalog_{key}_total', f'Catalog cache {key}.', catalog[key], labels)
+        exposition.gauge('microcloud_catalog_entries', 'Entries held by the catalog cache.', catalog['entries'], labels)
+
+
+def add_trace_metrics(exposition):
+    for operation, phases in tracing.histograms().items():
+        for phase, histogram in phases.items():
+            exposition.histogram('microcloud_phase_duration_seconds', 'Spawn and deploy phase latency.',
+                                 histogram, {'operation': operation, 'phase': phase})
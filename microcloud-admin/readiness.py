@@ -0,0 +1,58 @@
+"""Wait for a freshly started container to accept SSH.
+
+Instead of sleeping a fixed amount after ``containers.run``, probe the
+mapped SSH port until sshd sends its banner. Probes back off exponentially
+up to a cap and give up at a deadline.
+"""
+
+import logging
+import os
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+READY_TIMEOUT = float(os.getenv('SSH_READY_TIMEOUT', '60'))
+
+
+class NotReadyError(Exception):
+    pass
+
+
+def probe_ssh_banner(host, port, timeout=1.0):
+    """True if something on host:port answers with an SSH identification string."""
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as s:
+            s.settimeout(timeout)
+            return s.recv(64).startswith(b'SSH-')
+    except OSError:
+        return False
+
+
+def wait_for_ssh(host, port, timeout=READY_TIMEOUT, initial_delay=0.05, max_delay=1.0, container=None):
+    """Block until host:port serves an SSH banner; return the seconds it took.
+
+    When a container is given, its state is checked between probes so a
+    container that exits during start-up fails fast instead of running out
+    the clock. Raises NotReadyError at the deadline.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    delay = initial_delay
+    while True:
+        remaining = deadline - time.monotonic()
+        if probe_ssh_banner(host, port, timeout=max(0.1, min(1.0, remaining))):
+            elapsed = time.monotonic() - start
+            logger.info("SSH on %s:%s ready after %.3fs", host, port, elapsed)
+            return elapsed
+
+        if container is not None:
+            container.reload()
+            if container.status in ('exited', 'dead'):
+                raise NotReadyError(f"Container {container.short_id} {container.status} before SSH came up")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise NotReadyError(f"SSH on {host}:{port} not ready after {timeout:g}s")
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
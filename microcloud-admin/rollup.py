@@ -0,0 +1,316 @@
+"""Downsampled rollups and retention for TB_Instance_Metrics.
+
+Raw 5 s samples are compacted into 1-minute and 1-hour rollup tables with
+min/avg/max/p95 of cpu_percent, mem_usage and mem_percent per container and
+bucket. Both tiers are built from the raw rows (a p95 can't be rebuilt from
+finer p95s), so raw rows are only purged once every tier has compacted past
+them. Each tier keeps its own retention, and old rows are deleted in
+batches so the purge never holds long locks on the live table.
+
+Compaction only covers buckets that ended more than ROLLUP_LATENESS seconds
+ago, leaving time for buffered ingest to land. Stretches without raw rows
+(a node that was off, ingest disabled) are skipped rather than walked
+through, so a gap longer than ROLLUP_MAX_SPAN_HOURS can't stall it. When several nodes run the
+job, a SQL Server application lock makes sure only one compacts at a time.
+
+    python3 rollup.py init      # create the rollup tables
+    python3 rollup.py run       # compact and purge once
+    python3 rollup.py status
+"""
+
+import argparse
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+RAW_TABLE = 'TB_Instance_Metrics'
+RAW_RETENTION = timedelta(hours=float(os.getenv('METRICS_RAW_RETENTION_HOURS', '48')))
+LATENESS = timedelta(seconds=float(os.getenv('ROLLUP_LATENESS', '60')))
+PURGE_BATCH = int(os.getenv('ROLLUP_PURGE_BATCH', '5000'))
+# Upper bound on how much raw data one run compacts, so catching up after
+# downtime happens over several runs instead of one huge statement
+MAX_SPAN = timedelta(hours=float(os.getenv('ROLLUP_MAX_SPAN_HOURS', '6')))
+RUN_INTERVAL = float(os.getenv('ROLLUP_INTERVAL', '60'))
+
+FIELDS = ('cpu_percent', 'mem_usage', 'mem_percent')
+
+
+class Tier:
+    def __init__(self, name, table, datepart, step, retention):
+        self.name = name
+        self.table = table
+        self.datepart = datepart  # T-SQL DATEDIFF unit for the bucket
+        self.step = step
+        self.retention = retention
+
+    def bucket(self, ts):
+        """Start of the bucket containing ``ts``."""
+        if self.datepart == 'hour':
+            return ts.replace(minute=0, second=0, microsecond=0)
+        return ts.replace(second=0, microsecond=0)
+
+
+TIERS = [
+    Tier('1m', 'TB_Instance_Metrics_1m', 'minute', timedelta(minutes=1),
+         timedelta(days=float(os.getenv('ROLLUP_1M_RETENTION_DAYS', '14')))),
+    Tier('1h', 'TB_Instance_Metrics_1h', 'hour', timedelta(hours=1),
+         timedelta(days=float(os.getenv('ROLLUP_1H_RETENTION_DAYS', '400')))),
+]
+
+
+def _stat_columns():
+    return ',\n'.join(
+        f"{f}_min FLOAT, {f}_avg FLOAT, {f}_max FLOAT, {f}_p95 FLOAT" for f in FIELDS)
+
+
+def create_tables(connection):
+    """Create the rollup tables and their indexes if they don't exist."""
+    cursor = connection.cursor()
+    for tier in TIERS:
+        cursor.execute(f"""
+            IF OBJECT_ID('{tier.table}', 'U') IS NULL
+            BEGIN
+                CREATE TABLE {tier.table} (
+                    container_id VARCHAR(64) NOT NULL,
+                    bucket DATETIME NOT NULL,
+                    samples INT NOT NULL,
+                    {_stat_columns()},
+                    CONSTRAINT PK_{tier.table} PRIMARY KEY (container_id, bucket)
+                );
+                CREATE INDEX IX_{tier.table}_bucket ON {tier.table} (bucket);
+            END
+        """)
+    cursor.execute(f"""
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_{RAW_TABLE}_timestamp')
+            CREATE INDEX IX_{RAW_TABLE}_timestamp ON {RAW_TABLE} (timestamp)
+    """)
+    connection.commit()
+
+
+def _compact_sql(tier):
+    bucket = f"DATEADD({tier.datepart}, DATEDIFF({tier.datepart}, 0, timestamp), 0)"
+    aggregates = ',\n'.join(
+        f"MIN(w.{f}), AVG(w.{f}), MAX(w.{f}), p.{f}_p95" for f in FIELDS)
+    percentiles = ',\n'.join(
+        f"PERCENTILE_CONT(0.95) WITHIN GROUP (ORDER BY {f}) OVER (PARTITION BY container_id, bucket) AS {f}_p95"
+        for f in FIELDS)
+    columns = ', '.join(f"{f}_min, {f}_avg, {f}_max, {f}_p95" for f in FIELDS)
+    p95s = ', '.join(f"p.{f}_p95" for f in FIELDS)
+    # PERCENTILE_CONT is only available as a window function, hence the
+    # DISTINCT subquery joined back onto the grouped rows
+    return f"""
+        WITH w AS (
+            SELECT container_id, {bucket} AS bucket, {', '.join(FIELDS)}
+            FROM {RAW_TABLE}
+            WHERE timestamp >= ? AND timestamp < ?
+        ), p AS (
+            SELECT DISTINCT container_id, bucket,
+                {percentiles}
+            FROM w
+        )
+        INSERT INTO {tier.table} (container_id, bucket, samples, {columns})
+        SELECT w.container_id, w.bucket, COUNT(*),
+            {aggregates}
+        FROM w JOIN p ON p.container_id = w.container_id AND p.bucket = w.bucket
+        GROUP BY w.container_id, w.bucket, {p95s}
+    """
+
+
+# Owned by the session rather than a transaction: a pooled connection has
+# none open when the lock is taken, and compact() commits in between
+def _acquire_lock(cursor):
+    cursor.execute("""
+        DECLARE @result INT;
+        EXEC @result = sp_getapplock @Resource = 'microcloud_metrics_rollup', @LockMode = 'Exclusive',
+                                     @LockOwner = 'Session', @LockTimeout = 0;
+        SELECT @result;
+    """)
+    return cursor.fetchone()[0] >= 0
+
+
+def _release_lock(cursor):
+    cursor.execute("EXEC sp_releaseapplock @Resource = 'microcloud_metrics_rollup', @LockOwner = 'Session'")
+
+
+def _watermark(cursor, tier):
+    """End of the last compacted bucket, or None before the first run."""
+    cursor.execute(f"SELECT MAX(bucket) FROM {tier.table}")
+    last = cursor.fetchone()[0]
+    return last + tier.step if last is not None else None
+
+
+def _next_sample(cursor, start):
+    """Timestamp of the first raw row at or after ``start`` (of any row when None)."""
+    if start is None:
+        cursor.execute(f"SELECT MIN(timestamp) FROM {RAW_TABLE}")
+    else:
+        cursor.execute(f"SELECT MIN(timestamp) FROM {RAW_TABLE} WHERE timestamp >= ?", (start,))
+    return cursor.fetchone()[0]
+
+
+def window(tier, watermark, next_sample, now):
+    """``(start, end)`` of the buckets the next compaction covers, or None.
+
+    Starts at the bucket of the next raw sample when that's past the
+    watermark, so empty stretches are jumped over in one step.
+    """
+    if next_sample is None:
+        return None
+    start = tier.bucket(next_sample) if watermark is None else max(watermark, tier.bucket(next_sample))
+    end = min(tier.bucket(now - LATENESS), tier.bucket(start + MAX_SPAN))
+    return (start, end) if end > start else None
+
+
+def compact(connection):
+    """Roll complete buckets up into every tier; returns rows written per tier."""
+    cursor = connection.cursor()
+    if not _acquire_lock(cursor):
+        connection.rollback()
+        logger.debug("Another node is compacting metrics, skipping")
+        return None
+    written = {}
+    try:
+        cursor.execute("SELECT GETDATE()")
+        now = cursor.fetchone()[0]
+        for tier in TIERS:
+            watermark = _watermark(cursor, tier)
+            span = window(tier, watermark, _next_sample(cursor, watermark), now)
+            if span is None:
+                written[tier.name] = 0
+                continue
+            cursor.execute(_compact_sql(tier), span)
+            written[tier.name] = cursor.rowcount
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        _release_lock(cursor)
+    return written
+
+
+def _purge_table(connection, table, column, cutoff):
+    cursor = connection.cursor()
+    deleted = 0
+    while True:
+        cursor.execute(f"DELETE TOP (?) FROM {table} WHERE {column} < ?", (PURGE_BATCH, cutoff))
+        count = cursor.rowcount
+        connection.commit()
+        deleted += count
+        if count < PURGE_BATCH:
+            return deleted
+
+
+def purge(connection):
+    """Delete rows past each tier's retention; returns rows deleted per table."""
+    cursor = connection.cursor()
+    cursor.execute("SELECT GETDATE()")
+    now = cursor.fetchone()[0]
+
+    # Raw rows go only once every tier has been built past them
+    cutoff = now - RAW_RETENTION
+    for tier in TIERS:
+        cursor.execute(f"SELECT MAX(bucket) FROM {tier.table}")
+        last = cursor.fetchone()[0]
+        cutoff = min(cutoff, last + tier.step) if last is not None else None
+        if cutoff is None:
+            break
+    connection.commit()
+
+    deleted = {RAW_TABLE: _purge_table(connection, RAW_TABLE, 'timestamp', cutoff) if cutoff else 0}
+    for tier in TIERS:
+        deleted[tier.table] = _purge_table(connection, tier.table, 'bucket', now - tier.retention)
+    return deleted
+
+
+def run(pool):
+    """One compaction and purge pass."""
+    with pool.connection() as connection:
+        written = compact(connection)
+        if written is None:
+            return None
+        deleted = purge(connection)
+    logger.info("Metrics rollup: wrote %s, purged %s", written, deleted)
+    return {'written': written, 'deleted': deleted}
+
+
+def pick_tier(start, end, now=None, max_points=500):
+    """Finest tier that still holds ``start`` and returns at most ``max_points``.
+
+    Returns None for the raw table. ``start``, ``end`` and ``now`` are naive
+    datetimes in database time.
+    """
+    now = now or datetime.now()
+    span = end - start
+    if start >= now - RAW_RETENTION and span <= timedelta(seconds=5 * max_points):
+        return None
+    for tier in TIERS:
+        if start >= now - tier.retention and span / tier.step <= max_points:
+            return tier
+    return TIERS[-1]
+
+
+def query(connection, container_id, start, end, max_points=500):
+    """Samples of one container between ``start`` and ``end`` from the best tier.
+
+    Returns ``(tier_name, rows)``; raw rows are reported with their sample
+    value as min, avg, max and p95 so every tier has the same shape.
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT GETDATE()")
+    tier = pick_tier(start, end, cursor.fetchone()[0], max_points)
+    if tier is None:
+        stats = ', '.join(
+            f"{f} AS {f}_min, {f} AS {f}_avg, {f} AS {f}_max, {f} AS {f}_p95" for f in FIELDS)
+        cursor.execute(f"""
+            SELECT timestamp AS bucket, 1 AS samples, {stats}
+            FROM {RAW_TABLE}
+            WHERE container_id = ? AND timestamp >= ? AND timestamp < ?
+            ORDER BY timestamp
+        """, (container_id[:12], start, end))
+        name = 'raw'
+    else:
+        cursor.execute(f"""
+            SELECT * FROM {tier.table}
+            WHERE container_id = ? AND bucket >= ? AND bucket < ?
+            ORDER BY bucket
+        """, (container_id[:12], tier.bucket(start), end))
+        name = tier.name
+    columns = [c[0] for c in cursor.description]
+    return name, [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def status(connection):
+    cursor = connection.cursor()
+    result = {}
+    for table, column in [(RAW_TABLE, 'timestamp')] + [(t.table, 'bucket') for t in TIERS]:
+        cursor.execute(f"SELECT COUNT_BIG(*), MIN({column}), MAX({column}) FROM {table}")
+        count, first, last = cursor.fetchone()
+        result[table] = {'rows': count, 'first': str(first), 'last': str(last)}
+    return result
+
+
+def main():
+    import db
+
+    parser = argparse.ArgumentParser(description="Compact and purge instance metrics.")
+    parser.add_argument('command', choices=['init', 'run', 'status'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'init':
+        with db.get_pool().connection() as connection:
+            create_tables(connection)
+        print("Rollup tables ready")
+    elif args.command == 'run':
+        print(json.dumps(run(db.get_pool()), indent=2))
+    else:
+        with db.get_pool().connection() as connection:
+            print(json.dumps(status(connection), indent=2))
+
+
+if __name__ == '__main__':
+    main()
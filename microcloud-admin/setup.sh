@@ -18,6 +18,10 @@ echo "Installing unixODBC development headers..."
 sudo apt-get install -y unixodbc-dev
 echo "Installing required Python packages..."
 pip3 install --upgrade pip
-pip3 install pyodbc docker python-dotenv requests
+pip3 install pyodbc docker python-dotenv requests flask numpy
+echo "Warming the instance base image cache..."
+sudo python3 image_cache.py warm
+echo "Start the node agent with: sudo python3 agent.py (deploys fall back to main.py without it)"
 echo "Setup complete! Please update the .env file with your database credentials."
+echo "Then prepare the metrics tables with: python3 ingest.py init && python3 rollup.py init"
 echo "Note: You may need to log out and log back in for Docker group changes to take effect."
\ No newline at end of file
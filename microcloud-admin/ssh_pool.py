@@ -0,0 +1,261 @@
+"""Pooled, keepalive SSH connections from the deployer to the nodes.
+
+``~/.ssh/config`` is parsed once. The node IP -> SSH alias table is built
+from the node IPs in TB_Nodes matched against the ``HostName`` entries of
+the SSH config, and refreshed every SSH_ALIAS_TTL seconds. Nodes without an
+alias are reached directly on their IP and TB_Nodes.node_ssh_port.
+
+One transport is kept open per node with keepalives. Commands run on new
+channels of that transport, limited to SSH_MAX_CHANNELS_PER_NODE at once.
+A dead transport is reconnected transparently.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import paramiko
+
+logger = logging.getLogger(__name__)
+
+SSH_CONFIG_PATH = os.path.expanduser(os.getenv('SSH_CONFIG_PATH', '~/.ssh/config'))
+CONNECT_TIMEOUT = float(os.getenv('SSH_CONNECT_TIMEOUT', '10'))
+COMMAND_TIMEOUT = float(os.getenv('SSH_COMMAND_TIMEOUT', '300'))
+KEEPALIVE_INTERVAL = int(os.getenv('SSH_KEEPALIVE_INTERVAL', '30'))
+MAX_CHANNELS_PER_NODE = int(os.getenv('SSH_MAX_CHANNELS_PER_NODE', '4'))
+ALIAS_TTL = float(os.getenv('SSH_ALIAS_TTL', '300'))
+
+
+class ServiceUnavailableError(Exception):
+    pass
+
+
+def _parse_response(response, node_ip, port):
+    """``(status_code, parsed_json_body)`` from a raw HTTP/1.0 response.
+
+    An empty or truncated response means the service went away mid-request,
+    which is reported as ServiceUnavailableError like a refused channel.
+    """
+    header, separator, content = response.partition(b'\r\n\r\n')
+    lines = header.split(b'\r\n')
+    status_line = lines[0].split(b' ', 2)
+    if not separator or len(status_line) < 2 or not status_line[1].isdigit():
+        raise ServiceUnavailableError(
+            f"Empty or truncated response from {node_ip}:{port} ({len(response)} bytes)")
+    for line in lines[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length' and len(content) < int(value):
+            raise ServiceUnavailableError(
+                f"Truncated response from {node_ip}:{port} ({len(content)} of {int(value)} body bytes)")
+    return int(status_line[1]), json.loads(content) if content else None
+
+
+class _Node:
+    def __init__(self, max_channels):
+        self.lock = threading.Lock()
+        self.channels = threading.BoundedSemaphore(max_channels)
+        self.client = None
+        self.in_use = 0
+
+
+class SSHPool:
+    def __init__(self, node_loader, config_path=SSH_CONFIG_PATH, max_channels_per_node=MAX_CHANNELS_PER_NODE,
+                 connect_timeout=CONNECT_TIMEOUT, command_timeout=COMMAND_TIMEOUT,
+                 keepalive_interval=KEEPALIVE_INTERVAL, alias_ttl=ALIAS_TTL):
+        # node_loader() returns [(node_ip, node_ssh_port), ...] from TB_Nodes
+        self.node_loader = node_loader
+        self.max_channels_per_node = max_channels_per_node
+        self.connect_timeout = connect_timeout
+        self.command_timeout = command_timeout
+        self.keepalive_interval = keepalive_interval
+        self.alias_ttl = alias_ttl
+
+        if not os.path.exists(config_path):
+            raise Exception(f"No SSH config found at {config_path}")
+        self.ssh_config = paramiko.SSHConfig.from_path(config_path)
+
+        self._nodes = {}
+        self._nodes_lock = threading.Lock()
+        self._aliases = {}
+        self._ports = {}
+        self._aliases_loaded_at = 0.0
+        self._aliases_lock = threading.Lock()
+        self._stats = {'connects': 0, 'reconnects': 0, 'commands': 0, 'requests': 0, 'channel_waits': 0}
+
+    def _hostname_aliases(self):
+        aliases = {}
+        for alias in self.ssh_config.get_hostnames():
+            if any(c in alias for c in '*?!'):
+                continue
+            hostname = self.ssh_config.lookup(alias).get('hostname', alias)
+            aliases.setdefault(hostname, alias)
+        return aliases
+
+    def refresh_aliases(self):
+        """Rebuild the node IP -> alias table from TB_Nodes and the SSH config."""
+        by_hostname = self._hostname_aliases()
+        aliases, ports = {}, {}
+        for node_ip, node_ssh_port in self.node_loader():
+            if node_ip in by_hostname:
+                aliases[node_ip] = by_hostname[node_ip]
+            ports[node_ip] = node_ssh_port
+        with self._aliases_lock:
+            self._aliases, self._ports = aliases, ports
+            self._aliases_loaded_at = time.monotonic()
+        return aliases
+
+    def _host_settings(self, node_ip):
+        with self._aliases_lock:
+            stale = time.monotonic() - self._aliases_loaded_at > self.alias_ttl
+        if stale:
+            self.refresh_aliases()
+        with self._aliases_lock:
+            alias = self._aliases.get(node_ip)
+            node_port = self._ports.get(node_ip)
+
+        host_conf = self.ssh_config.lookup(alias or node_ip)
+        identityfile = host_conf.get('identityfile', None)
+        if identityfile and isinstance(identityfile, list):
+            identityfile = identityfile[0]
+        return {
+            'hostname': host_conf.get('hostname', node_ip),
+            'port': int(host_conf.get('port') or node_port or 22),
+            'username': host_conf.get('user', 'ubuntu'),  # Default if not specified in config
+            'key_filename': identityfile,
+        }
+
+    def _node(self, node_ip):
+        with self._nodes_lock:
+            if node_ip not in self._nodes:
+                self._nodes[node_ip] = _Node(self.max_channels_per_node)
+            return self._nodes[node_ip]
+
+    def _client(self, node_ip, node):
+        """The node's connected client, (re)connecting if the transport is gone."""
+        with node.lock:
+            transport = node.client.get_transport() if node.client else None
+            if transport is not None and transport.is_active():
+                return node.client
+            if node.client is not None:
+                logger.info("SSH transport to %s is down, reconnecting", node_ip)
+                node.client.close()
+                self._stats['reconnects'] += 1
+
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(
+                timeout=self.connect_timeout,
+                banner_timeout=self.connect_timeout,
+                auth_timeout=self.connect_timeout,
+                **self._host_settings(node_ip),
+            )
+            client.get_transport().set_keepalive(self.keepalive_interval)
+            node.client = client
+            self._stats['connects'] += 1
+            return client
+
+    def _acquire(self, node):
+        if not node.channels.acquire(blocking=False):
+            self._stats['channel_waits'] += 1
+            node.channels.acquire()
+        node.in_use += 1
+
+    def _release(self, node):
+        node.in_use -= 1
+        node.channels.release()
+
+    def run(self, node_ip, command, timeout=None):
+        """Run a command on a node; returns ``(exit_status, stdout, stderr)``."""
+        node = self._node(node_ip)
+        self._acquire(node)
+        try:
+            for attempt in range(2):
+                client = self._client(node_ip, node)
+                try:
+                    _, stdout, stderr = client.exec_command(command, timeout=timeout or self.command_timeout)
+                    break
+                except (paramiko.SSHException, EOFError, OSError):
+                    # Stale transport; drop it and retry once on a fresh connection
+                    if attempt:
+                        raise
+                    with node.lock:
+                        client.close()
+            output = stdout.read().decode('utf-8', errors='replace')
+            error = stderr.read().decode('utf-8', errors='replace')
+            exit_status = stdout.channel.recv_exit_status()
+            self._stats['commands'] += 1
+            return exit_status, output, error
+        finally:
+            self._release(node)
+
+    def request(self, node_ip, method, path, body=None, port=7070, timeout=None):
+        """Make an HTTP request to a service listening on the node's loopback.
+
+        The request travels over a direct-tcpip channel of the node's pooled
+        transport. Returns ``(status_code, parsed_json_body)``; raises
+        ServiceUnavailableError when nothing is listening or the response
+        comes back empty or truncated.
+        """
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        head = (
+            f"{method} {path} HTTP/1.0\r\n"
+            f"Host: 127.0.0.1:{port}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode('ascii')
+
+        node = self._node(node_ip)
+        self._acquire(node)
+        try:
+            for attempt in range(2):
+                transport = self._client(node_ip, node).get_transport()
+                try:
+                    channel = transport.open_channel(
+                        'direct-tcpip', ('127.0.0.1', port), ('127.0.0.1', 0), timeout=self.connect_timeout)
+                    break
+                except paramiko.ChannelException as e:
+                    raise ServiceUnavailableError(f"Nothing listening on {node_ip}:{port}") from e
+                except (paramiko.SSHException, EOFError, OSError):
+                    if attempt:
+                        raise
+                    with node.lock:
+                        node.client.close()
+            try:
+                channel.settimeout(timeout or self.command_timeout)
+                channel.sendall(head + payload)
+                chunks = []
+                while True:
+                    chunk = channel.recv(65536)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+            finally:
+                channel.close()
+            self._stats['requests'] += 1
+        finally:
+            self._release(node)
+
+        return _parse_response(b''.join(chunks), node_ip, port)
+
+    def stats(self):
+        with self._nodes_lock:
+            nodes = dict(self._nodes)
+        stats = dict(self._stats)
+        stats['nodes'] = {
+            ip: {
+                'connected': bool(n.client and n.client.get_transport() and n.client.get_transport().is_active()),
+                'channels_in_use': n.in_use,
+            }
+            for ip, n in nodes.items()
+        }
+        return stats
+
+    def close(self):
+        with self._nodes_lock:
+            for node in self._nodes.values():
+                if node.client is not None:
+                    node.client.close()
+            self._nodes.clear()
@@ -0,0 +1,229 @@
+"""Streaming per-container resource stats from the Docker API.
+
+Instead of forking ``docker stats --no-stream`` every tick (which blocks for
+the CLI's CPU sampling window and returns display strings), the collector
+keeps one streaming stats connection open per running container and keeps
+the latest raw counters. CPU percent, memory and I/O figures are computed
+here from the numeric counters. A Docker events listener starts streams for
+containers that start or unpause, and closes the stream of a container
+that dies, stops, pauses or is destroyed (its stream would otherwise keep
+sending zeroed frames) and forgets its last sample.
+
+``RateTracker`` turns the cumulative network and block I/O byte counters
+into per-second rates, computed for all containers of a tick at once.
+"""
+
+import logging
+import threading
+import time
+
+import docker
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def human_size(num_bytes):
+    """Format bytes like the docker CLI does (decimal units), e.g. ``1.2kB``."""
+    value = float(num_bytes)
+    for unit in ('B', 'kB', 'MB', 'GB', 'TB'):
+        if value < 1000 or unit == 'TB':
+            return f"{value:.3g}{unit}"
+        value /= 1000
+
+
+def _sum_blkio(frame, op):
+    entries = (frame.get('blkio_stats') or {}).get('io_service_bytes_recursive') or []
+    return sum(e.get('value', 0) for e in entries if e.get('op', '').lower() == op)
+
+
+def parse_frame(frame, previous=None):
+    """Turn one raw stats frame into a numeric sample.
+
+    ``previous`` is the frame before it on the same stream; the CPU percent
+    is computed from the delta between the two, the way ``docker stats`` does.
+    """
+    cpu_stats = frame.get('cpu_stats') or {}
+    pre_stats = (previous or {}).get('cpu_stats') or frame.get('precpu_stats') or {}
+    cpu_total = (cpu_stats.get('cpu_usage') or {}).get('total_usage', 0)
+    pre_total = (pre_stats.get('cpu_usage') or {}).get('total_usage', 0)
+    system_delta = cpu_stats.get('system_cpu_usage', 0) - pre_stats.get('system_cpu_usage', 0)
+    online_cpus = cpu_stats.get('online_cpus') or len((cpu_stats.get('cpu_usage') or {}).get('percpu_usage') or []) or 1
+    cpu_percent = 0.0
+    if system_delta > 0 and cpu_total >= pre_total:
+        cpu_percent = (cpu_total - pre_total) / system_delta * online_cpus * 100.0
+
+    memory = frame.get('memory_stats') or {}
+    mem_detail = memory.get('stats') or {}
+    # Page cache doesn't count as used memory (cgroup v1 and v2 names)
+    inactive = mem_detail.get('total_inactive_file', mem_detail.get('inactive_file', 0))
+    mem_bytes = max(memory.get('usage', 0) - inactive, 0)
+    mem_limit = memory.get('limit', 0)
+
+    networks = frame.get('networks') or {}
+    return {
+        'cpu_usage_ns': cpu_total,
+        'cpu_percent': round(cpu_percent, 2),
+        'mem_bytes': mem_bytes,
+        'mem_usage': mem_bytes / (1024 * 1024),  # MiB
+        'mem_percent': round(mem_bytes / mem_limit * 100.0, 2) if mem_limit else 0.0,
+        'net_rx_bytes': sum(n.get('rx_bytes', 0) for n in networks.values()),
+        'net_tx_bytes': sum(n.get('tx_bytes', 0) for n in networks.values()),
+        'blk_read_bytes': _sum_blkio(frame, 'read'),
+        'blk_write_bytes': _sum_blkio(frame, 'write'),
+        'pids': (frame.get('pids_stats') or {}).get('current', 0),
+    }
+
+
+class StatsCollector:
+    START_EVENTS = ('start', 'unpause')
+    STOP_EVENTS = ('die', 'stop', 'pause', 'destroy')
+
+    def __init__(self, client=None, on_unwatch=None):
+        # on_unwatch(short container id) is called when a container's stream is closed
+        self.client = client or docker.from_env()
+        self.on_unwatch = on_unwatch
+        self._latest = {}  # full container id -> sample
+        self._streams = {}  # full container id -> Event set to close the stream
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _stream(self, container_id, closed):
+        previous = None
+        try:
+            for frame in self.client.api.stats(container_id, stream=True, decode=True):
+                if self._stop.is_set() or closed.is_set():
+                    return
+                if not frame.get('read') or not frame.get('cpu_stats'):
+                    continue
+                sample = parse_frame(frame, previous)
+                sample['container_id'] = container_id[:12]  # matches the docker stats "Container" column
+                sample['read_at'] = time.time()
+                previous = frame
+                with self._lock:
+                    if closed.is_set():
+                        return
+                    self._latest[container_id] = sample
+        except docker.errors.NotFound:
+            pass
+        except Exception as e:
+            logger.warning("Stats stream for %s ended: %s", container_id[:12], e)
+        finally:
+            with self._lock:
+                # A restarted container may already have a new stream
+                if self._streams.get(container_id) is closed:
+                    del self._streams[container_id]
+                    self._latest.pop(container_id, None)
+
+    def watch(self, container_id):
+        with self._lock:
+            if container_id in self._streams:
+                return
+            closed = self._streams[container_id] = threading.Event()
+        threading.Thread(target=self._stream, args=(container_id, closed), daemon=True).start()
+
+    def unwatch(self, container_id):
+        """Close a container's stream and drop its last sample."""
+        with self._lock:
+            closed = self._streams.pop(container_id, None)
+            self._latest.pop(container_id, None)
+            if closed is not None:
+                # The stream thread returns at its next frame
+                closed.set()
+        if self.on_unwatch is not None:
+            self.on_unwatch(container_id[:12])
+
+    def _events(self):
+        while not self._stop.is_set():
+            try:
+                events = self.client.events(
+                    decode=True,
+                    filters={'type': 'container', 'event': [*self.START_EVENTS, *self.STOP_EVENTS]})
+                for event in events:
+                    if self._stop.is_set():
+                        return
+                    if event.get('status', event.get('Action')) in self.STOP_EVENTS:
+                        self.unwatch(event['id'])
+                    else:
+                        self.watch(event['id'])
+            except Exception as e:
+                logger.warning("Docker events listener failed, retrying: %s", e)
+                time.sleep(1)
+
+    def start(self):
+        """Open streams for the running containers and follow new ones."""
+        for container in self.client.containers.list():
+            self.watch(container.id)
+        threading.Thread(target=self._events, daemon=True).start()
+        logger.info("Stats collector streaming %d container(s)", len(self._streams))
+
+    def stop(self):
+        self._stop.set()
+
+    def snapshot(self):
+        """Latest sample of every streamed container."""
+        with self._lock:
+            return [dict(sample) for sample in self._latest.values()]
+
+
+class RateTracker:
+    """Per-second rates of the I/O byte counters between consecutive samples.
+
+    The previous counters of each container are kept between ticks. A
+    counter that went down means the container restarted and counts from
+    zero again, so its current value is taken as the delta. A sample read
+    at the same time as the previous one (no new stats frame yet) keeps the
+    previous rates.
+    """
+
+    COUNTERS = ('net_rx_bytes', 'net_tx_bytes', 'blk_read_bytes', 'blk_write_bytes')
+    RATES = ('net_rx_rate', 'net_tx_rate', 'blk_read_rate', 'blk_write_rate')
+
+    def __init__(self):
+        self._previous = {}  # container id -> (read_at, counters, rates)
+        self._lock = threading.Lock()
+
+    def forget(self, container_id):
+        """Drop a container's previous counters, e.g. once it stopped."""
+        with self._lock:
+            self._previous.pop(container_id, None)
+
+    def apply(self, samples):
+        """Add the rate fields to every sample in place; returns the samples."""
+        with self._lock:
+            return self._apply(samples)
+
+    def _apply(self, samples):
+        if not samples:
+            self._previous.clear()
+            return samples
+        width = len(self.COUNTERS)
+        current = np.array([[s[c] for c in self.COUNTERS] for s in samples], dtype=np.float64)
+        read_at = np.array([s['read_at'] for s in samples], dtype=np.float64)
+        prev_counters = np.full((len(samples), width), np.nan)
+        prev_read_at = np.full(len(samples), np.nan)
+        prev_rates = np.zeros((len(samples), width))
+        for i, sample in enumerate(samples):
+            previous = self._previous.get(sample['container_id'])
+            if previous is not None:
+                prev_read_at[i], prev_counters[i], prev_rates[i] = previous
+
+        elapsed = read_at - prev_read_at
+        delta = current - prev_counters
+        delta = np.where(delta < 0, current, delta)
+        fresh = elapsed > 0  # False where there's no previous sample (nan) or no new frame
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = np.where(fresh[:, None], delta / elapsed[:, None], prev_rates)
+        rates = np.round(rates, 1)
+
+        previous = {}
+        for i, sample in enumerate(samples):
+            for j, field in enumerate(self.RATES):
+                sample[field] = float(rates[i, j])
+            if fresh[i] or np.isnan(prev_read_at[i]):
+                previous[sample['container_id']] = (read_at[i], current[i], rates[i])
+            else:
+                previous[sample['container_id']] = self._previous[sample['container_id']]
+        # Containers missing from this tick are forgotten
+        self._previous = previous
+        return samples
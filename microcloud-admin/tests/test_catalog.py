@@ -0,0 +1,109 @@
+from collections import namedtuple
+from contextlib import contextmanager
+
+import pytest
+
+import catalog
+
+Row = namedtuple('Row', 'plan_id vcpu ram')
+
+PLANS = {1: (1.0, 512), 2: (2.0, 1024)}
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, sql, params=()):
+        self.conn.queries.append(sql)
+        ids = params or list(PLANS)
+        self.rows = [Row(plan_id, *PLANS[plan_id]) for plan_id in ids if plan_id in PLANS]
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self):
+        self.queries = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakePool:
+    """A pool of one connection that fails a second, nested checkout."""
+
+    def __init__(self):
+        self.conn = FakeConnection()
+        self.checked_out = False
+        self.checkouts = 0
+
+    @contextmanager
+    def connection(self):
+        if self.checked_out:
+            raise AssertionError("nested checkout")
+        self.checked_out = True
+        self.checkouts += 1
+        try:
+            yield self.conn
+        finally:
+            self.checked_out = False
+
+
+def test_plan_loads_only_its_row_before_a_whole_read():
+    pool = FakePool()
+    cat = catalog.Catalog(pool)
+
+    assert cat.plan(1) == {'vcpu': 1.0, 'ram': 512}
+    assert cat.plan(1) == {'vcpu': 1.0, 'ram': 512}
+
+    assert pool.conn.queries == ["SELECT vcpu, ram FROM VW_Plans WHERE plan_id = ?"]
+    assert cat.stats()['plans']['hits'] == 1
+
+
+def test_missing_row_is_not_cached():
+    pool = FakePool()
+    cat = catalog.Catalog(pool)
+
+    assert cat.plan(3) is None
+    PLANS[3] = (4.0, 2048)
+    try:
+        assert cat.plan(3) == {'vcpu': 4.0, 'ram': 2048}
+    finally:
+        del PLANS[3]
+
+
+def test_whole_read_switches_to_whole_table_loads():
+    pool = FakePool()
+    cat = catalog.Catalog(pool)
+
+    cat.plan(1)
+    assert cat.plans() == {1: {'vcpu': 1.0, 'ram': 512}, 2: {'vcpu': 2.0, 'ram': 1024}}
+    assert cat.plan(2) == {'vcpu': 2.0, 'ram': 1024}
+    cat.invalidate('plans')
+    cat.plan(2)
+
+    assert pool.conn.queries[1:] == ["SELECT plan_id, vcpu, ram FROM VW_Plans"] * 2
+
+
+@pytest.mark.parametrize('preload', [False, True])
+def test_held_connection_is_reused(preload):
+    pool = FakePool()
+    cat = catalog.Catalog(pool, ttl=0)
+    if preload:
+        cat._reload(['plans'])
+
+    with pool.connection() as conn:
+        assert cat.plan(1, conn) == {'vcpu': 1.0, 'ram': 512}
+
+    assert pool.checkouts == (2 if preload else 1)
+
+
+def test_invalidate_rejects_unknown_catalog():
+    with pytest.raises(ValueError):
+        catalog.Catalog(FakePool()).invalidate('regions')
@@ -0,0 +1,95 @@
+import pytest
+
+import collection
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeStop:
+    """Stands in for the loop's stop Event; wait() advances the clock, oversleeping on demand."""
+
+    def __init__(self, clock, oversleep):
+        self.clock = clock
+        self.oversleep = list(oversleep)
+        self.stopped = False
+
+    def is_set(self):
+        return self.stopped
+
+    def set(self):
+        self.stopped = True
+
+    def wait(self, timeout):
+        self.clock.now += timeout + (self.oversleep.pop(0) if self.oversleep else 0.0)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(collection.time, 'monotonic', clock.monotonic)
+    return clock
+
+
+def run_samples(clock, durations, oversleep=(), **kwargs):
+    """Run the sampling stage for one tick per duration; a None duration makes that sample fail."""
+    durations = list(durations)
+    stop = FakeStop(clock, oversleep)
+
+    def sample():
+        took = durations.pop(0)
+        if not durations:
+            stop.set()
+        if took is None:
+            raise RuntimeError("docker went away")
+        clock.now += took
+        return ['sample']
+
+    kwargs = {'interval': 1, 'min_interval': 1, 'max_interval': 10, 'target_load': 0.5, **kwargs}
+    loop = collection.CollectionLoop(sample, lambda batch: None, **kwargs)
+    loop._stop = stop
+    loop._sample_loop()
+    return loop
+
+
+def test_late_ticks_are_counted_as_dropped_with_their_lag(clock):
+    loop = run_samples(clock, [0.1, 0.1, 0.1], oversleep=[2.5, 0.0])
+
+    assert loop.stats['ticks'] == 3
+    assert loop.stats['dropped_ticks'] == 2
+    assert loop.stats['lag_seconds_max'] == pytest.approx(2.5)
+    assert loop.stats['lag_seconds'] == pytest.approx(0.0)
+    assert loop.sample_duration.count == 3
+
+
+def test_interval_stretches_at_once_and_shrinks_gradually(clock):
+    loop = run_samples(clock, [3.0])
+    assert loop.interval == pytest.approx(6.0)
+
+    loop = run_samples(clock, [3.0, 0.1])
+    assert loop.interval == pytest.approx(6.0 + (1.0 - 6.0) * collection.SHRINK_RATE)
+
+    loop = run_samples(clock, [30.0])
+    assert loop.interval == 10
+
+
+def test_sample_errors_are_counted_and_the_loop_keeps_going(clock):
+    loop = run_samples(clock, [None, 0.1])
+
+    assert loop.stats['sample_errors'] == 1
+    assert loop.stats['ticks'] == 2
+    assert loop.status()['flush_backlog'] == 1
+
+
+def test_full_backlog_drops_the_oldest_batch():
+    loop = collection.CollectionLoop(lambda: None, lambda batch: None, backlog=2)
+    for batch in ('a', 'b', 'c'):
+        loop._enqueue(batch)
+
+    assert loop.stats['dropped_batches'] == 1
+    assert [loop._batches.get_nowait() for _ in range(2)] == ['b', 'c']
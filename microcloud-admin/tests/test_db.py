@@ -0,0 +1,163 @@
+import types
+
+import pytest
+
+import db
+
+
+class FakeRawCursor:
+    def __init__(self, raw):
+        self.raw = raw
+
+    def execute(self, sql, params=()):
+        if self.raw.dead:
+            raise db.Error("connection lost")
+        self.raw.executed.append(sql)
+        return self
+
+    def fetchone(self):
+        return (1,)
+
+
+class FakeRaw:
+    def __init__(self):
+        self.executed = []
+        self.commits = 0
+        self.rollbacks = 0
+        self.closed = False
+        self.dead = False
+
+    def cursor(self):
+        return FakeRawCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        if self.dead:
+            raise db.Error("connection lost")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def raws(monkeypatch):
+    created = []
+
+    def connect(conn_str):
+        created.append(FakeRaw())
+        return created[-1]
+
+    monkeypatch.setattr(db, 'pyodbc', types.SimpleNamespace(connect=connect))
+    return created
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(db.time, 'monotonic', clock.monotonic)
+    return clock
+
+
+def make_pool(**kwargs):
+    kwargs.setdefault('checkout_timeout', 0.05)
+    return db.ConnectionPool('DSN=test', **kwargs)
+
+
+def test_connections_are_reused(raws, clock):
+    pool = make_pool()
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+
+    assert first is second
+    assert len(raws) == 1
+    assert pool.stats()['checkouts'] == 2 and pool.stats()['in_use'] == 0
+
+
+def test_uncommitted_work_is_rolled_back_and_committed_work_is_not(raws, clock):
+    pool = make_pool()
+    with pool.connection() as conn:
+        conn.cursor().execute("UPDATE t SET x = 1")
+    assert raws[0].rollbacks == 1
+
+    with pool.connection() as conn:
+        conn.cursor().execute("UPDATE t SET x = 2")
+        conn.commit()
+    with pool.connection():
+        pass
+    assert raws[0].rollbacks == 1
+
+
+def test_idle_connection_is_health_checked(raws, clock):
+    pool = make_pool(health_check_idle=30)
+    with pool.connection():
+        pass
+    clock.now += 10
+    with pool.connection():
+        pass
+    assert raws[0].executed == []
+
+    clock.now += 31
+    with pool.connection():
+        pass
+    assert raws[0].executed == ["SELECT 1"]
+
+
+def test_failed_health_check_replaces_the_connection(raws, clock):
+    pool = make_pool(health_check_idle=30)
+    with pool.connection():
+        pass
+    raws[0].dead = True
+    clock.now += 31
+
+    with pool.connection() as conn:
+        assert conn.raw is raws[1]
+    assert raws[0].closed
+    assert pool.stats()['health_check_failures'] == 1
+
+
+def test_connections_are_recycled_after_their_lifetime(raws, clock):
+    pool = make_pool(max_lifetime=60, health_check_idle=1e9)
+    with pool.connection():
+        pass
+    clock.now += 61
+
+    with pool.connection() as conn:
+        assert conn.raw is raws[1]
+    assert raws[0].closed
+    assert pool.stats()['recycled'] == 1
+
+
+def test_broken_connection_is_closed_not_reused(raws, clock):
+    pool = make_pool()
+    with pytest.raises(db.Error):
+        with pool.connection() as conn:
+            raws[0].dead = True
+            conn.cursor().execute("SELECT 1")
+
+    with pool.connection() as conn:
+        assert conn.raw is raws[1]
+    assert raws[0].closed
+
+
+def test_checkout_times_out_when_the_pool_is_exhausted(raws, clock):
+    pool = make_pool(max_size=1)
+    with pool.connection():
+        with pytest.raises(db.PoolTimeoutError):
+            with pool.connection():
+                pass
+    assert pool.stats()['timeouts'] == 1
+    with pool.connection():
+        pass
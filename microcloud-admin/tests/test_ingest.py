@@ -0,0 +1,144 @@
+from collections import namedtuple
+from contextlib import contextmanager
+
+import pytest
+
+import ingest
+
+HOUR = 1704067200  # 2024-01-01 00:00 UTC, a finished hour
+
+Instance = namedtuple('Instance', 'instance_id container_id')
+
+
+def sample(container_id, ts=HOUR + 5):
+    return {'container_id': container_id, 'read_at': ts, 'cpu_percent': 1.5, 'mem_usage': 64.0,
+            'mem_percent': 12.5, 'pids': 3, 'net_rx_bytes': 1000, 'net_tx_bytes': 2000,
+            'blk_read_bytes': 0, 'blk_write_bytes': 4096}
+
+
+class FakeCursor:
+    def __init__(self, instances, fail):
+        self.instances = instances
+        self.fail = fail
+        self.batches = []
+        self.fast_executemany = False
+
+    def execute(self, sql, params=()):
+        self.sql = sql
+
+    def fetchall(self):
+        return list(self.instances)
+
+    def fetchone(self):
+        return None
+
+    def executemany(self, sql, rows):
+        if self.fail:
+            raise RuntimeError("deadlock victim")
+        self.batches.append((' '.join(sql.split()), rows))
+
+
+class FakePool:
+    def __init__(self, instances=()):
+        self.instances = list(instances)
+        self.fail = False
+        self.commits = 0
+        self.batches = []
+
+    @contextmanager
+    def connection(self):
+        cursor = FakeCursor(self.instances, self.fail)
+        pool = self
+
+        class Connection:
+            def cursor(self):
+                return cursor
+
+            def commit(self):
+                pool.commits += 1
+
+        yield Connection()
+        self.batches.extend(cursor.batches)
+
+    def statements(self):
+        return [sql.split()[0] for sql, _ in self.batches]
+
+
+@pytest.fixture
+def pool():
+    return FakePool([Instance(1, 'aaaaaaaaaaaa' + 'f' * 52), Instance(2, 'bbbbbbbbbbbb' + 'f' * 52)])
+
+
+def test_only_samples_of_known_containers_are_buffered(pool):
+    metrics = ingest.MetricsIngest(pool, storage='rows')
+
+    kept = metrics.add([sample('aaaaaaaaaaaa'), sample('cccccccccccc'), sample('bbbbbbbbbbbb')])
+
+    assert kept == 2
+    assert metrics.stats['rows_buffered'] == 2 and metrics.stats['rows_skipped'] == 1
+
+
+def test_flush_is_due_by_size_or_interval(pool, monkeypatch):
+    metrics = ingest.MetricsIngest(pool, flush_size=2, flush_interval=5, storage='rows')
+    assert not metrics.due()
+
+    metrics.add([sample('aaaaaaaaaaaa')])
+    assert not metrics.due()
+    metrics.add([sample('bbbbbbbbbbbb')])
+    assert metrics.due()
+
+    metrics.flush()
+    metrics.add([sample('aaaaaaaaaaaa')])
+    now = ingest.time.monotonic()
+    monkeypatch.setattr(ingest.time, 'monotonic', lambda: now + 5)
+    assert metrics.due()
+
+
+def test_rows_storage_inserts_one_row_per_sample(pool):
+    metrics = ingest.MetricsIngest(pool, storage='rows')
+    metrics.add([sample('aaaaaaaaaaaa'), sample('bbbbbbbbbbbb')])
+
+    assert metrics.flush() == 2
+    assert pool.statements() == ['INSERT']
+    rows = pool.batches[0][1]
+    assert rows[0][:7] == ('aaaaaaaaaaaa', 1.5, 64.0, 12.5, '1kB / 2kB', '0B / 4.1kB', 3)
+    assert rows[0][7:11] == (1000, 2000, 0, 4096)
+    assert pool.commits == 1
+    assert metrics.stats['rows_written'] == 2 and metrics.stats['blobs_written'] == 0
+
+
+def test_blob_storage_writes_one_blob_per_container_hour(pool):
+    metrics = ingest.MetricsIngest(pool, storage='blob')
+    metrics.add([sample('aaaaaaaaaaaa', HOUR + 5), sample('aaaaaaaaaaaa', HOUR + 10), sample('bbbbbbbbbbbb')])
+
+    assert metrics.flush() == 3
+    assert pool.statements() == ['MERGE']
+    assert sorted((row[0], row[2]) for row in pool.batches[0][1]) == [('aaaaaaaaaaaa', 2), ('bbbbbbbbbbbb', 1)]
+    assert metrics.stats['blobs_written'] == 2
+
+
+def test_both_storage_writes_rows_and_blobs_in_one_transaction(pool):
+    metrics = ingest.MetricsIngest(pool, storage='both')
+    metrics.add([sample('aaaaaaaaaaaa')])
+
+    metrics.flush()
+    assert pool.statements() == ['INSERT', 'MERGE']
+    assert pool.commits == 1
+
+
+def test_failed_flush_keeps_the_buffer(pool):
+    metrics = ingest.MetricsIngest(pool, storage='rows')
+    metrics.add([sample('aaaaaaaaaaaa')])
+    pool.fail = True
+
+    with pytest.raises(RuntimeError):
+        metrics.flush()
+    assert metrics.stats['flush_errors'] == 1
+
+    pool.fail = False
+    assert metrics.flush() == 1
+
+
+def test_unknown_storage_is_rejected(pool):
+    with pytest.raises(ValueError):
+        ingest.MetricsIngest(pool, storage='parquet')
@@ -0,0 +1,85 @@
+import time
+from contextlib import contextmanager
+
+import instance_state
+
+
+class RecordingCursor:
+    def __init__(self):
+        self.executed = []
+        self.batches = []
+        self.fast_executemany = False
+
+    def execute(self, sql, params=()):
+        self.executed.append(sql)
+
+    def executemany(self, sql, rows):
+        self.batches.append((sql, list(rows), self.fast_executemany))
+
+
+class FakePool:
+    def __init__(self):
+        self.fake_cursor = RecordingCursor()
+        self.commits = 0
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self):
+        return self.fake_cursor
+
+    def commit(self):
+        self.commits += 1
+
+
+class Known:
+    def __init__(self, ids):
+        self.ids = ids
+
+    def instance_ids(self, container_ids):
+        return {cid: self.ids[cid] for cid in container_ids if cid in self.ids}
+
+
+def sample(container_id, read_at, cpu):
+    return {'container_id': container_id, 'read_at': read_at, 'cpu_percent': cpu, 'pids': 4}
+
+
+def test_sync_only_rewrites_rows_that_differ():
+    cursor = RecordingCursor()
+
+    instance_state.sync(cursor)
+
+    update, delete = cursor.executed
+    predicate = ' '.join(update.split('WHERE EXISTS', 1)[1].split())
+    names = ', '.join(f't.{name}' for name, _, _ in instance_state.DETAIL_COLUMNS)
+    sources = ', '.join(source for _, _, source in instance_state.DETAIL_COLUMNS)
+    assert predicate == f"( SELECT {names} EXCEPT SELECT {sources} )"
+    assert 'DELETE' in delete and 'NOT EXISTS' in delete
+
+
+def test_update_upserts_the_newest_sample_of_known_containers():
+    pool = FakePool()
+    state = instance_state.InstanceState(pool, Known({'aaa': 1, 'bbb': 2}), sync_interval=3600)
+    state._synced_at = time.monotonic()  # not due
+
+    written = state.update([sample('aaa', 100.0, 10.0), sample('aaa', 105.0, 20.0),
+                            sample('bbb', 101.0, 30.0), sample('zzz', 102.0, 40.0)])
+
+    assert written == 2
+    (sql, rows, fast), = pool.fake_cursor.batches
+    assert fast and sql == instance_state.UPSERT_SQL
+    by_instance = {row[0]: row for row in rows}
+    assert set(by_instance) == {1, 2}
+    assert by_instance[1][1] == 'aaa' and by_instance[1][2] == 20.0
+    assert state.stats['rows_upserted'] == 2
+
+
+def test_update_syncs_when_due_even_without_samples():
+    pool = FakePool()
+    state = instance_state.InstanceState(pool, Known({}), sync_interval=0)
+
+    assert state.update([]) == 0
+    assert state.stats['syncs'] == 1
+    assert pool.commits == 1
+    assert any('EXCEPT' in sql for sql in pool.fake_cursor.executed)
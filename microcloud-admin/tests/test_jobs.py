@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+import jobs
+
+
+def wait_for(job, timeout=2):
+    deadline = time.monotonic() + timeout
+    while job.status in (jobs.QUEUED, jobs.RUNNING):
+        assert time.monotonic() < deadline, f"job still {job.status}"
+        time.sleep(0.005)
+    return job
+
+
+def test_same_key_returns_the_existing_job():
+    release = threading.Event()
+    queue = jobs.JobQueue(lambda job, queue: release.wait(2) and 'done')
+
+    first, created = queue.submit('sub-1', {})
+    again, created_again = queue.submit('sub-1', {})
+    assert created and not created_again
+    assert again is first
+
+    release.set()
+    assert wait_for(first).status == jobs.SUCCEEDED
+    assert queue.submit('sub-1', {}) == (first, False)
+
+
+def test_allow_rerun_starts_a_new_job_after_success():
+    queue = jobs.JobQueue(lambda job, queue: 'done')
+    first, _ = queue.submit('sub-1', {})
+    wait_for(first)
+
+    second, created = queue.submit('sub-1', {}, allow_rerun=True)
+    assert created and second is not first
+    wait_for(second)
+
+
+def test_failed_job_can_be_resubmitted():
+    def handler(job, queue):
+        raise RuntimeError("node unreachable")
+
+    queue = jobs.JobQueue(handler)
+    first, _ = queue.submit('sub-1', {})
+    assert wait_for(first).status == jobs.FAILED
+    assert first.error == "node unreachable"
+
+    second, created = queue.submit('sub-1', {}, handler=lambda job, queue: 'done')
+    assert created
+    assert wait_for(second).result == 'done'
+
+
+def test_full_queue_rejects_new_keys():
+    release = threading.Event()
+    queue = jobs.JobQueue(lambda job, queue: release.wait(2), max_pending=1)
+    queue.submit('sub-1', {})
+
+    with pytest.raises(jobs.QueueFullError):
+        queue.submit('sub-2', {})
+    release.set()
+
+
+def test_node_slot_limits_concurrent_jobs_per_node():
+    lock = threading.Lock()
+    running = {'now': 0, 'peak': 0}
+
+    def handler(job, queue):
+        with queue.node_slot(job.payload['node_id']):
+            with lock:
+                running['now'] += 1
+                running['peak'] = max(running['peak'], running['now'])
+            time.sleep(0.02)
+            with lock:
+                running['now'] -= 1
+
+    queue = jobs.JobQueue(handler, max_workers=8, per_node_limit=2)
+    submitted = [queue.submit(f'sub-{i}', {'node_id': 1})[0] for i in range(6)]
+    for job in submitted:
+        assert wait_for(job).status == jobs.SUCCEEDED
+    assert running['peak'] == 2
+
+
+def test_finished_jobs_are_pruned_after_retention(monkeypatch):
+    queue = jobs.JobQueue(lambda job, queue: 'done', retention=60)
+    first, _ = queue.submit('sub-1', {})
+    wait_for(first)
+
+    now = time.monotonic()
+    monkeypatch.setattr(jobs.time, 'monotonic', lambda: now + 61)
+    second, created = queue.submit('sub-2', {})
+    assert created
+    assert queue.get(first.id) is None
+    assert not queue.is_active('sub-1')
+    assert queue.submit('sub-1', {})[1]
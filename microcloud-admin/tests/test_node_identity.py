@@ -0,0 +1,66 @@
+import pytest
+
+import node_identity
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(node_identity.time, 'monotonic', clock.monotonic)
+    return clock
+
+
+class Source:
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.calls = 0
+        self.__name__ = 'fake_source'
+
+    def __call__(self, node_id, connection=None):
+        self.calls += 1
+        return self.answers.pop(0)
+
+
+def test_unavailable_is_cached_for_the_negative_ttl(clock, tmp_path):
+    source = Source([None, '203.0.113.7'])
+    cache_path = tmp_path / 'identity.json'
+    identity = node_identity.NodeIdentity(1, sources=[source], cache_path=str(cache_path), negative_ttl=60)
+
+    assert identity.public_ip() == 'Unavailable'
+    clock.now += 30
+    assert identity.public_ip() == 'Unavailable'
+    assert source.calls == 1
+    assert not cache_path.exists()
+
+    clock.now += 31
+    assert identity.public_ip() == '203.0.113.7'
+    assert source.calls == 2
+
+
+def test_resolved_ip_is_cached_for_the_ttl(clock, tmp_path):
+    source = Source(['203.0.113.7', '203.0.113.8'])
+    identity = node_identity.NodeIdentity(1, sources=[source], cache_path=None, ttl=3600)
+
+    assert identity.public_ip() == '203.0.113.7'
+    clock.now += 3599
+    assert identity.public_ip() == '203.0.113.7'
+    clock.now += 2
+    assert identity.public_ip() == '203.0.113.8'
+    assert source.calls == 2
+
+
+def test_invalidate_clears_the_negative_cache(clock):
+    source = Source([None, '203.0.113.7'])
+    identity = node_identity.NodeIdentity(1, sources=[source], cache_path=None)
+
+    assert identity.public_ip() == 'Unavailable'
+    identity.invalidate()
+    assert identity.public_ip() == '203.0.113.7'
@@ -0,0 +1,98 @@
+from collections import namedtuple
+from contextlib import contextmanager
+
+import placement
+
+Plan = namedtuple('Plan', 'plan_id vcpu ram')
+Node = namedtuple('Node', 'node_id node_ip node_region')
+Reserved = namedtuple('Reserved', 'node_id vcpu ram')
+Container = namedtuple('Container', 'instance_id node_id container_id')
+Usage = namedtuple('Usage', 'container_id cpu_percent mem_usage')
+
+FULL_A = 'a' * 12 + '0' * 52
+FULL_B = 'b' * 12 + '0' * 52
+FULL_C = 'c' * 12 + '0' * 52
+
+RESULTS = [
+    ('FROM VW_Plans', [Plan(1, 1, 512)]),
+    ('FROM TB_Nodes', [Node(1, '10.0.0.1', 1), Node(2, '10.0.0.2', 1)]),
+    ('SUM(p.vcpu)', [Reserved(1, 2, 1024)]),
+    ('FROM TB_Instances WHERE', [Container(1, 1, FULL_A), Container(2, 1, FULL_B), Container(3, 2, FULL_C)]),
+    ('FROM TB_Instance_Metrics', [Usage('a' * 12, 50.0, 100.0), Usage('b' * 12, 25.0, 200.0),
+                                  Usage('c' * 12, 100.0, 300.0), Usage('d' * 12, 80.0, 400.0)]),
+]
+
+
+class FakeCursor:
+    def __init__(self):
+        self.rows = []
+        self.queries = []
+        self.on_metrics = None  # called while the usage query runs
+
+    def execute(self, sql, params=()):
+        self.queries.append(sql)
+        self.rows = next(rows for marker, rows in RESULTS if marker in sql)
+        if 'FROM TB_Instances WHERE' in sql:
+            # Only instances past the watermark
+            self.rows = [row for row in self.rows if row.instance_id > params[0]]
+        if 'FROM TB_Instance_Metrics' in sql and self.on_metrics is not None:
+            self.on_metrics()
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakePool:
+    def __init__(self):
+        self.fake_cursor = FakeCursor()
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self):
+        return self.fake_cursor
+
+
+def test_refresh_maps_metrics_to_nodes_by_short_id(tmp_path):
+    pool = FakePool()
+    scheduler = placement.Scheduler(pool, capacity_config_path=str(tmp_path / 'missing.json'))
+
+    scheduler.refresh()
+
+    assert scheduler.nodes[1].observed_vcpu == 0.75
+    assert scheduler.nodes[1].observed_ram == 300.0
+    assert scheduler.nodes[2].observed_vcpu == 1.0
+    assert scheduler.nodes[2].observed_ram == 300.0
+    assert scheduler.nodes[1].reserved_vcpu == 2.0
+    assert not any('LIKE' in sql for sql in pool.fake_cursor.queries)
+
+
+def test_container_map_is_read_incrementally(tmp_path):
+    pool = FakePool()
+    scheduler = placement.Scheduler(pool, capacity_config_path=str(tmp_path / 'missing.json'))
+
+    scheduler.refresh()
+    scheduler.refresh()
+
+    assert scheduler._container_watermark == 3
+    assert scheduler.nodes[2].observed_vcpu == 1.0  # still mapped from the first read
+
+
+def test_reservation_confirmed_during_a_refresh_is_kept(tmp_path):
+    pool = FakePool()
+    scheduler = placement.Scheduler(pool, capacity_config_path=str(tmp_path / 'missing.json'))
+    scheduler.refresh()
+    reservation = scheduler.place(1, 1)
+    node_id = reservation.node_id
+    before = scheduler.nodes[node_id].reserved_vcpu
+
+    # Confirmed after the reserved capacity was read, so that read misses it
+    pool.fake_cursor.on_metrics = reservation.confirm
+    scheduler.refresh()
+    assert scheduler.nodes[node_id].reserved_vcpu == before
+
+    # A refresh that starts later finds the instance in the database
+    pool.fake_cursor.on_metrics = None
+    scheduler.refresh()
+    assert scheduler.nodes[node_id].reserved_vcpu == before - 1
@@ -0,0 +1,95 @@
+import pytest
+
+from port_allocator import PortAllocator, PortsExhaustedError
+
+START = 41000
+
+
+@pytest.fixture
+def allocator(tmp_path):
+    return PortAllocator(start=START, end=START + 9, state_path=str(tmp_path / 'ports.bin'))
+
+
+def test_allocate_returns_distinct_ports_lowest_first(allocator):
+    assert allocator.allocate(5) == [START + i for i in range(5)]
+    assert allocator.allocate(3) == [START + 5, START + 6, START + 7]
+    assert allocator.stats()['used'] == 8
+
+
+def test_freed_ports_are_reused(allocator):
+    first = allocator.allocate(5)
+    allocator.allocate(5)
+    with pytest.raises(PortsExhaustedError):
+        allocator.allocate(1)
+    allocator.free(first)
+    assert sorted(allocator.allocate(5)) == first
+
+
+def test_double_free_and_out_of_range_are_ignored(allocator):
+    ports = allocator.allocate(2)
+    allocator.free(ports)
+    allocator.free(ports + [START - 1, START + 100])
+    assert allocator.stats()['free'] == 10
+    assert len(set(allocator.allocate(10))) == 10
+
+
+def test_exhaustion_gives_back_partial_allocation(allocator):
+    allocator.allocate(8)
+    with pytest.raises(PortsExhaustedError):
+        allocator.allocate(3)
+    assert sorted(allocator.allocate(2)) == [START + 8, START + 9]
+    assert allocator.stats()['exhausted_count'] == 1
+
+
+def test_seed_marks_ports_used_on_first_use(tmp_path):
+    allocator = PortAllocator(start=START, end=START + 9, state_path=str(tmp_path / 'ports.bin'),
+                              seed=lambda: {START, START + 2, 99})
+    assert allocator.allocate(2) == [START + 1, START + 3]
+
+
+def test_state_survives_a_new_allocator(allocator, tmp_path):
+    allocator.allocate(3)
+    again = PortAllocator(start=START, end=START + 9, state_path=str(tmp_path / 'ports.bin'))
+    assert again.allocate(1) == [START + 3]
+
+
+def test_reseed_replaces_the_state(allocator):
+    allocator.allocate(10)
+    allocator.reseed({START + 4})
+    stats = allocator.stats()
+    assert stats['used'] == 1
+    assert START + 4 not in allocator.allocate(9)
+
+
+def test_reconcile_frees_ports_unused_on_two_passes(allocator):
+    kept = allocator.allocate(5)
+    leaked = allocator.allocate(5)
+    assert allocator.reconcile(set(kept)) == []  # could still be a spawn in flight
+    assert allocator.reconcile(set(kept)) == leaked
+    assert sorted(allocator.allocate(5)) == leaked
+
+
+def test_reconcile_spares_ports_bound_in_between(allocator):
+    ports = allocator.allocate(2)
+    allocator.reconcile(set())
+    assert allocator.reconcile({ports[0]}) == [ports[1]]
+    assert allocator.reconcile(set()) == []  # ports[0] has only been unused once
+    assert allocator.stats()['used'] == 1
+
+
+def test_reconcile_marks_bound_ports_used(allocator):
+    allocator.reconcile({START, START + 1})
+    assert allocator.allocate(1) == [START + 2]
+
+
+def test_stats_after_reconcile_marks_ports_used(allocator):
+    allocator.reconcile({START, START + 1})
+    stats = allocator.stats()
+    assert (stats['used'], stats['free']) == (2, stats['total'] - 2)
+
+    # A port marked by reconcile goes back on the free stack only once
+    allocator.free([START])
+    stats = allocator.stats()
+    assert (stats['used'], stats['free']) == (1, stats['total'] - 1)
+    rest = allocator.allocate(stats['total'] - 1)
+    assert sorted(rest) == [port for port in range(START, START + stats['total']) if port != START + 1]
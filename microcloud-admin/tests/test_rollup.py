@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+
+import rollup
+
+MINUTE, HOUR = rollup.TIERS
+
+
+class FakeCursor:
+    """Answers the statements compact() issues from in-memory raw timestamps."""
+
+    def __init__(self, raw, now, locked=False):
+        self.raw = sorted(raw)
+        self.now = now
+        self.locked = locked  # the rollup lock, as seen by this session
+        self.buckets = {tier.table: set() for tier in rollup.TIERS}
+        self.windows = []
+        self._result = None
+        self.rowcount = 0
+
+    def execute(self, sql, params=()):
+        if 'sp_getapplock' in sql:
+            assert "@LockOwner = 'Session'" in sql
+            self._result = (-1,) if self.locked else (0,)
+            self.locked = True
+        elif 'sp_releaseapplock' in sql:
+            self.locked = False
+        elif 'GETDATE()' in sql:
+            self._result = (self.now,)
+        elif 'SELECT MAX(bucket)' in sql:
+            table = sql.split('FROM')[1].split()[0]
+            self._result = (max(self.buckets[table], default=None),)
+        elif 'SELECT MIN(timestamp)' in sql:
+            after = [ts for ts in self.raw if not params or ts >= params[0]]
+            self._result = (after[0] if after else None,)
+        elif 'INSERT INTO' in sql:
+            tier = next(t for t in rollup.TIERS if f'INSERT INTO {t.table} ' in sql)
+            start, end = params
+            new = {tier.bucket(ts) for ts in self.raw if start <= ts < end}
+            self.buckets[tier.table] |= new
+            self.windows.append((tier.name, start, end))
+            self.rowcount = len(new)
+        else:
+            raise AssertionError(f"Unexpected SQL: {sql}")
+
+    def fetchone(self):
+        return self._result
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def samples(start, minutes):
+    return [start + timedelta(seconds=5 * i) for i in range(minutes * 12)]
+
+
+def test_window_starts_at_first_sample():
+    now = datetime(2024, 1, 1, 12, 0)
+    first = datetime(2024, 1, 1, 11, 0, 17)
+    assert rollup.window(MINUTE, None, first, now) == (datetime(2024, 1, 1, 11, 0), datetime(2024, 1, 1, 11, 59))
+
+
+def test_window_is_capped_at_max_span():
+    now = datetime(2024, 1, 2)
+    watermark = datetime(2024, 1, 1)
+    assert rollup.window(MINUTE, watermark, watermark, now) == (watermark, watermark + rollup.MAX_SPAN)
+
+
+def test_window_jumps_over_a_gap():
+    now = datetime(2024, 1, 3)
+    watermark = datetime(2024, 1, 1, 0, 5)
+    resumed = datetime(2024, 1, 2, 8, 30, 40)
+    start, end = rollup.window(MINUTE, watermark, resumed, now)
+    assert start == datetime(2024, 1, 2, 8, 30)
+    assert end == start + rollup.MAX_SPAN
+
+
+def test_window_waits_for_complete_buckets():
+    now = datetime(2024, 1, 1, 12, 0, 30)
+    assert rollup.window(MINUTE, datetime(2024, 1, 1, 11, 59), datetime(2024, 1, 1, 11, 59, 5), now) is None
+    assert rollup.window(MINUTE, datetime(2024, 1, 1, 11, 0), None, now) is None
+
+
+def test_compaction_continues_after_a_gap_longer_than_max_span():
+    before = samples(datetime(2024, 1, 1, 0, 0), 10)
+    after = samples(datetime(2024, 1, 1, 20, 0), 10)  # node was off for ~20 h
+    cursor = FakeCursor(before + after, now=datetime(2024, 1, 1, 22, 0))
+    connection = FakeConnection(cursor)
+
+    assert rollup.compact(connection)['1m'] == 10
+    # The next run skips the empty hours and picks up the new samples
+    assert rollup.compact(connection)['1m'] == 10
+    assert max(cursor.buckets[MINUTE.table]) == datetime(2024, 1, 1, 20, 9)
+    assert cursor.buckets[HOUR.table] == {datetime(2024, 1, 1, 0, 0), datetime(2024, 1, 1, 20, 0)}
+    assert rollup.compact(connection) == {'1m': 0, '1h': 0}
+
+
+def test_compaction_releases_its_lock():
+    cursor = FakeCursor(samples(datetime(2024, 1, 1, 0, 0), 10), now=datetime(2024, 1, 1, 2, 0))
+
+    assert rollup.compact(FakeConnection(cursor))['1m'] == 10
+    assert not cursor.locked
+
+
+def test_compaction_skips_while_another_session_holds_the_lock():
+    cursor = FakeCursor(samples(datetime(2024, 1, 1, 0, 0), 10), now=datetime(2024, 1, 1, 2, 0), locked=True)
+
+    assert rollup.compact(FakeConnection(cursor)) is None
+    assert cursor.windows == []
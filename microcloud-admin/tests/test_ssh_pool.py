@@ -0,0 +1,79 @@
+import pytest
+
+import ssh_pool
+
+
+class FakeChannel:
+    def __init__(self, response):
+        self.response = response
+        self.sent = b''
+        self.closed = False
+
+    def settimeout(self, timeout):
+        pass
+
+    def sendall(self, data):
+        self.sent += data
+
+    def recv(self, size):
+        chunk, self.response = self.response[:size], self.response[size:]
+        return chunk
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTransport:
+    def __init__(self, channel):
+        self.channel = channel
+
+    def open_channel(self, kind, dest, src, timeout=None):
+        return self.channel
+
+
+class FakeClient:
+    def __init__(self, channel):
+        self.transport = FakeTransport(channel)
+
+    def get_transport(self):
+        return self.transport
+
+
+@pytest.fixture
+def make_pool(tmp_path, monkeypatch):
+    config = tmp_path / 'ssh_config'
+    config.write_text('')
+
+    def make(response):
+        pool = ssh_pool.SSHPool(lambda: [], config_path=str(config))
+        channel = FakeChannel(response)
+        monkeypatch.setattr(pool, '_client', lambda node_ip, node: FakeClient(channel))
+        return pool, channel
+
+    return make
+
+
+def test_request_parses_status_and_json_body(make_pool):
+    body = b'{"ssh_port": 20001}'
+    pool, channel = make_pool(
+        b'HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n'
+        b'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+
+    assert pool.request('10.0.0.1', 'POST', '/spawn', {'plan_id': 1}) == (200, {'ssh_port': 20001})
+    assert channel.sent.startswith(b'POST /spawn HTTP/1.0\r\n')
+    assert channel.closed
+    assert pool.stats()['requests'] == 1
+
+
+@pytest.mark.parametrize('response', [
+    b'',
+    b'HTTP/1.0',
+    b'HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n',
+    b'HTTP/1.0 200 OK\r\nContent-Length: 40\r\n\r\n{"ssh_port": 2',
+])
+def test_empty_or_truncated_response_is_service_unavailable(make_pool, response):
+    pool, channel = make_pool(response)
+
+    with pytest.raises(ssh_pool.ServiceUnavailableError):
+        pool.request('10.0.0.1', 'POST', '/spawn', {'plan_id': 1})
+    assert channel.closed
@@ -0,0 +1,140 @@
+import stats_collector
+
+
+def sample(container_id, read_at, rx, tx=0, read=0, write=0):
+    return {'container_id': container_id, 'read_at': read_at, 'net_rx_bytes': rx, 'net_tx_bytes': tx,
+            'blk_read_bytes': read, 'blk_write_bytes': write}
+
+
+def rates(s):
+    return [s[field] for field in stats_collector.RateTracker.RATES]
+
+
+def test_first_sample_has_zero_rates():
+    tracker = stats_collector.RateTracker()
+
+    first, = tracker.apply([sample('a', 100.0, 5000, 7000, 100, 200)])
+
+    assert rates(first) == [0.0, 0.0, 0.0, 0.0]
+
+
+def test_rates_are_per_second_deltas():
+    tracker = stats_collector.RateTracker()
+    tracker.apply([sample('a', 100.0, 1000, 2000, 0, 0), sample('b', 100.0, 0)])
+
+    a, b = tracker.apply([sample('a', 105.0, 2000, 4500, 50, 0), sample('b', 102.0, 300)])
+
+    assert rates(a) == [200.0, 500.0, 10.0, 0.0]
+    assert rates(b) == [150.0, 0.0, 0.0, 0.0]
+
+
+def test_counter_reset_counts_from_zero():
+    tracker = stats_collector.RateTracker()
+    tracker.apply([sample('a', 100.0, 10_000_000, write=5000)])
+
+    a, = tracker.apply([sample('a', 110.0, 4000, write=6000)])
+
+    # rx went down: the container restarted, so the new counter is the delta
+    assert rates(a) == [400.0, 0.0, 0.0, 100.0]
+
+
+def test_repeated_frame_keeps_previous_rates():
+    tracker = stats_collector.RateTracker()
+    tracker.apply([sample('a', 100.0, 1000)])
+    tracker.apply([sample('a', 110.0, 2000)])
+
+    repeat, = tracker.apply([sample('a', 110.0, 2000)])
+    following, = tracker.apply([sample('a', 120.0, 2500)])
+
+    assert rates(repeat) == [100.0, 0.0, 0.0, 0.0]
+    assert rates(following) == [50.0, 0.0, 0.0, 0.0]
+
+
+def test_containers_missing_from_a_tick_are_forgotten():
+    tracker = stats_collector.RateTracker()
+    tracker.apply([sample('a', 100.0, 1000)])
+    tracker.apply([sample('b', 105.0, 1000)])
+
+    a, = tracker.apply([sample('a', 110.0, 3000)])
+
+    assert rates(a) == [0.0, 0.0, 0.0, 0.0]
+
+
+def test_parse_frame_reads_numeric_io_counters():
+    frame = {
+        'networks': {'eth0': {'rx_bytes': 100, 'tx_bytes': 40}, 'eth1': {'rx_bytes': 5, 'tx_bytes': 1}},
+        'blkio_stats': {'io_service_bytes_recursive': [
+            {'op': 'Read', 'value': 4096}, {'op': 'Write', 'value': 8192}, {'op': 'read', 'value': 4}]},
+    }
+
+    parsed = stats_collector.parse_frame(frame)
+
+    assert (parsed['net_rx_bytes'], parsed['net_tx_bytes']) == (105, 41)
+    assert (parsed['blk_read_bytes'], parsed['blk_write_bytes']) == (4100, 8192)
+
+
+class FakeAPI:
+    def __init__(self, frames):
+        self.frames = frames  # container id -> list of frames, consumed by the stream
+
+    def stats(self, container_id, stream=True, decode=True):
+        while self.frames[container_id]:
+            yield self.frames[container_id].pop(0)
+
+
+class FakeDockerClient:
+    def __init__(self, frames=None, events=()):
+        self.api = FakeAPI(frames or {})
+        self._events = list(events)
+        self.collector = None
+
+    def events(self, decode=True, filters=None):
+        for event in self._events:
+            yield event
+        self.collector.stop()
+
+
+FRAME = {'read': '2024-01-01T00:00:00Z', 'cpu_stats': {'system_cpu_usage': 1}, 'networks': {'eth0': {'rx_bytes': 10}}}
+
+
+def test_stop_events_close_the_stream_and_forget_the_container():
+    forgotten = []
+    client = FakeDockerClient(frames={'c' * 64: [FRAME, FRAME]},
+                              events=[{'status': 'die', 'id': 'c' * 64}])
+    collector = stats_collector.StatsCollector(client, on_unwatch=forgotten.append)
+    client.collector = collector
+    closed = collector._streams['c' * 64] = stats_collector.threading.Event()
+    collector._latest['c' * 64] = {'container_id': 'c' * 12}
+
+    collector._events()
+
+    assert collector.snapshot() == []
+    assert closed.is_set()
+    assert forgotten == ['c' * 12]
+    # The stream thread stops at its next frame without storing it
+    collector._stream('c' * 64, closed)
+    assert collector.snapshot() == []
+    assert client.api.frames['c' * 64] == [FRAME]
+
+
+def test_start_events_open_a_stream():
+    client = FakeDockerClient(frames={'d' * 64: [FRAME]}, events=[{'status': 'start', 'id': 'd' * 64}])
+    collector = stats_collector.StatsCollector(client)
+    client.collector = collector
+    watched = []
+    collector.watch = watched.append
+
+    collector._events()
+
+    assert watched == ['d' * 64]
+
+
+def test_forget_drops_the_previous_counters():
+    tracker = stats_collector.RateTracker()
+    tracker.apply([sample('a', 100.0, 1000), sample('b', 100.0, 1000)])
+
+    tracker.forget('a')
+    a, b = tracker.apply([sample('a', 110.0, 3000), sample('b', 110.0, 3000)])
+
+    assert rates(a) == [0.0, 0.0, 0.0, 0.0]
+    assert rates(b) == [200.0, 0.0, 0.0, 0.0]
@@ -0,0 +1,61 @@
+import pytest
+
+import tracing
+
+
+def test_histogram_counts_each_observation_in_its_bucket():
+    histogram = tracing.Histogram(buckets=(0.1, 1.0, float('inf')))
+    for seconds in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(seconds)
+
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.count == 4
+    assert histogram.sum == pytest.approx(3.65)
+
+
+def test_histogram_quantiles_are_bucket_upper_bounds():
+    histogram = tracing.Histogram(buckets=(0.1, 1.0, 10.0, float('inf')))
+    assert histogram.quantile(0.5) is None
+
+    for _ in range(98):
+        histogram.observe(0.05)
+    histogram.observe(5.0)
+    histogram.observe(60.0)
+
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.99) == 10.0
+    assert histogram.quantile(1.0) == float('inf')
+
+
+def test_histogram_as_dict_has_cumulative_buckets():
+    histogram = tracing.Histogram(buckets=(0.1, 1.0, float('inf')))
+    histogram.observe(0.05)
+    histogram.observe(2.0)
+
+    assert histogram.as_dict() == {
+        'count': 2, 'sum': 2.05, 'p50': 0.1, 'p99': float('inf'),
+        'buckets': [[0.1, 1], [1.0, 1], ['+Inf', 2]],
+    }
+
+
+def test_trace_spans_feed_the_phase_histograms():
+    with tracing.Trace('test-spawn', correlation_id='abc') as trace:
+        with tracing.span('create'):
+            pass
+        trace.add('node.start', 0.2)
+    with tracing.span('outside'):
+        pass
+
+    assert tracing.current() is None
+    assert [phase for phase, _ in trace.spans] == ['create', 'node.start']
+    phases = tracing.histograms()['test-spawn']
+    assert set(phases) == {'create', 'node.start', 'total'}
+    assert phases['node.start']['count'] == 1
+
+
+def test_failed_trace_is_recorded_as_failed():
+    with pytest.raises(RuntimeError):
+        with tracing.Trace('test-deploy'):
+            raise RuntimeError("no capacity")
+
+    assert set(tracing.histograms()['test-deploy']) == {'failed'}
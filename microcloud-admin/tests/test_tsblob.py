@@ -0,0 +1,137 @@
+from collections import namedtuple
+from datetime import datetime
+
+import pytest
+
+import tsblob
+
+HOUR = 1704067200  # 2024-01-01 00:00 UTC
+
+Row = namedtuple('Row', 'data')
+StoredHour = namedtuple('StoredHour', 'hour_start data')
+
+
+def sample(ts, cpu=1.5, **fields):
+    return {'container_id': 'abc123def456', 'read_at': ts, 'cpu_percent': cpu,
+            'net_rx_bytes': 1000 + int(ts - HOUR), 'pids': 3, **fields}
+
+
+def columns(samples):
+    return {field: [s.get(field) or 0 for s in samples] for field, _ in tsblob.COLUMNS}
+
+
+class FakeCursor:
+    def __init__(self, stored=None, blobs=()):
+        self.stored = stored
+        self.blobs = list(blobs)  # (hour start, blob) rows read_range fetches
+        self.rows = None
+
+    def execute(self, sql, params=()):
+        pass
+
+    def fetchone(self):
+        if self.blobs:
+            hour, blob = self.blobs.pop(0)
+            return StoredHour(datetime.fromtimestamp(hour), blob)
+        return Row(self.stored) if self.stored is not None else None
+
+    def executemany(self, sql, rows):
+        self.rows = rows
+
+
+class FakeConnection:
+    def __init__(self, stored=None, blobs=()):
+        self.fake_cursor = FakeCursor(stored, blobs)
+
+    def cursor(self):
+        return self.fake_cursor
+
+
+def test_round_trip():
+    samples = [sample(HOUR + 5 * i + 0.123, cpu=i * 0.37, mem_usage=512.25, net_rx_rate=12.3) for i in range(100)]
+    blob = tsblob.encode(HOUR, [s['read_at'] for s in samples], columns(samples))
+
+    timestamps, decoded = tsblob.decode(blob)
+
+    assert timestamps == pytest.approx([s['read_at'] for s in samples], abs=1e-3)
+    assert decoded['cpu_percent'] == pytest.approx([round(i * 0.37, 2) for i in range(100)])
+    assert decoded['mem_usage'] == [512.25] * 100
+    assert decoded['net_rx_bytes'] == [s['net_rx_bytes'] for s in samples]
+    assert decoded['net_rx_rate'] == [12.3] * 100
+    assert decoded['blk_write_bytes'] == [0] * 100
+
+
+def test_empty_hour_round_trips():
+    assert tsblob.decode(tsblob.encode(HOUR, [], columns([]))) == ([], {field: [] for field, _ in tsblob.COLUMNS})
+
+
+def test_decode_rejects_other_data():
+    blob = tsblob.encode(HOUR, [HOUR + 1], columns([sample(HOUR + 1)]))
+
+    with pytest.raises(ValueError):
+        tsblob.decode(b'XXXX' + blob[4:])
+
+
+def test_late_and_repeated_samples_are_dropped():
+    store = tsblob.BlobStore()
+    store.add([sample(HOUR + 10), sample(HOUR + 20)])
+    store.add([sample(HOUR + 20), sample(HOUR + 15), sample(HOUR + 30)])
+    connection = FakeConnection()
+
+    assert store.write(connection) == 1
+
+    (_, _, count, blob), = connection.fake_cursor.rows
+    timestamps, _ = tsblob.decode(blob)
+    assert count == 3
+    assert timestamps == [HOUR + 10, HOUR + 20, HOUR + 30]
+
+
+def test_write_merges_with_the_stored_hour():
+    stored = [sample(HOUR + 10), sample(HOUR + 20)]
+    blob = tsblob.encode(HOUR, [s['read_at'] for s in stored], columns(stored))
+    store = tsblob.BlobStore()
+    # After a restart the first tick may repeat a sample that's already stored
+    store.add([sample(HOUR + 20), sample(HOUR + 25)])
+    connection = FakeConnection(stored=blob)
+
+    store.write(connection)
+
+    (_, _, count, merged), = connection.fake_cursor.rows
+    timestamps, decoded = tsblob.decode(merged)
+    assert count == 3
+    assert timestamps == [HOUR + 10, HOUR + 20, HOUR + 25]
+    assert decoded['net_rx_bytes'] == [1010, 1020, 1025]
+
+
+def test_only_finished_hours_are_written():
+    store = tsblob.BlobStore()
+    store.add([sample(HOUR + 3590), sample(HOUR + 3605)])
+    connection = FakeConnection()
+
+    assert store.write(connection, now=HOUR + 3610) == 1
+    assert connection.fake_cursor.rows[0][1] == datetime.fromtimestamp(HOUR)
+    store.add([sample(HOUR + 3610)])
+    assert store.write(FakeConnection(), now=HOUR + 3615) == 0
+    assert list(store.hours('abc123def456', HOUR, HOUR + 7200)) == [HOUR + 3600]
+
+
+def test_open_hour_is_checkpointed_after_the_interval():
+    store = tsblob.BlobStore(checkpoint_interval=0)
+    store.add([sample(HOUR + 10)])
+
+    assert store.write(FakeConnection(), now=HOUR + 20) == 1
+    assert store.write(FakeConnection(), now=HOUR + 25) == 0
+    assert list(store.hours('abc123def456', HOUR, HOUR + 3600)) == [HOUR]
+
+
+def test_read_range_adds_samples_not_stored_yet():
+    stored = [sample(HOUR + 10), sample(HOUR + 20)]
+    checkpoint = tsblob.encode(HOUR, [s['read_at'] for s in stored], columns(stored))
+    store = tsblob.BlobStore()
+    store.add(stored + [sample(HOUR + 30)] + [sample(HOUR + 3600 + 5)])
+    connection = FakeConnection(blobs=[(HOUR, checkpoint)])
+
+    samples = list(tsblob.read_range(connection, 'abc123def456' + '0' * 52, HOUR + 15, HOUR + 7200, store))
+
+    assert [s['timestamp'] for s in samples] == [HOUR + 20, HOUR + 30, HOUR + 3605]
+    assert [s['net_rx_bytes'] for s in samples] == [1020, 1030, 4605]
@@ -0,0 +1,152 @@
+import pytest
+
+import warm_pool
+
+
+class FakeContainer:
+    def __init__(self, client, name, labels, ports, status='running'):
+        self.client = client
+        self.id = self.short_id = name
+        self.name = name
+        self.labels = labels
+        self.status = status
+        self.attrs = {'HostConfig': {'PortBindings': {
+            internal: [{'HostIp': '', 'HostPort': str(external)}] for internal, external in ports.items()}}}
+
+    def pause(self):
+        self.status = 'paused'
+
+    def unpause(self):
+        self.status = 'running'
+
+    def rename(self, name):
+        self.name = name
+
+    def remove(self, force=False):
+        self.client.containers.items.remove(self)
+
+
+class FakeContainers:
+    def __init__(self, client):
+        self.client = client
+        self.items = []
+
+    def run(self, image=None, name=None, labels=None, ports=None, **kwargs):
+        container = FakeContainer(self.client, name, labels, ports)
+        self.items.append(container)
+        return container
+
+    def list(self, all=False, filters=None):
+        label = filters['label'].split('=', 1)[1]
+        return [c for c in self.items if c.labels.get(warm_pool.SHAPE_LABEL) == label]
+
+
+class FakeClient:
+    def __init__(self):
+        self.containers = FakeContainers(self)
+
+
+class Ports:
+    def __init__(self):
+        self.next = 20000
+        self.freed = []
+
+    def allocate(self, count):
+        ports = list(range(self.next, self.next + count))
+        self.next += count
+        return ports
+
+    def free(self, ports):
+        self.freed.extend(ports)
+
+
+@pytest.fixture
+def pool(monkeypatch, tmp_path):
+    monkeypatch.setattr(warm_pool, 'LOCK_PATH', str(tmp_path / 'pool.lock'))
+    monkeypatch.setattr(warm_pool.image_cache, 'ensure_base_image', lambda client: 'base')
+    monkeypatch.setattr(warm_pool.readiness, 'wait_for_ssh', lambda *args, **kwargs: 0.0)
+    ports = Ports()
+    pool = warm_pool.WarmPool(FakeClient(), ports.allocate, port_release=ports.free)
+    pool.add_shape(1, 1024, target=2, high_water=2)
+    pool.ports = ports
+    return pool
+
+
+def test_refill_creates_paused_containers(pool):
+    assert pool.refill('1c1024m') == 2
+    assert [c.status for c in pool.client.containers.items] == ['paused', 'paused']
+    assert pool.ports.freed == []
+
+
+def test_trim_above_high_water_frees_ports(pool):
+    pool.refill('1c1024m')
+    pool.shapes['1c1024m'].update(target=1, high_water=1)
+    trimmed = pool.client.containers.items[1]
+    trimmed_ports = warm_pool.bound_ports(trimmed)
+
+    pool.refill('1c1024m')
+    assert trimmed not in pool.client.containers.items
+    assert sorted(pool.ports.freed) == sorted(trimmed_ports)
+
+
+def test_stale_containers_are_removed_with_their_ports(pool):
+    pool.refill('1c1024m')
+    stale = pool.client.containers.items[0]
+    stale.status = 'exited'
+    stale_ports = warm_pool.bound_ports(stale)
+
+    pool.refill('1c1024m')
+    assert stale not in pool.client.containers.items
+    assert sorted(pool.ports.freed) == sorted(stale_ports)
+
+
+def test_failed_create_removes_container_and_frees_ports(pool, monkeypatch):
+    def not_ready(*args, **kwargs):
+        raise warm_pool.readiness.NotReadyError("no banner")
+
+    monkeypatch.setattr(warm_pool.readiness, 'wait_for_ssh', not_ready)
+    with pytest.raises(warm_pool.readiness.NotReadyError):
+        pool.refill('1c1024m')
+    assert pool.client.containers.items == []
+    assert pool.ports.freed == [20000, 20001, 20002, 20003, 20004]
+
+
+def test_failed_claim_removes_container_and_frees_ports(pool, monkeypatch):
+    pool.refill('1c1024m')
+    claimed = pool.client.containers.items[0]
+    claimed_ports = warm_pool.bound_ports(claimed)
+
+    def no_password(container, password):
+        raise RuntimeError("exec failed")
+
+    monkeypatch.setattr(warm_pool.image_cache, 'set_root_password', no_password)
+    assert pool.claim(1, 1024, 'secret') is None
+    assert claimed not in pool.client.containers.items
+    assert sorted(pool.ports.freed) == sorted(claimed_ports)
+
+
+def test_failed_run_frees_ports(pool, monkeypatch):
+    def broken_run(**kwargs):
+        raise RuntimeError("docker down")
+
+    monkeypatch.setattr(pool.client.containers, 'run', broken_run)
+    with pytest.raises(RuntimeError):
+        pool.refill('1c1024m')
+    assert pool.ports.freed == [20000, 20001, 20002, 20003, 20004]
+
+
+def test_pool_from_config_skips_unknown_plans():
+    def lookup(plan_id):
+        if plan_id == 2:
+            raise Exception(f"Plan ID {plan_id} not found.")
+        return {'vcpu': 1, 'ram': 1024}
+
+    pool = warm_pool.pool_from_config(FakeClient(), Ports().allocate, lookup,
+                                      config={1: {'target': 1, 'high_water': 2}, 2: {'target': 1, 'high_water': 1}})
+    assert list(pool.shapes) == ['1c1024m']
+
+
+def test_configure_adds_shapes_to_the_shared_pool(pool):
+    pool.configure(lambda plan_id: {'vcpu': 2, 'ram': 2048}, config={3: {'target': 1, 'high_water': 1}})
+    assert pool.shapes['2c2048m'] == {'vcpu': 2, 'ram': 2048, 'target': 1, 'high_water': 1}
+    assert '1c1024m' in pool.shapes
@@ -0,0 +1,161 @@
+"""Per-phase timing of spawns and deploys.
+
+A ``Trace`` covers one spawn or deploy and records how long each phase
+took. The trace of the running operation is kept in a context variable, so
+code deep in the call chain (image cache, readiness wait, DB inserts) can
+time itself with ``tracing.span('phase')`` without a trace being passed
+around; outside a trace the span is a no-op.
+
+Traces carry a correlation id. The deployer creates it (or takes the
+caller's ``X-Correlation-ID`` header) and sends it to the node, which uses
+it for its own spawn trace and returns its spans; the deployer adds them
+to its trace with a ``node.`` prefix.
+
+Finished traces feed per-phase latency histograms, and any trace slower
+than TRACE_SLOW_SECONDS is logged with its full breakdown.
+"""
+
+import contextvars
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SLOW_SECONDS = float(os.getenv('TRACE_SLOW_SECONDS', '15'))
+CORRELATION_HEADER = 'X-Correlation-ID'
+
+# Upper bounds in seconds; the last bucket catches everything slower
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, float('inf'))
+
+_current = contextvars.ContextVar('trace', default=None)
+_histograms = {}  # (operation, phase) -> Histogram
+_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the ``q`` quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def as_dict(self):
+        cumulative = []
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            cumulative.append(['+Inf' if bound == float('inf') else bound, seen])
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 4),
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': cumulative,
+        }
+
+
+def observe(operation, phase, seconds):
+    with _lock:
+        histogram = _histograms.get((operation, phase))
+        if histogram is None:
+            histogram = _histograms[(operation, phase)] = Histogram()
+        histogram.observe(seconds)
+
+
+def histograms():
+    """Latency histograms as ``{operation: {phase: histogram}}``."""
+    with _lock:
+        result = {}
+        for (operation, phase), histogram in sorted(_histograms.items()):
+            result.setdefault(operation, {})[phase] = histogram.as_dict()
+        return result
+
+
+class Trace:
+    def __init__(self, operation, correlation_id=None, slow_seconds=SLOW_SECONDS):
+        self.operation = operation
+        self.correlation_id = correlation_id or uuid.uuid4().hex
+        self.slow_seconds = slow_seconds
+        self.spans = []  # (phase, seconds) in the order they ended
+        self.total = None
+        self._started = time.monotonic()
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        self.finish(ok=exc_type is None)
+        return False
+
+    @contextmanager
+    def span(self, phase):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.spans.append((phase, time.monotonic() - started))
+
+    def add(self, phase, seconds):
+        """Record a span timed elsewhere, e.g. on the node."""
+        self.spans.append((phase, float(seconds)))
+
+    def finish(self, ok=True):
+        if self.total is not None:
+            return
+        self.total = time.monotonic() - self._started
+        for phase, seconds in self.spans:
+            observe(self.operation, phase, seconds)
+        observe(self.operation, 'total' if ok else 'failed', self.total)
+        if self.total > self.slow_seconds:
+            breakdown = ', '.join(f"{phase}={seconds:.3f}s" for phase, seconds in self.spans)
+            logger.warning("Slow %s %s took %.3fs: %s", self.operation, self.correlation_id, self.total, breakdown)
+
+    def as_dict(self):
+        total = self.total if self.total is not None else time.monotonic() - self._started
+        return {
+            'correlation_id': self.correlation_id,
+            'total_seconds': round(total, 4),
+            'spans': [{'phase': phase, 'seconds': round(seconds, 4)} for phase, seconds in self.spans],
+        }
+
+
+def current():
+    return _current.get()
+
+
+@contextmanager
+def span(phase):
+    """Time a phase of the current trace, if there is one."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(phase):
+        yield
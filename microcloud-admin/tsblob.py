@@ -0,0 +1,260 @@
+"""Compressed per-container-hour blobs of metric samples.
+
+One row of TB_Instance_Metrics_Blob holds every sample of a container for
+one hour:
+
+    header   magic 'MCTS', version, column count, sample count, hour start (unix seconds)
+    payload  zlib(timestamps, column 1, column 2, ...)
+
+Timestamps are milliseconds since the hour start. Each column is stored as
+fixed-point integers (the value times its scale in ``COLUMNS``). Both are
+delta-encoded as little-endian ``array('q')``, so slowly changing gauges
+and monotonic counters turn into runs of small numbers that zlib packs
+well.
+
+``BlobStore`` keeps the current hour of each container in memory. An
+hour's blob is upserted once the hour is over, and the open hour is only
+checkpointed every METRICS_BLOB_CHECKPOINT seconds, so a flush doesn't
+re-encode and rewrite a growing blob per container. ``read_range`` streams
+decoded samples for a time range one blob at a time, and takes what isn't
+stored yet from the ``BlobStore``.
+"""
+
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from datetime import datetime
+
+MAGIC = b'MCTS'
+VERSION = 1
+TABLE = 'TB_Instance_Metrics_Blob'
+CHECKPOINT_INTERVAL = float(os.getenv('METRICS_BLOB_CHECKPOINT', '600'))
+
+# (field, scale): values are stored as round(value * scale)
+COLUMNS = (
+    ('cpu_percent', 100), ('mem_usage', 100), ('mem_percent', 100),
+    ('net_rx_bytes', 1), ('net_tx_bytes', 1), ('blk_read_bytes', 1), ('blk_write_bytes', 1),
+    ('net_rx_rate', 10), ('net_tx_rate', 10), ('blk_read_rate', 10), ('blk_write_rate', 10),
+    ('pids', 1),
+)
+
+_HEADER = struct.Struct('<4sBHIq')
+
+
+def _delta(values):
+    out = array('q', values)
+    for i in range(len(out) - 1, 0, -1):
+        out[i] -= out[i - 1]
+    return out
+
+
+def _undelta(deltas):
+    total = 0
+    for i, d in enumerate(deltas):
+        total += d
+        deltas[i] = total
+    return deltas
+
+
+def _to_bytes(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(data):
+    values = array('q')
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def hour_start(ts):
+    return int(ts) - int(ts) % 3600
+
+
+def encode(start, timestamps, columns):
+    """Pack one hour of samples.
+
+    ``timestamps`` are unix seconds, ``columns`` maps each field in
+    ``COLUMNS`` to a list of values in timestamp order.
+    """
+    parts = [_to_bytes(_delta(round((ts - start) * 1000) for ts in timestamps))]
+    for field, scale in COLUMNS:
+        parts.append(_to_bytes(_delta(round((v or 0) * scale) for v in columns[field])))
+    header = _HEADER.pack(MAGIC, VERSION, len(COLUMNS), len(timestamps), start)
+    return header + zlib.compress(b''.join(parts), 6)
+
+
+def decode(blob):
+    """Unpack a blob into ``(timestamps, {field: values})``."""
+    magic, version, column_count, count, start = _HEADER.unpack_from(blob)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Not a v{VERSION} metrics blob")
+    if column_count != len(COLUMNS):
+        raise ValueError(f"Blob has {column_count} columns, expected {len(COLUMNS)}")
+    payload = zlib.decompress(blob[_HEADER.size:])
+    width = count * 8
+    timestamps = [start + ms / 1000 for ms in _undelta(_from_bytes(payload[:width]))]
+    columns = {}
+    for i, (field, scale) in enumerate(COLUMNS, start=1):
+        values = _undelta(_from_bytes(payload[i * width:(i + 1) * width]))
+        columns[field] = [v / scale if scale != 1 else v for v in values]
+    return timestamps, columns
+
+
+def create_table(connection):
+    cursor = connection.cursor()
+    cursor.execute(f"""
+        IF OBJECT_ID('{TABLE}', 'U') IS NULL
+            CREATE TABLE {TABLE} (
+                container_id VARCHAR(64) NOT NULL,
+                hour_start DATETIME NOT NULL,
+                samples INT NOT NULL,
+                data VARBINARY(MAX) NOT NULL,
+                CONSTRAINT PK_{TABLE} PRIMARY KEY (container_id, hour_start)
+            )
+    """)
+    connection.commit()
+
+
+class _Hour:
+    def __init__(self, start):
+        self.start = start
+        self.timestamps = []
+        self.columns = {field: [] for field, _ in COLUMNS}
+        self.dirty = False
+        self.loaded = False  # merged with what's already stored
+        self.written_at = time.monotonic()  # the open hour's first checkpoint comes after a full interval
+
+    def extend(self, timestamps, columns):
+        self.timestamps.extend(timestamps)
+        for field, _ in COLUMNS:
+            self.columns[field].extend(columns[field])
+
+
+class BlobStore:
+    """Accumulates samples per container-hour and upserts their blobs."""
+
+    def __init__(self, checkpoint_interval=CHECKPOINT_INTERVAL):
+        self.checkpoint_interval = checkpoint_interval
+        self._hours = {}  # (container id, hour start) -> _Hour
+        self._lock = threading.Lock()
+
+    def add(self, samples):
+        with self._lock:
+            for sample in samples:
+                ts = sample['read_at']
+                key = (sample['container_id'], hour_start(ts))
+                hour = self._hours.get(key)
+                if hour is None:
+                    hour = self._hours[key] = _Hour(key[1])
+                if hour.timestamps and ts <= hour.timestamps[-1]:
+                    continue
+                hour.timestamps.append(ts)
+                for field, _ in COLUMNS:
+                    hour.columns[field].append(sample.get(field) or 0)
+                hour.dirty = True
+
+    def _load_existing(self, cursor, container_id, hour):
+        # After a restart, samples already stored for this hour come first
+        cursor.execute(f"SELECT data FROM {TABLE} WHERE container_id = ? AND hour_start = ?",
+                       (container_id, datetime.fromtimestamp(hour.start)))
+        row = cursor.fetchone()
+        if row is not None:
+            timestamps, columns = decode(bytes(row.data))
+            pending_ts, pending_cols = hour.timestamps, hour.columns
+            hour.timestamps, hour.columns = [], {field: [] for field, _ in COLUMNS}
+            hour.extend(timestamps, columns)
+            keep = [i for i, ts in enumerate(pending_ts) if not timestamps or ts > timestamps[-1]]
+            hour.extend([pending_ts[i] for i in keep], {f: [pending_cols[f][i] for i in keep] for f in pending_cols})
+        hour.loaded = True
+
+    def write(self, connection, now=None):
+        """Upsert the blobs of finished hours, and of open ones due a checkpoint; returns the count.
+
+        Finished hours are dropped from memory once written.
+        """
+        now = time.time() if now is None else now
+        current = hour_start(now)
+        checkpoint_due = time.monotonic() - self.checkpoint_interval
+        with self._lock:
+            dirty = [(key, hour) for key, hour in self._hours.items()
+                     if hour.dirty and (hour.start < current or hour.written_at <= checkpoint_due)]
+            if not dirty:
+                return 0
+            cursor = connection.cursor()
+            for (container_id, _), hour in dirty:
+                if not hour.loaded:
+                    self._load_existing(cursor, container_id, hour)
+            rows = [
+                (container_id, datetime.fromtimestamp(hour.start), len(hour.timestamps),
+                 encode(hour.start, hour.timestamps, hour.columns))
+                for (container_id, _), hour in dirty
+            ]
+            # No fast_executemany here: it buffers VARBINARY(MAX) parameters badly
+            cursor.executemany(f"""
+                MERGE {TABLE} WITH (HOLDLOCK) AS t
+                USING (SELECT ? AS container_id, ? AS hour_start, ? AS samples, ? AS data) AS s
+                ON t.container_id = s.container_id AND t.hour_start = s.hour_start
+                WHEN MATCHED THEN UPDATE SET samples = s.samples, data = s.data
+                WHEN NOT MATCHED THEN INSERT (container_id, hour_start, samples, data)
+                    VALUES (s.container_id, s.hour_start, s.samples, s.data);
+            """, rows)
+            written_at = time.monotonic()
+            for _, hour in dirty:
+                hour.dirty = False
+                hour.written_at = written_at
+            for key in [k for k, h in self._hours.items() if h.start < current and not h.dirty]:
+                del self._hours[key]
+            return len(rows)
+
+    def hours(self, container_id, start, end):
+        """Copies of the in-memory hours of a container overlapping start..end, by hour start."""
+        with self._lock:
+            return {
+                hour.start: (list(hour.timestamps), {field: list(values) for field, values in hour.columns.items()})
+                for (cid, _), hour in self._hours.items()
+                if cid == container_id[:12] and hour.start < end and hour.start + 3600 > start
+            }
+
+
+def _samples(timestamps, columns, start, end, after=None):
+    for i, ts in enumerate(timestamps):
+        if start <= ts < end and (after is None or ts > after):
+            sample = {field: columns[field][i] for field, _ in COLUMNS}
+            sample['timestamp'] = ts
+            yield sample
+
+
+def read_range(connection, container_id, start, end, store=None):
+    """Yield the samples of one container between two unix timestamps, oldest first.
+
+    Blobs are fetched and decoded one hour at a time, so long ranges never
+    sit in memory whole. Samples a ``store`` holds that aren't in the stored
+    blob of their hour yet come after the stored ones. The connection must
+    stay checked out until the generator is exhausted.
+    """
+    memory = store.hours(container_id, start, end) if store is not None else {}
+    cursor = connection.cursor()
+    cursor.execute(f"""
+        SELECT hour_start, data FROM {TABLE}
+        WHERE container_id = ? AND hour_start >= ? AND hour_start < ?
+        ORDER BY hour_start
+    """, (container_id[:12], datetime.fromtimestamp(hour_start(start)), datetime.fromtimestamp(end)))
+    while True:
+        row = cursor.fetchone()
+        stored_hour = int(row.hour_start.timestamp()) if row is not None else None
+        for hour in sorted(h for h in memory if stored_hour is None or h < stored_hour):
+            yield from _samples(*memory.pop(hour), start, end)
+        if row is None:
+            return
+        timestamps, columns = decode(bytes(row.data))
+        yield from _samples(timestamps, columns, start, end)
+        if stored_hour in memory:
+            yield from _samples(*memory.pop(stored_hour), start, end, after=timestamps[-1] if timestamps else None)
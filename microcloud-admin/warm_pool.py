@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""Per-node warm pool of pre-created instance containers.
+
+Pool containers are started from the cached base image with their port
+bindings and resource limits already in place, then paused. Membership is
+encoded in the container name (``mcpool-<shape>-<token>``) so it survives
+restarts of whatever process manages the pool; claiming a container renames
+it out of the pool under a node-wide lock file.
+
+Pool sizes are configured per plan in a JSON file pointed to by
+WARM_POOL_CONFIG, e.g.:
+
+    {"default": {"target": 0, "high_water": 0},
+     "plans": {"1": {"target": 3, "high_water": 5}}}
+
+``target`` is the number of idle containers the refill loop keeps ready;
+anything above ``high_water`` is removed.
+
+Usage on a node:
+    python3 warm_pool.py run       # keep the pools topped up in the background
+    python3 warm_pool.py refill    # top up once and exit
+    python3 warm_pool.py status
+"""
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+
+import docker
+
+import image_cache
+from instances import INTERNAL_PORTS
+import port_allocator
+import readiness
+
+logger = logging.getLogger(__name__)
+
+POOL_PREFIX = 'mcpool-'
+SHAPE_LABEL = 'microcloud.pool.shape'
+LOCK_PATH = os.getenv('WARM_POOL_LOCK', '/tmp/microcloud_pool.lock')
+CONFIG_PATH = os.getenv('WARM_POOL_CONFIG', 'warm_pool.json')
+REFILL_INTERVAL = float(os.getenv('WARM_POOL_REFILL_INTERVAL', '30'))
+
+
+def shape_key(vcpu, ram):
+    """Name-safe key for a vcpu/ram shape, e.g. ``1c1024m``."""
+    return f"{float(vcpu):g}c{int(ram)}m".replace('.', '_')
+
+
+def load_config(path=CONFIG_PATH):
+    """Return ``{plan_id: {'target': n, 'high_water': m}}`` from the config file."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        raw = json.load(f)
+    default = raw.get('default', {})
+    config = {}
+    for plan_id, sizes in raw.get('plans', {}).items():
+        target = int(sizes.get('target', default.get('target', 0)))
+        high_water = int(sizes.get('high_water', default.get('high_water', target)))
+        config[int(plan_id)] = {'target': target, 'high_water': max(target, high_water)}
+    return config
+
+
+def container_ports(container):
+    """External host ports of a container, ordered like INTERNAL_PORTS."""
+    bindings = container.attrs['HostConfig']['PortBindings'] or {}
+    return [int(bindings[f'{port}/tcp'][0]['HostPort']) for port in INTERNAL_PORTS]
+
+
+def bound_ports(container):
+    """Every host port a container publishes.
+
+    Read from HostConfig rather than ``container.ports``, which is empty
+    once the container has exited.
+    """
+    bindings = container.attrs['HostConfig'].get('PortBindings') or {}
+    return [int(entry['HostPort']) for entries in bindings.values() for entry in entries or [] if entry.get('HostPort')]
+
+
+class _NodeLock:
+    """Serialises pool changes across threads and processes on a node."""
+
+    _thread_lock = threading.Lock()
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        self._file = open(LOCK_PATH, 'w')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._thread_lock.release()
+
+
+class WarmPool:
+    """Claims and refills pooled containers for each configured plan shape."""
+
+    def __init__(self, client, port_allocator, shapes=None, port_release=None):
+        # port_allocator(count) returns a list of free host ports, port_release(ports) gives them back
+        self.client = client
+        self.port_allocator = port_allocator
+        self.port_release = port_release
+        # shape key -> {'vcpu', 'ram', 'target', 'high_water'}
+        self.shapes = shapes or {}
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_shape(self, vcpu, ram, target, high_water):
+        self.shapes[shape_key(vcpu, ram)] = {
+            'vcpu': vcpu, 'ram': ram, 'target': target, 'high_water': high_water,
+        }
+
+    def configure(self, plan_lookup, config=None):
+        """Add a shape for each plan in the config (WARM_POOL_CONFIG by default).
+
+        plan_lookup(plan_id) returns the plan's ``{'vcpu', 'ram'}``.
+        """
+        for plan_id, sizes in (config if config is not None else load_config()).items():
+            try:
+                plan = plan_lookup(plan_id)
+            except Exception as e:
+                # One bad entry shouldn't keep the service from starting
+                logger.error("Warm pool plan %s skipped: %s", plan_id, e)
+                continue
+            self.add_shape(plan['vcpu'], plan['ram'], sizes['target'], sizes['high_water'])
+
+    def _members(self, key):
+        return self.client.containers.list(
+            all=True, filters={'label': f'{SHAPE_LABEL}={key}', 'name': f'{POOL_PREFIX}{key}-'}
+        )
+
+    def claim(self, vcpu, ram, ssh_password):
+        """Take an idle container of the given shape out of the pool.
+
+        Returns ``(container, external_ports, ready_seconds)`` or ``None``
+        when the pool is empty or the claimed container doesn't come up, in
+        which case the caller should fall back to a cold spawn.
+        """
+        key = shape_key(vcpu, ram)
+        with _NodeLock():
+            idle = [c for c in self._members(key) if c.status == 'paused']
+            if not idle:
+                return None
+            container = idle[0]
+            container.rename(f"mc-{secrets.token_hex(6)}")
+        self._wakeup.set()
+
+        try:
+            container.unpause()
+            image_cache.set_root_password(container, ssh_password)
+            ports = container_ports(container)
+            ready_seconds = readiness.wait_for_ssh('127.0.0.1', ports[2], container=container)
+        except Exception as e:
+            # Out of the pool already, so nothing else would ever remove it
+            logger.warning("Claimed pool container %s failed to start, removing it: %s", container.id, e)
+            try:
+                self._remove(container)
+            except Exception as e:
+                logger.warning("Could not remove claimed pool container %s: %s", container.id, e)
+            return None
+        return container, ports, ready_seconds
+
+    def _release(self, ports):
+        if self.port_release is not None and ports:
+            self.port_release(ports)
+
+    def _remove(self, container):
+        ports = bound_ports(container)
+        container.remove(force=True)
+        self._release(ports)
+
+    def _create(self, key, shape):
+        image = image_cache.ensure_base_image(self.client)
+        ports = self.port_allocator(len(INTERNAL_PORTS))
+        container = None
+        try:
+            container = self.client.containers.run(
+                image=image,
+                name=f"{POOL_PREFIX}{key}-{secrets.token_hex(4)}",
+                labels={SHAPE_LABEL: key},
+                detach=True,
+                mem_limit=f"{shape['ram']}m",
+                nano_cpus=int(float(shape['vcpu']) * 1e9),
+                ports={f'{internal}/tcp': external for internal, external in zip(INTERNAL_PORTS, ports)},
+            )
+            # Only pool containers whose sshd is already up, so claims are instant
+            readiness.wait_for_ssh('127.0.0.1', ports[2], container=container)
+            container.pause()
+        except Exception:
+            if container is not None:
+                try:
+                    container.remove(force=True)
+                except Exception as e:
+                    logger.warning("Could not remove half-created pool container %s: %s", container.id, e)
+            self._release(ports)
+            raise
+        return container
+
+    def refill(self, key):
+        """Bring one shape's pool back between its target and high-water mark."""
+        shape = self.shapes[key]
+        with _NodeLock():
+            members = self._members(key)
+            for container in members:
+                if container.status == 'running':
+                    container.pause()
+                elif container.status != 'paused':
+                    # Left over from a crash or reboot; its bindings are stale
+                    self._remove(container)
+            idle = [c for c in self._members(key) if c.status == 'paused']
+            for container in idle[shape['high_water']:]:
+                self._remove(container)
+
+        created = 0
+        for _ in range(shape['target'] - len(idle)):
+            self._create(key, shape)
+            created += 1
+        if created:
+            logger.info("Warm pool %s: created %d container(s)", key, created)
+        return created
+
+    def refill_all(self):
+        for key in list(self.shapes):
+            try:
+                self.refill(key)
+            except Exception as e:
+                logger.error("Warm pool refill for %s failed: %s", key, e)
+
+    def status(self):
+        return {
+            key: {
+                'idle': sum(1 for c in self._members(key) if c.status == 'paused'),
+                'target': shape['target'],
+                'high_water': shape['high_water'],
+            }
+            for key, shape in self.shapes.items()
+        }
+
+    def _run(self, interval):
+        while not self._stop.is_set():
+            self.refill_all()
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+
+    def start(self, interval=REFILL_INTERVAL):
+        """Refill in a background thread; claims trigger an immediate refill."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+
+def pool_from_config(client, port_allocator, plan_lookup, config=None, port_release=None):
+    """Build a WarmPool with a shape for each configured plan."""
+    pool = WarmPool(client, port_allocator, port_release=port_release)
+    pool.configure(plan_lookup, config)
+    return pool
+
+
+def main():
+    from main import get_plan_details
+
+    parser = argparse.ArgumentParser(description="Manage the warm container pool on this node.")
+    parser.add_argument('command', choices=['run', 'refill', 'status'])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    client = docker.from_env()
+    allocator = port_allocator.PortAllocator(seed=lambda: port_allocator.docker_bound_ports(client))
+    pool = pool_from_config(client, allocator.allocate, get_plan_details, port_release=allocator.free)
+
+    if args.command == 'status':
+        print(json.dumps(pool.status(), indent=2))
+    elif args.command == 'refill':
+        pool.refill_all()
+    else:
+        pool.start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pool.stop()
+
+
+if __name__ == '__main__':
+    main()
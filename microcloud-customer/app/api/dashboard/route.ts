@@ -28,6 +28,9 @@ export async function GET(req: NextRequest) {
     await sql.connect(dbConfig);
 
     console.log("Running SQL query...");
+    // Every instance of the customer, with the latest usage the metrics
+    // pipeline keeps in TB_Instance_State (one primary key seek per
+    // instance); instances it hasn't sampled yet come back with NULL usage
     const result = await sql.query`
       SELECT 
         s.renewal_date, 
@@ -36,12 +39,17 @@ export async function GET(req: NextRequest) {
         p.vcpu, 
         p.storage, 
         n.node_ip, 
-        i.instance_status 
+        i.instance_status,
+        st.cpu_percent,
+        st.mem_usage,
+        st.mem_percent,
+        st.last_seen
       FROM TB_Customer c
       JOIN TB_Subscription s ON s.customer_id = c.customer_id
       JOIN TB_Plans p ON p.plan_id = s.plan_id
       JOIN TB_Instances i ON i.subscription_id = s.sub_id
       JOIN TB_Nodes n ON n.node_id = i.node_id
+      LEFT JOIN TB_Instance_State st ON st.instance_id = i.instance_id
       WHERE c.email = ${email}`;
 
     // Check if the query returned any results